@@ -7,8 +7,6 @@ __version__ = "1.0.1"
 __author__  = "Harry Tunstall"
 
 import gui
-import lookup
-import database
 
 
 licence = "PyFinance  Copyright (C) 2022  {}\n\n".format(__author__) + \
@@ -0,0 +1,964 @@
+"""
+Benchmarks for the slow parts of the software package. Run from the command
+line, e.g.
+
+    python benchmark.py formatting
+
+The results can be saved as JSON, and compared against a saved baseline to
+catch regressions, e.g.
+
+    python benchmark.py endtoend --json baseline.json
+    python benchmark.py endtoend --baseline baseline.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+
+from   datetime import datetime
+
+import numpy   as np
+import pandas  as pd
+import pymongo
+
+import lookup
+import money
+import report
+import database
+import dedup
+import export
+import importer
+import storage
+
+#------------------------------------------------------------------------------
+def timeit(function, repeat=3):
+    """
+    Time a function, returning the best time of several runs.
+
+    Parameters
+    ----------
+    function : Callable
+        The function to time, called with no arguments.
+    repeat : Integer, optional
+        How many times to run the function. The default is 3.
+
+    Returns
+    -------
+    Float
+        The fastest run in seconds.
+
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+#------------------------------------------------------------------------------
+
+def profile(function, repeat=3):
+    """
+    Time a function with timeit, then run it once more under tracemalloc for
+    its peak memory, so the tracing does not slow the timed runs.
+
+    Parameters
+    ----------
+    function : Callable
+        The function to profile, called with no arguments.
+    repeat : Integer, optional
+        How many times to run the function for the time. The default is 3.
+
+    Returns
+    -------
+    time : Float
+        The fastest run in seconds.
+    peak : Integer
+        The peak memory allocated by the run in bytes.
+
+    """
+    time_s = timeit(function, repeat)
+
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return time_s, peak
+#------------------------------------------------------------------------------
+
+def benchFormatting(sizes=(1000, 10000, 100000, 1000000), seed=0):
+    """
+    Compare the column-at-a-time money formatting against the old row-wise
+    DataFrame.apply, and check it scales linearly with the number of rows.
+
+    Parameters
+    ----------
+    sizes : Tuple of Integers, optional
+        The row counts to time.
+    seed : Integer, optional
+        The random seed for the generated amounts. The default is 0.
+
+    Returns
+    -------
+    results : List of dictionaries
+        One entry per row count with the timings in seconds.
+
+    """
+    def rowwise(df):
+        return df.apply(lambda row: "£{:0,.2f}".format(row["Amount"]).replace("£-", "-£"), axis=1)
+    #--------------------------------------------------------------------------
+
+    rng     = np.random.default_rng(seed)
+    results = []
+
+    print("{:>10} | {:>12} | {:>12} | {:>8} | {:>14}".format("Rows", "Row-wise (s)", "Column (s)", "Speedup", "ns/row (column)"))
+    for n in sizes:
+        df = pd.DataFrame({"Amount" : np.round(rng.uniform(-500, 5000, n), 2)})
+
+        # Check they agree before timing them
+        sample = df.head(1000)
+        if not (money.formatMoney(sample["Amount"]) == rowwise(sample)).all():
+            raise AssertionError("The column formatting does not match the row-wise formatting")
+
+        # The row-wise version gets very slow, only time it on the smaller sizes
+        t_row = timeit(lambda: rowwise(df), repeat=1) if n <= 100000 else float("nan")
+        t_col = timeit(lambda: money.formatMoney(df["Amount"]))
+
+        results.append({"rows" : n, "rowwise" : t_row, "column" : t_col})
+        print("{:>10} | {:>12.4f} | {:>12.4f} | {:>8.1f} | {:>14.1f}".format(n, t_row, t_col, t_row / t_col, 1e9 * t_col / n))
+
+    # Linear scaling means the time per row stays flat as the rows grow
+    per_row = [r["column"] / r["rows"] for r in results]
+    print("Time per row, largest/smallest: {:.2f} (1.0 is perfectly linear)".format(per_row[-1] / per_row[0]))
+
+    return results
+#------------------------------------------------------------------------------
+
+def benchPence(sizes=(10000, 1000000, 10000000), seed=0):
+    """
+    Compare summing and splitting amounts as float pounds against the exact
+    int64 pence kernels in money, and count how far the float totals drift.
+
+    Parameters
+    ----------
+    sizes : Tuple of Integers, optional
+        The number of amounts.
+    seed : Integer, optional
+        The random seed for the generated amounts. The default is 0.
+
+    Returns
+    -------
+    results : List of dictionaries
+        One entry per size with the timings in seconds.
+
+    """
+    rng     = np.random.default_rng(seed)
+    results = []
+
+    print("{:>10} | {:>12} | {:>12} | {:>12} | {:>12} | {:>10}".format("Amounts", "Sum float", "Sum pence", "Split float", "Split pence", "Drift (p)"))
+    for n in sizes:
+        pence     = rng.integers(-5000, 500000, n)
+        pounds    = pence / 100
+        fractions = rng.choice([0, 0.5, 1, 1 / 3], n)
+        groups    = rng.integers(0, len(lookup.valid_categories), n)
+
+        t_sum_f   = timeit(lambda: pd.Series(pounds).groupby(groups).sum())
+        t_sum_p   = timeit(lambda: money.sumPence(pence, groups))
+        t_split_f = timeit(lambda: np.round(pounds * fractions, 2))
+        t_split_p = timeit(lambda: money.splitPence(pence, fractions))
+
+        # How many pence the float total is out by, once rounded
+        drift = abs(round(pounds.sum() * 100) - money.sumPence(pence))
+
+        results.append({"amounts" : n, "sum_float" : t_sum_f, "sum_pence" : t_sum_p, "split_float" : t_split_f, "split_pence" : t_split_p})
+        print("{:>10} | {:>12.4f} | {:>12.4f} | {:>12.4f} | {:>12.4f} | {:>10.0f}".format(n, t_sum_f, t_sum_p, t_split_f, t_split_p, drift))
+
+    return results
+#------------------------------------------------------------------------------
+
+def monthDocuments(n, seed=0, year=2022, month=1):
+    """
+    Generate the documents for a month, in the same format as they are
+    stored in the database.
+
+    Parameters
+    ----------
+    n : Integer
+        The number of documents.
+    seed : Integer, optional
+        The random seed. The default is 0.
+    year : Integer, optional
+        The year of the dates. The default is 2022.
+    month : Integer, optional
+        The month of the dates. The default is 1.
+
+    Returns
+    -------
+    List of dictionaries
+
+    """
+    rng = np.random.default_rng(seed)
+
+    amount   = np.round(rng.uniform(-50, 500, n), 2)
+    courtney = np.round(amount * rng.choice([0, 0.5, 1], n), 3)
+
+    df = pd.DataFrame({"Name"      : ["Expense {}".format(i) for i in range(n)],
+                       "Date"      : pd.to_datetime({"year" : year, "month" : month, "day" : rng.integers(1, 29, n)}),
+                       "Category"  : rng.choice(lookup.valid_categories, n),
+                       "Amount"    : amount,
+                       "Courtney"  : courtney,
+                       "Recurring" : rng.random(n) < 0.1})
+
+    return [{key : (value.to_pydatetime() if key == "Date" else value) for key, value in doc.items()} for doc in df.to_dict("records")]
+#------------------------------------------------------------------------------
+
+def monthFrame(n, seed=0, year=2022, month=1):
+    """
+    Generate a month summary DataFrame, in the same layout as
+    database.getMonthSummary returns, without needing a database.
+
+    Parameters
+    ----------
+    n : Integer
+        The number of rows.
+    seed : Integer, optional
+        The random seed. The default is 0.
+    year : Integer, optional
+        The year of the dates. The default is 2022.
+    month : Integer, optional
+        The month of the dates. The default is 1.
+
+    Returns
+    -------
+    Pandas DataFrame
+
+    """
+    df = pd.DataFrame(monthDocuments(n, seed, year, month))
+    database.formatSummary(df)
+
+    return df
+#------------------------------------------------------------------------------
+
+def generateHistory(years=3, rows_per_month=300, categories=None, recurring_ratio=0.1, courtney_split=None, start_year=2020, seed=0):
+    """
+    Generate a realistic history of expenses, in the same format as they are
+    stored in the database. The recurring expenses are the same bills every
+    month, on the same day, with the odd change in price. The itemised ones
+    are spread over the days of the month, with a few refunds.
+
+    Parameters
+    ----------
+    years : Integer, optional
+        The number of years, starting in January. The default is 3.
+    rows_per_month : Integer, optional
+        The number of expenses each month. The default is 300.
+    categories : Dictionary or List of strings, optional
+        The weight of each category, or the categories to pick from evenly.
+        The default is None, every category in lookup.valid_categories with
+        a few taking most of the expenses, like real spending.
+    recurring_ratio : Float, optional
+        The fraction of each month's expenses which are recurring. The
+        default is 0.1.
+    courtney_split : Dictionary, optional
+        The probability of each fraction of an amount being Courtney's. The
+        default is None, {0 : 0.5, 0.5 : 0.35, 1 : 0.15}.
+    start_year : Integer, optional
+        The first year. The default is 2020.
+    seed : Integer, optional
+        The random seed. The default is 0.
+
+    Returns
+    -------
+    List of dictionaries
+
+    """
+    if categories is None:
+        categories = {category : 1 / (rank + 1) for rank, category in enumerate(lookup.valid_categories)}
+    elif not isinstance(categories, dict):
+        categories = {category : 1 for category in categories}
+    if courtney_split is None:
+        courtney_split = {0 : 0.5, 0.5 : 0.35, 1 : 0.15}
+
+    rng       = np.random.default_rng(seed)
+    names     = list(categories)
+    weights   = np.array(list(categories.values()), dtype=float) / sum(categories.values())
+    fractions = np.array(list(courtney_split), dtype=float)
+    chances   = np.array(list(courtney_split.values()), dtype=float) / sum(courtney_split.values())
+
+    months      = pd.period_range("{}-01".format(start_year), periods=12 * years, freq="M")
+    n_recurring = int(round(rows_per_month * recurring_ratio))
+    n_itemised  = rows_per_month - n_recurring
+
+    # The itemised expenses, every month at once
+    n       = n_itemised * len(months)
+    month_i = np.repeat(np.arange(len(months)), n_itemised)
+    days    = (rng.random(n) * months.days_in_month.to_numpy()[month_i]).astype(int)
+    amount  = np.round(rng.lognormal(3, 1, n), 2)
+    amount  = np.where(rng.random(n) < 0.05, -amount, amount)
+
+    itemised = pd.DataFrame({"Name"      : ["Shop {}".format(shop) for shop in rng.integers(1, 200, n)],
+                             "Date"      : months.start_time[month_i] + pd.to_timedelta(days, unit="D"),
+                             "Category"  : rng.choice(names, n, p=weights),
+                             "Amount"    : amount,
+                             "Courtney"  : np.round(amount * rng.choice(fractions, n, p=chances), 2),
+                             "Recurring" : False})
+
+    # The recurring bills, each changing price now and then
+    bill_day      = rng.integers(1, 29, n_recurring)
+    bill_category = rng.choice(names, n_recurring, p=weights)
+    bill_fraction = rng.choice(fractions, n_recurring, p=chances)
+    bill_amount   = np.round(rng.lognormal(4, 0.8, n_recurring), 2)
+
+    bills = []
+    for period in months:
+        bills.append(pd.DataFrame({"Name"      : ["Bill {}".format(i) for i in range(n_recurring)],
+                                   "Date"      : period.start_time + pd.to_timedelta(bill_day - 1, unit="D"),
+                                   "Category"  : bill_category,
+                                   "Amount"    : bill_amount,
+                                   "Courtney"  : np.round(bill_amount * bill_fraction, 2),
+                                   "Recurring" : True}))
+        changed     = rng.random(n_recurring) < 0.1
+        bill_amount = np.where(changed, np.round(bill_amount * rng.uniform(0.9, 1.1, n_recurring), 2), bill_amount)
+
+    df = pd.concat([itemised] + bills, ignore_index=True).sort_values("Date", kind="stable")
+
+    return [{key : (value.to_pydatetime() if key == "Date" else value) for key, value in doc.items()} for doc in df.to_dict("records")]
+#------------------------------------------------------------------------------
+
+def loadHistory(col, docs, chunk=10000):
+    """
+    Write a generated history to a collection the way the software does,
+    the itemised expenses with database.insertExpenses and each month's
+    recurring ones with database.insertRecurring, so the rollups and keys
+    are as they would be.
+
+    Parameters
+    ----------
+    col : PyMongo Collection
+        The expenses collection.
+    docs : List of dictionaries
+        The expenses, e.g. from generateHistory.
+    chunk : Integer, optional
+        The number of itemised expenses written at a time. The default is
+        10000.
+
+    Returns
+    -------
+    None.
+
+    """
+    itemised  = [doc for doc in docs if not doc["Recurring"]]
+    recurring = {}
+    for doc in docs:
+        if doc["Recurring"]:
+            recurring.setdefault((doc["Date"].year, doc["Date"].month), []).append(doc)
+
+    for i in range(0, len(itemised), chunk):
+        database.insertExpenses(col, itemised[i:i + chunk])
+    for month in sorted(recurring):
+        database.insertRecurring(col, recurring[month])
+#------------------------------------------------------------------------------
+
+def benchReport(sizes=(1000, 10000, 100000), seed=0):
+    """
+    Time building every view of a month summary, and check the time grows
+    with the rows and not with the rows times the number of views.
+
+    Parameters
+    ----------
+    sizes : Tuple of Integers, optional
+        The row counts to time.
+    seed : Integer, optional
+        The random seed for the generated rows. The default is 0.
+
+    Returns
+    -------
+    results : List of dictionaries
+        One entry per row count with the timings in seconds.
+
+    """
+    results = []
+
+    print("{:>10} | {:>8} | {:>12} | {:>14}".format("Rows", "Views", "Build (s)", "ns/row"))
+    for n in sizes:
+        df    = monthFrame(n, seed)
+        views = report.buildViews(df)
+        t     = timeit(lambda: report.buildViews(df))
+
+        results.append({"rows" : n, "views" : len(views), "build" : t})
+        print("{:>10} | {:>8} | {:>12.4f} | {:>14.1f}".format(n, len(views), t, 1e9 * t / n))
+
+    return results
+#------------------------------------------------------------------------------
+
+def benchMemory(sizes=(10000, 100000, 1000000), seed=0):
+    """
+    Compare the memory used by a month summary with its typed columns (see
+    database.typeColumns) against the documents loaded as they come from the
+    database.
+
+    Parameters
+    ----------
+    sizes : Tuple of Integers, optional
+        The row counts to measure.
+    seed : Integer, optional
+        The random seed for the generated rows. The default is 0.
+
+    Returns
+    -------
+    results : List of dictionaries
+        One entry per row count with the memory used in bytes.
+
+    """
+    results = []
+
+    print("{:>10} | {:>12} | {:>12} | {:>8}".format("Rows", "Plain (MB)", "Typed (MB)", "Ratio"))
+    for n in sizes:
+        plain = pd.DataFrame(monthDocuments(n, seed))
+        plain["Recurring"] = plain["Recurring"].astype(object)
+        typed = plain.copy()
+        database.typeColumns(typed)
+
+        columns = ["Date", "Category", "Amount", "Courtney", "Recurring"]
+        m_plain = plain[columns].memory_usage(deep=True, index=False).sum()
+        m_typed = typed[columns].memory_usage(deep=True, index=False).sum()
+
+        results.append({"rows" : n, "plain" : m_plain, "typed" : m_typed})
+        print("{:>10} | {:>12.2f} | {:>12.2f} | {:>8.2f}".format(n, m_plain / 1e6, m_typed / 1e6, m_plain / m_typed))
+
+    return results
+#------------------------------------------------------------------------------
+
+def benchRendering(rows=2000, months=12, workers=(1, 2, 4), seed=0):
+    """
+    Time writing the report files with different numbers of worker
+    processes, for one month (the views are shared out) and for a range of
+    months (the months are shared out).
+
+    Parameters
+    ----------
+    rows : Integer, optional
+        The number of rows in each month. The default is 2000.
+    months : Integer, optional
+        The number of months in the range. The default is 12.
+    workers : Tuple of Integers, optional
+        The worker counts to time.
+    seed : Integer, optional
+        The random seed for the generated rows. The default is 0.
+
+    Returns
+    -------
+    results : List of dictionaries
+        One entry per worker count with the timings in seconds and the files
+        written per second.
+
+    """
+    month = monthFrame(rows, seed)
+    year  = pd.concat([monthFrame(rows, seed + i, month=i + 1) for i in range(months)], ignore_index=True)
+    year["Period"] = year["Date"].dt.to_period("M")
+    summaries      = [(group.drop(columns="Period"), database.periodName(period)) for period, group in year.groupby("Period", sort=True)]
+
+    results = []
+
+    print("CPUs: {}".format(os.cpu_count()))
+    print("{:>8} | {:>10} | {:>12} | {:>10} | {:>12}".format("Workers", "Month (s)", "Files/s", "Range (s)", "Files/s"))
+    with tempfile.TemporaryDirectory() as root:
+        n_month = len(database.saveDF(month, os.path.join(root, "month")))
+        n_range = sum(len(database.saveDF(period_df, os.path.join(root, "range", name))) for period_df, name in summaries)
+
+        for n in workers:
+            t_month = timeit(lambda: database.saveDF(month, os.path.join(root, "month"), workers=n), repeat=1)
+            t_range = timeit(lambda: database.saveRange(year, summaries, os.path.join(root, "range"), workers=n), repeat=1)
+
+            results.append({"workers" : n, "month" : t_month, "range" : t_range})
+            print("{:>8} | {:>10.3f} | {:>12.1f} | {:>10.3f} | {:>12.1f}".format(n, t_month, n_month / t_month, t_range, n_range / t_range))
+
+    return results
+#------------------------------------------------------------------------------
+
+def benchExport(sizes=(10000, 100000, 500000), seed=0):
+    """
+    Time the streaming export and measure its peak memory, which should stay
+    flat as the number of documents grows.
+
+    Parameters
+    ----------
+    sizes : Tuple of Integers, optional
+        The number of documents to export.
+    seed : Integer, optional
+        The random seed for the generated documents. The default is 0.
+
+    Returns
+    -------
+    results : List of dictionaries
+        One entry per size with the time in seconds and the peak memory in
+        bytes.
+
+    """
+    def documents(n):
+        # Generated a chunk at a time, so they are never all in memory
+        for i in range(0, n, 10000):
+            yield from monthDocuments(min(10000, n - i), seed + i)
+    #--------------------------------------------------------------------------
+
+    results = []
+
+    print("{:>10} | {:>10} | {:>12} | {:>14}".format("Documents", "Time (s)", "Rows/s", "Peak memory (MB)"))
+    with tempfile.TemporaryDirectory() as root:
+        for n in sizes:
+            with open(os.path.join(root, "export.csv"), "w", encoding="utf-8", newline="") as csv_file, \
+                 open(os.path.join(root, "export.html"), "w", encoding="utf-8") as html_file:
+                tracemalloc.start()
+                start = time.perf_counter()
+                export.writeExport(documents(n), csv_file, html_file)
+                t     = time.perf_counter() - start
+                peak  = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+            results.append({"documents" : n, "time" : t, "peak" : peak})
+            print("{:>10} | {:>10.3f} | {:>12.0f} | {:>14.1f}".format(n, t, n / t, peak / 1e6))
+
+    return results
+#------------------------------------------------------------------------------
+
+def benchImport(sizes=(10000, 100000, 500000), seed=0):
+    """
+    Time importing a bank statement CSV, reading, categorising and building
+    the documents, without writing them to a database.
+
+    Parameters
+    ----------
+    sizes : Tuple of Integers, optional
+        The number of rows in the statement.
+    seed : Integer, optional
+        The random seed for the generated statement. The default is 0.
+
+    Returns
+    -------
+    results : List of dictionaries
+        One entry per size with the time in seconds and the rows per second.
+
+    """
+    rng     = np.random.default_rng(seed)
+    payees  = ["TESCO STORES 2231", "SHELL PETROL 44", "DELIVEROO.CO.UK", "COSTA COFFEE", "NETFLIX.COM", "VODAFONE LTD", "BRITISH GAS",
+               "PETS AT HOME", "IKEA LTD", "BOOTS 1123", "CARD PAYMENT TO J SMITH", "AMAZON MARKETPLACE", "SALARY"]
+    results = []
+
+    print("{:>10} | {:>10} | {:>12}".format("Rows", "Time (s)", "Rows/s"))
+    with tempfile.TemporaryDirectory() as root:
+        for n in sizes:
+            path = os.path.join(root, "statement.csv")
+            pd.DataFrame({"Date"        : pd.to_datetime("2022-01-01") + pd.to_timedelta(rng.integers(0, 365, n), unit="D"),
+                          "Description" : rng.choice(payees, n),
+                          "Amount"      : np.round(rng.uniform(-200, 50, n), 2)}).to_csv(path, index=False, date_format="%d/%m/%Y")
+
+            stats = importer.importStatement(path)
+
+            results.append({"rows" : n, "time" : stats["seconds"], "rows_per_sec" : stats["rows_per_sec"]})
+            print("{:>10} | {:>10.3f} | {:>12.0f}".format(n, stats["seconds"], stats["rows_per_sec"]))
+
+    return results
+#------------------------------------------------------------------------------
+
+def benchAggregation(sizes=(1000, 10000, 100000), address="localhost", port=27017, seed=0):
+    """
+    Compare a month report built from every document (the default) with one
+    where the totals are aggregated on the server, against a real MongoDB
+    server. The documents are written to a scratch database which is dropped
+    afterwards.
+
+    Parameters
+    ----------
+    sizes : Tuple of Integers, optional
+        The number of documents in the month.
+    address : String, optional
+        The address of the MongoDB server. The default is "localhost".
+    port : Integer, optional
+        The port the MongoDB server is running on. The default is 27017.
+    seed : Integer, optional
+        The random seed for the generated documents. The default is 0.
+
+    Returns
+    -------
+    results : List of dictionaries
+        One entry per size with the timings in seconds.
+
+    """
+    client = pymongo.MongoClient(address, port, serverSelectionTimeoutMS=2000)
+    try:
+        client.admin.command("ping")
+    except pymongo.errors.PyMongoError:
+        print("No MongoDB server at {}:{}, skipping".format(address, port))
+        client.close()
+        return []
+
+    col     = client.finances_benchmark.expenses
+    results = []
+
+    def run(aggregate):
+        df, _ = database.getMonthSummary(1, 2022, col, aggregate=aggregate)
+        report.buildViews(df, df.attrs.get("totals"))
+    #--------------------------------------------------------------------------
+
+    print("{:>10} | {:>12} | {:>14} | {:>8}".format("Documents", "Client (s)", "Aggregate (s)", "Speedup"))
+    try:
+        for n in sizes:
+            col.drop()
+            col.insert_many(monthDocuments(n, seed))
+
+            t_client = timeit(lambda: run(False))
+            t_server = timeit(lambda: run(True))
+
+            results.append({"documents" : n, "client" : t_client, "aggregate" : t_server})
+            print("{:>10} | {:>12.4f} | {:>14.4f} | {:>8.2f}".format(n, t_client, t_server, t_client / t_server))
+    finally:
+        client.drop_database("finances_benchmark")
+        client.close()
+
+    return results
+#------------------------------------------------------------------------------
+
+def benchBackends(sizes=(1000, 10000, 100000), address="localhost", port=27017, seed=0):
+    """
+    Run the same workload against each storage backend: writing a month of
+    expenses (with their rollups), the month report built from the
+    documents and from the aggregated totals, and a page of the history.
+    SQLite always runs, in a scratch file, MongoDB only if a server can be
+    reached, in a scratch database which is dropped afterwards.
+
+    Parameters
+    ----------
+    sizes : Tuple of Integers, optional
+        The number of documents in the month.
+    address : String, optional
+        The address of the MongoDB server. The default is "localhost".
+    port : Integer, optional
+        The port the MongoDB server is running on. The default is 27017.
+    seed : Integer, optional
+        The random seed for the generated documents. The default is 0.
+
+    Returns
+    -------
+    results : List of dictionaries
+        One entry per backend and size with the timings in seconds.
+
+    """
+    results = []
+
+    def run(col, aggregate):
+        df, _ = database.getMonthSummary(1, 2022, col, aggregate=aggregate)
+        report.buildViews(df, df.attrs.get("totals"))
+    #--------------------------------------------------------------------------
+
+    with tempfile.TemporaryDirectory() as root:
+        backends = [("SQLite", storage.SQLiteClient(os.path.join(root, "benchmark.db")))]
+
+        client = pymongo.MongoClient(address, port, serverSelectionTimeoutMS=2000)
+        try:
+            client.admin.command("ping")
+            backends.append(("MongoDB", client))
+        except pymongo.errors.PyMongoError:
+            print("No MongoDB server at {}:{}, only SQLite is run".format(address, port))
+            client.close()
+
+        print("{:<8} | {:>10} | {:>10} | {:>11} | {:>14} | {:>11}".format("Backend", "Documents", "Write (s)", "Client (s)", "Aggregate (s)", "History (s)"))
+        try:
+            for name, backend in backends:
+                for n in sizes:
+                    backend.drop_database("finances_benchmark")
+                    col  = backend.finances_benchmark.expenses
+                    docs = monthDocuments(n, seed)
+                    database.ensureIndexes(col)
+
+                    start   = time.perf_counter()
+                    database.insertExpenses(col, docs)
+                    t_write = time.perf_counter() - start
+
+                    t_client  = timeit(lambda: run(col, False))
+                    t_server  = timeit(lambda: run(col, True))
+                    t_history = timeit(lambda: database.historyPage(col))
+
+                    results.append({"backend" : name, "documents" : n, "write" : t_write, "client" : t_client, "aggregate" : t_server, "history" : t_history})
+                    print("{:<8} | {:>10} | {:>10.4f} | {:>11.4f} | {:>14.4f} | {:>11.4f}".format(name, n, t_write, t_client, t_server, t_history))
+        finally:
+            for _, backend in backends:
+                backend.drop_database("finances_benchmark")
+                backend.close()
+
+    return results
+#------------------------------------------------------------------------------
+
+def benchEndToEnd(years=3, rows_per_month=300, recurring_ratio=0.1, address="localhost", port=27017, seed=0, repeat=3):
+    """
+    Run the query and report paths end to end on a generated history (see
+    generateHistory): the month summary, with the totals worked out here and
+    on the server, saving its files, the range summary of the last year, the
+    history the expense window loads when it opens and the recurring lookup
+    of the recurring expense window. Each is timed and its peak memory
+    measured. It runs against a MongoDB server if one can be reached, in a
+    scratch database dropped afterwards, otherwise against SQLite in a
+    scratch file, see storage.
+
+    Parameters
+    ----------
+    years : Integer, optional
+        The number of years of history. The default is 3.
+    rows_per_month : Integer, optional
+        The number of expenses each month. The default is 300.
+    recurring_ratio : Float, optional
+        The fraction of the expenses which are recurring. The default is 0.1.
+    address : String, optional
+        The address of the MongoDB server. The default is "localhost".
+    port : Integer, optional
+        The port the MongoDB server is running on. The default is 27017.
+    seed : Integer, optional
+        The random seed for the generated history. The default is 0.
+    repeat : Integer, optional
+        How many times each stage is run for its time. The default is 3.
+
+    Returns
+    -------
+    results : List of dictionaries
+        One entry per stage with the backend, the number of documents, the
+        time in seconds and the peak memory in bytes (None for loading the
+        history, which is only run once).
+
+    """
+    docs  = generateHistory(years, rows_per_month, recurring_ratio=recurring_ratio, seed=seed)
+    last  = docs[-1]["Date"]
+    start = "{}-{:02d}".format(last.year - 1, last.month)
+    end   = "{}-{:02d}".format(last.year, last.month)
+
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        client = pymongo.MongoClient(address, port, serverSelectionTimeoutMS=2000)
+        try:
+            client.admin.command("ping")
+            backend = "MongoDB"
+        except pymongo.errors.PyMongoError:
+            client.close()
+            client  = storage.SQLiteClient(os.path.join(root, "benchmark.db"))
+            backend = "SQLite"
+
+        client.drop_database("finances_benchmark")
+        col = client.finances_benchmark.expenses
+        database.ensureIndexes(col)
+
+        def summary(aggregate):
+            return database.getMonthSummary(last.month, last.year, col, aggregate=aggregate)[0]
+
+        def historyPreload():
+            # As enterExpense does when it opens
+            dedup.DedupIndex(col).load()
+            database.historyPage(col)
+
+        def recurringLookup():
+            # As populate_expenses does for last month
+            query = {"Recurring" : True, "Date" : {"$gte" : datetime(last.year, last.month, 1), "$lte" : last}}
+            return list(col.find(query).sort("Date", 1))
+        #----------------------------------------------------------------------
+
+        print("Backend: {}, {} documents over {} years".format(backend, len(docs), years))
+        print("{:<24} | {:>10} | {:>16}".format("Stage", "Time (s)", "Peak memory (MB)"))
+        try:
+            begin = time.perf_counter()
+            loadHistory(col, docs)
+            stages = [("load", time.perf_counter() - begin, None)]
+
+            df = summary(False)
+            for name, function in [("month_summary",           lambda: summary(False)),
+                                   ("month_summary_aggregate", lambda: summary(True)),
+                                   ("save_df",                 lambda: database.saveDF(df, os.path.join(root, "month"))),
+                                   ("range_summary",           lambda: database.getRangeSummary(start, end, col)),
+                                   ("history_preload",         historyPreload),
+                                   ("recurring_lookup",        recurringLookup)]:
+                stages.append((name,) + profile(function, repeat))
+
+            for name, time_s, peak in stages:
+                results.append({"stage" : name, "backend" : backend, "documents" : len(docs), "time" : time_s, "peak" : peak})
+                print("{:<24} | {:>10.4f} | {:>16}".format(name, time_s, "" if peak is None else "{:.1f}".format(peak / 1e6)))
+        finally:
+            client.drop_database("finances_benchmark")
+            client.close()
+
+    return results
+#------------------------------------------------------------------------------
+
+def compareResults(baseline, results, tolerance=0.25):
+    """
+    Compare benchmark results against a baseline, flagging every time or
+    peak memory that has grown by more than the tolerance. Entries are
+    matched on their other fields which are not floats, e.g. the rows or
+    the stage.
+
+    Parameters
+    ----------
+    baseline : Dictionary
+        The results of each benchmark, as saved by --json, to compare to.
+    results : Dictionary
+        The results of each benchmark now.
+    tolerance : Float, optional
+        The fraction a measurement may grow by. The default is 0.25.
+
+    Returns
+    -------
+    regressions : List of strings
+        A description of each regression, empty if there are none.
+
+    """
+    def key(entry):
+        return tuple(sorted((field, value) for field, value in entry.items() if field not in ("time", "peak") and not isinstance(value, float)))
+    #--------------------------------------------------------------------------
+
+    regressions = []
+    for name, entries in results.items():
+        before = {key(entry) : entry for entry in baseline.get(name, [])}
+        for entry in entries:
+            old = before.get(key(entry))
+            if old is None:
+                continue
+            for field in ("time", "peak"):
+                if entry.get(field) is not None and old.get(field) and entry[field] > old[field] * (1 + tolerance):
+                    regressions.append("{} {}: {} {:.4g} -> {:.4g} (+{:.0%})".format(name, dict(key(entry)), field, old[field], entry[field], entry[field] / old[field] - 1))
+
+    return regressions
+#------------------------------------------------------------------------------
+
+def importTimes(statement, repeat=3):
+    """
+    Run an import statement in a fresh interpreter with -X importtime, and
+    read back how long each module took to import.
+
+    Parameters
+    ----------
+    statement : String
+        The statement to run, e.g. "import gui".
+    repeat : Integer, optional
+        How many interpreters to run, the fastest is kept. The default is 3.
+
+    Returns
+    -------
+    total : Float
+        The time spent importing in seconds.
+    modules : Dictionary
+        The cumulative time in seconds of each top level module imported,
+        i.e. those imported by the statement itself.
+
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    best = (float("inf"), {})
+
+    for _ in range(repeat):
+        result  = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], cwd=root, capture_output=True, text=True, check=True)
+        total   = 0
+        modules = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:"):
+                continue
+            fields = line[len("import time:"):].split("|")
+            if not fields[0].strip().isdigit():
+                continue
+
+            total += int(fields[0]) / 1e6
+            if not fields[2].startswith("  "):
+                modules[fields[2].strip()] = int(fields[1]) / 1e6
+
+        if total < best[0]:
+            best = (total, modules)
+
+    return best
+#------------------------------------------------------------------------------
+
+def benchStartup(repeat=5):
+    """
+    Time the imports needed before each part of the software can start, with
+    -X importtime, and compare them with importing every module up front as
+    PyFinance.py used to. Each is run in a fresh interpreter so nothing is
+    already loaded.
+
+    Parameters
+    ----------
+    repeat : Integer, optional
+        How many times to run each, the fastest is kept. The default is 5.
+
+    Returns
+    -------
+    results : List of dictionaries
+        One entry per start up with the total import time in seconds and
+        the slowest top level modules.
+
+    """
+    startups = [("Main window (PyFinance.py)", "import gui"),
+                ("Eager (every module)",       "import gui, database, dedup, journal, money, report"),
+                ("Expense entry window",       "import gui; gui.database.openCollection; gui.journal.openJournal; gui.dedup.openIndex; gui.money.Money"),
+                ("Month query window",         "import gui; gui.database.pd.DataFrame; gui.database.report.buildViews"),
+                ("Command line (cli.py)",      "import cli")]
+    results  = []
+
+    print("{:<28} | {:>10} | {}".format("Start up", "Time (s)", "Slowest imports"))
+    for name, statement in startups:
+        total, modules = importTimes(statement, repeat)
+        slowest        = sorted(modules.items(), key=lambda item: item[1], reverse=True)[:3]
+
+        results.append({"startup" : name, "time" : total, "slowest" : slowest})
+        print("{:<28} | {:>10.3f} | {}".format(name, total, ", ".join("{} {:.3f}".format(*module) for module in slowest)))
+
+    return results
+#------------------------------------------------------------------------------
+
+benchmarks = {"formatting"  : benchFormatting,
+              "pence"       : benchPence,
+              "report"      : benchReport,
+              "memory"      : benchMemory,
+              "rendering"   : benchRendering,
+              "export"      : benchExport,
+              "import"      : benchImport,
+              "aggregation" : benchAggregation,
+              "backends"    : benchBackends,
+              "endtoend"    : benchEndToEnd,
+              "startup"     : benchStartup}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PyFinance benchmarks")
+    parser.add_argument("benchmark",   nargs="*", help="The benchmarks to run ({}), all if none are given".format(", ".join(benchmarks)))
+    parser.add_argument("--json",      default=None, help="Save the results to this JSON file")
+    parser.add_argument("--baseline",  default=None, help="Compare the results to those saved in this JSON file, exiting with 1 if any have regressed")
+    parser.add_argument("--tolerance", default=0.25, type=float, help="The fraction a time or peak memory may grow by before it has regressed")
+    args   = parser.parse_args()
+
+    for name in args.benchmark:
+        if name not in benchmarks:
+            parser.error("Unknown benchmark `{}`".format(name))
+
+    results = {}
+    for name in args.benchmark or benchmarks.keys():
+        print("\n{}\n{}".format(name, "-" * len(name)))
+        results[name] = benchmarks[name]()
+
+    if args.json is not None:
+        # numpy numbers are saved as the Python ones
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"python"   : sys.version,
+                       "platform" : platform.platform(),
+                       "cpus"     : os.cpu_count(),
+                       "date"     : datetime.now().isoformat(timespec="seconds"),
+                       "results"  : results}, f, indent=2, default=lambda value: value.item())
+
+    if args.baseline is not None:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compareResults(json.load(f)["results"], results, args.tolerance)
+
+        print("\n{} regressions against {}".format(len(regressions), args.baseline))
+        for regression in regressions:
+            print("  " + regression)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+    sys.exit(0)
@@ -0,0 +1,205 @@
+"""
+A local cache of the month summaries fetched from the database. Each query
+range is kept in its own file, alongside a fingerprint of the documents it
+was built from, so a repeat query for a month that has not changed is loaded
+straight from disk instead of being fetched and built again.
+"""
+
+import os
+import pickle
+import hashlib
+
+#------------------------------------------------------------------------------
+# Global Variables
+#------------------------------------------------------------------------------
+cache_dir = os.path.join(os.path.expanduser("~"), ".pyfinance", "cache")
+
+# Bumped whenever the layout of the cached DataFrames changes, so files
+# written by an older version are never used
+layout    = 2
+
+# One cache per (address, port), shared by the whole process
+_caches = {}
+#------------------------------------------------------------------------------
+
+def fingerprint(col, query):
+    """
+    A cheap fingerprint of the documents a query matches, their count and
+    the largest _id, worked out on the server in one round trip. Adding or
+    removing a document changes it, editing one in place does not, see
+    FrameCache.clear.
+
+    Parameters
+    ----------
+    col : PyMongo Collection
+        The collection we are querying.
+    query : Dictionary
+        The query filter.
+
+    Returns
+    -------
+    Tuple
+        (count, largest _id), (0, None) if nothing matches.
+
+    """
+    pipeline = [{"$match" : query},
+                {"$group" : {"_id" : None, "count" : {"$sum" : 1}, "last" : {"$max" : "$_id"}}}]
+
+    for group in col.aggregate(pipeline):
+        return group["count"], group["last"]
+
+    return 0, None
+#------------------------------------------------------------------------------
+
+class FrameCache():
+    """
+    The summaries fetched from one database server, one file per query range.
+    Each file holds the fingerprint and the DataFrame, already sorted and
+    formatted, so a hit skips the DataFrame construction as well as the
+    network. Pickle is used so the ObjectIds, dtypes and df.attrs (the
+    server totals) come back exactly as they were.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits      = 0
+        self.misses    = 0
+
+    def path(self, name):
+        """
+        The file a query range is kept in.
+        """
+        return os.path.join(self.directory, "{}.pkl".format(name))
+
+    def load(self, name, key):
+        """
+        Load a cached DataFrame, if its fingerprint still matches.
+
+        Parameters
+        ----------
+        name : String
+            The name of the query range.
+        key : Tuple
+            The current fingerprint, see fingerprint.
+
+        Returns
+        -------
+        Pandas DataFrame or None
+            None if it is not cached or has changed since.
+
+        """
+        try:
+            with open(self.path(name), "rb") as f:
+                cached_key, df = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+        if cached_key != (layout, key):
+            return None
+
+        return df
+
+    def store(self, name, key, df):
+        """
+        Save a DataFrame and the fingerprint it was built from, replacing
+        anything already cached for the range.
+
+        Parameters
+        ----------
+        name : String
+            The name of the query range.
+        key : Tuple
+            The fingerprint of the documents df was built from.
+        df : Pandas DataFrame
+            The summary.
+
+        Returns
+        -------
+        None.
+
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # Write to a temporary file first, so a half written file is never
+        # picked up
+        path      = self.path(name)
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as f:
+            pickle.dump(((layout, key), df), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+
+    def fetch(self, col, query, name, build):
+        """
+        Return the summary for a query range, from the cache if the documents
+        have not changed, otherwise built with build and cached.
+
+        Parameters
+        ----------
+        col : PyMongo Collection
+            The collection we are querying.
+        query : Dictionary
+            The query filter, used for the fingerprint.
+        name : String
+            The name of the query range, e.g. "2022-01-01_2022-01-31".
+        build : Callable
+            Called with no arguments to fetch and build the summary on a miss.
+
+        Returns
+        -------
+        Pandas DataFrame
+
+        """
+        key = fingerprint(col, query)
+        df  = self.load(name, key)
+
+        if df is not None:
+            self.hits += 1
+            return df.copy()
+
+        self.misses += 1
+        df = build()
+        self.store(name, key, df)
+
+        return df
+
+    def clear(self):
+        """
+        Remove everything cached for this server. Needed after documents are
+        edited in place (e.g. resubmitting a month's recurring expenses), as
+        that does not change the fingerprint.
+
+        Returns
+        -------
+        None.
+
+        """
+        if not os.path.isdir(self.directory):
+            return
+
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith(".pkl"):
+                os.remove(os.path.join(self.directory, file_name))
+#------------------------------------------------------------------------------
+
+def openCache(address, port):
+    """
+    Return the cache for a database server, creating it the first time.
+
+    Parameters
+    ----------
+    address : String
+        The address of the MongoDB server.
+    port : Integer
+        The port the MongoDB server is running on.
+
+    Returns
+    -------
+    FrameCache
+
+    """
+    key = (address, port)
+    if key not in _caches:
+        server = hashlib.sha1("{}:{}".format(address, port).encode("utf-8")).hexdigest()[:12]
+        _caches[key] = FrameCache(os.path.join(cache_dir, server))
+
+    return _caches[key]
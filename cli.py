@@ -0,0 +1,327 @@
+"""
+The command line interface for PyFinance, for running the reports, imports
+and exports without a display (e.g. from cron). Run it with
+
+    python -m pyfinance report --month 2022-01 2022-02 --range 2021-01 2021-12
+    python -m pyfinance import statement.csv
+    python -m pyfinance export --start 2020-01-01 --end 2022-12-31
+    python -m pyfinance repair
+
+Nothing here imports tkinter. Each month, range or statement is processed on
+its own, so one failing does not stop the rest, and the exit code says how
+the run went, see the exit codes below.
+"""
+
+import os
+import sys
+import argparse
+import traceback
+
+import pandas as pd
+
+import cache
+import dedup
+import export
+import database
+import importer
+import metrics
+
+#------------------------------------------------------------------------------
+# Global Variables
+#------------------------------------------------------------------------------
+# The exit codes, 2 is also what argparse exits with for bad arguments
+exit_ok          = 0
+exit_failed      = 1
+exit_usage       = 2
+exit_unreachable = 3
+#------------------------------------------------------------------------------
+
+def parseMonth(text):
+    """
+    Parse a month given on the command line.
+
+    Parameters
+    ----------
+    text : String
+        The month, e.g. "2022-01".
+
+    Returns
+    -------
+    Pandas Period
+        The month.
+
+    """
+    try:
+        return pd.Period(text, freq="M")
+    except ValueError:
+        raise argparse.ArgumentTypeError("`{}` is not a month, use YYYY-MM".format(text))
+#------------------------------------------------------------------------------
+
+def _error(name, error, verbose=False):
+    """
+    Report a failure on stderr, with the traceback if verbose.
+    """
+    print("{}: failed, {}".format(name, error), file=sys.stderr)
+    if verbose:
+        traceback.print_exc()
+#------------------------------------------------------------------------------
+
+def _connect(args):
+    """
+    Open the expenses collection, or None if the server cannot be reached.
+    """
+    if not database.checkClient(args.address, args.port):
+        print("The database at {}:{} cannot be reached".format(args.address, args.port), file=sys.stderr)
+        return None
+
+    return database.openCollection(args.address, args.port)
+#------------------------------------------------------------------------------
+
+def runReport(args):
+    """
+    Save the reports for each month, with getMonthSummary and saveDF, for
+    each range, with getRangeSummary and saveRange, and the rollup for each
+    trend, from the monthly rollups with getRollupRows and saveRollup.
+
+    Parameters
+    ----------
+    args : argparse Namespace
+        The parsed arguments of the report command.
+
+    Returns
+    -------
+    Integer
+        The exit code.
+
+    """
+    if not args.month and not args.range and not args.trend:
+        print("Nothing to report, give at least one --month, --range or --trend", file=sys.stderr)
+        return exit_usage
+
+    expenses = _connect(args)
+    if expenses is None:
+        return exit_unreachable
+
+    summaries_cache = cache.openCache(args.address, args.port) if args.cache else None
+    code            = exit_ok
+
+    for period in args.month or []:
+        name = "{:%Y-%m}".format(period.start_time)
+        try:
+            df, str_ym = database.getMonthSummary(period.month, period.year, expenses, aggregate=args.aggregate, cache=summaries_cache)
+            if len(df) == 0:
+                print("{}: no enteries, nothing saved".format(name))
+                continue
+
+            written = database.saveDF(df, os.path.join(args.root, str_ym), args.incremental, args.workers)
+            print("{}: {} enteries, {} files written".format(name, len(df), len(written)))
+        except Exception as error:
+            _error(name, error, args.verbose)
+            code = exit_failed
+
+    for start, end in args.range or []:
+        name = "{:%Y-%m}_{:%Y-%m}".format(start.start_time, end.start_time)
+        try:
+            df, summaries = database.getRangeSummary(start.start_time, end.start_time, expenses, cache=summaries_cache)
+            database.saveRange(df, summaries, os.path.join(args.root, name), incremental=args.incremental, workers=args.workers)
+            print("{}: {} enteries over {} months".format(name, len(df), len(summaries)))
+        except Exception as error:
+            _error(name, error, args.verbose)
+            code = exit_failed
+
+    for start, end in args.trend or []:
+        name = "trend_{:%Y-%m}_{:%Y-%m}".format(start.start_time, end.start_time)
+        try:
+            rows = database.getRollupRows(start, end, expenses)
+            if len(rows) == 0:
+                print("{}: no enteries, nothing saved".format(name))
+                continue
+
+            database.saveRollup(rows, os.path.join(args.root, name))
+            print("{}: {} enteries from {} rollups".format(name, rows["Count"].sum(), len(rows)))
+        except Exception as error:
+            _error(name, error, args.verbose)
+            code = exit_failed
+
+    if args.metrics is not None:
+        metrics.saveMetrics(args.metrics)
+        print("Metrics saved to {}".format(os.path.abspath(args.metrics)))
+
+    return code
+#------------------------------------------------------------------------------
+
+def runImport(args):
+    """
+    Import each bank statement with importer.importStatement.
+
+    Parameters
+    ----------
+    args : argparse Namespace
+        The parsed arguments of the import command.
+
+    Returns
+    -------
+    Integer
+        The exit code.
+
+    """
+    expenses = None
+    if not args.dry_run:
+        expenses = _connect(args)
+        if expenses is None:
+            return exit_unreachable
+
+    code = exit_ok
+    try:
+        rules = None if args.rules is None else importer.loadRules(args.rules)
+    except Exception as error:
+        _error(args.rules, error, args.verbose)
+        return exit_failed
+
+    for statement in args.statement:
+        try:
+            stats = importer.importStatement(statement, expenses, rules, args.fraction, duplicates=args.duplicates)
+            print("{}: {} rows, {} inserted, {} duplicates in {:.2f}s".format(statement, stats["rows"], stats["inserted"], stats["duplicates"], stats["seconds"]))
+        except Exception as error:
+            _error(statement, error, args.verbose)
+            code = exit_failed
+
+    return code
+#------------------------------------------------------------------------------
+
+def runExport(args):
+    """
+    Stream every entery between two dates to export.csv and export.html with
+    export.exportRange.
+
+    Parameters
+    ----------
+    args : argparse Namespace
+        The parsed arguments of the export command.
+
+    Returns
+    -------
+    Integer
+        The exit code.
+
+    """
+    expenses = _connect(args)
+    if expenses is None:
+        return exit_unreachable
+
+    try:
+        totals = export.exportRange(args.start, args.end, expenses, args.root, args.size)
+    except Exception as error:
+        _error("export", error, args.verbose)
+        return exit_failed
+
+    print("{} enteries exported to {}".format(totals["rows"], os.path.abspath(args.root)))
+
+    return exit_ok
+#------------------------------------------------------------------------------
+
+def runRepair(args):
+    """
+    Rebuild the monthly rollups from the expenses, with
+    database.rebuildRollups.
+
+    Parameters
+    ----------
+    args : argparse Namespace
+        The parsed arguments of the repair command.
+
+    Returns
+    -------
+    Integer
+        The exit code.
+
+    """
+    expenses = _connect(args)
+    if expenses is None:
+        return exit_unreachable
+
+    try:
+        count = database.rebuildRollups(expenses)
+    except Exception as error:
+        _error("repair", error, args.verbose)
+        return exit_failed
+
+    print("{} monthly rollups rebuilt".format(count))
+
+    return exit_ok
+#------------------------------------------------------------------------------
+
+def buildParser():
+    """
+    The argument parser, with a sub command each for report, import and
+    export.
+
+    Returns
+    -------
+    argparse ArgumentParser
+
+    """
+    server = argparse.ArgumentParser(add_help=False)
+    server.add_argument("--address", default="localhost", help="The address of the MongoDB server, or sqlite:<path> for a SQLite file")
+    server.add_argument("--port",    default=27017, type=int, help="The port the MongoDB server is running on")
+    server.add_argument("--verbose", action="store_true", help="Print the traceback of any failure")
+
+    parser   = argparse.ArgumentParser(prog="pyfinance", description="PyFinance without the gui",
+                                       epilog="Exits with {} on success, {} if anything failed, {} for bad arguments and {} if the server cannot be reached".format(exit_ok, exit_failed, exit_usage, exit_unreachable))
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    report = commands.add_parser("report", parents=[server], help="Save the month reports")
+    report.add_argument("--month",       nargs="+", action="extend", type=parseMonth, metavar="YYYY-MM", help="The months to report on, each saved on its own")
+    report.add_argument("--range",       nargs=2, action="append", type=parseMonth, metavar=("START", "END"), help="A range of months fetched in one query and saved month by month, with the rollup")
+    report.add_argument("--trend",       nargs=2, action="append", type=parseMonth, metavar=("START", "END"), help="A range of months rolled up from the monthly rollups, without reading the expenses")
+    report.add_argument("--root",        default=".", help="The directory the reports are saved in")
+    report.add_argument("--workers",     default=1, type=int, help="The number of processes the files are written with")
+    report.add_argument("--incremental", action="store_true", help="Only rewrite the files whose contents have changed")
+    report.add_argument("--aggregate",   action="store_true", help="Work out the month totals on the server")
+    report.add_argument("--cache",       action="store_true", help="Use the local cache of the month summaries")
+    report.add_argument("--metrics",     default=None, help="Save the time of each stage and the rows and bytes handled to this file, as Prometheus text if it ends in .prom or .txt and JSON otherwise")
+    report.set_defaults(run=runReport)
+
+    statement = commands.add_parser("import", parents=[server], help="Import bank statements")
+    statement.add_argument("statement",    nargs="+", help="The CSV or OFX files to import")
+    statement.add_argument("--rules",      default=None, help="A CSV file of pattern,category rules, the built in rules are used if not given")
+    statement.add_argument("--fraction",   default=0.0, type=float, help="The fraction of each amount that is Courtney's")
+    statement.add_argument("--dry-run",    action="store_true", help="Categorise the statements without writing them to the database")
+    statement.add_argument("--duplicates", default="reject", choices=dedup.modes, help="Leave out transactions already in the database, or write them flagged as duplicates")
+    statement.set_defaults(run=runImport)
+
+    dump = commands.add_parser("export", parents=[server], help="Stream a date range to export.csv and export.html")
+    dump.add_argument("--start", required=True, help="The first day of the range, e.g. 2020-01-01")
+    dump.add_argument("--end",   required=True, help="The last day of the range, it is inclusive")
+    dump.add_argument("--root",  default=".", help="The directory the files are saved in")
+    dump.add_argument("--size",  default=None, type=int, help="The number of documents fetched and written at a time")
+    dump.set_defaults(run=runExport)
+
+    repair = commands.add_parser("repair", parents=[server], help="Rebuild the monthly rollups from the expenses")
+    repair.set_defaults(run=runRepair)
+
+    return parser
+#------------------------------------------------------------------------------
+
+def main(argv=None):
+    """
+    Run the command line interface.
+
+    Parameters
+    ----------
+    argv : List of strings, optional
+        The arguments, sys.argv[1:] if None.
+
+    Returns
+    -------
+    Integer
+        The exit code.
+
+    """
+    args = buildParser().parse_args(argv)
+
+    return args.run(args)
+#------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,12 +3,146 @@ All the database logic and minipulation happens in this module.
 """
 
 import os
+import json
+import atexit
+import sqlite3
 import pymongo
+import pymongo.errors
 import calendar
-import pandas   as pd
 from   datetime import datetime
 
+import lazy
+import pools
 import lookup
+import metrics
+import storage
+
+# pandas, and the modules built on it, are only loaded when the first summary
+# is made, so opening the collection to enter expenses does not wait on them
+pd     = lazy.LazyModule("pandas")
+money  = lazy.LazyModule("money")
+report = lazy.LazyModule("report")
+
+#------------------------------------------------------------------------------
+# Global Variables
+#------------------------------------------------------------------------------
+# The fields the reports use
+report_fields = {"Name" : 1, "Date" : 1, "Category" : 1, "Amount" : 1, "Courtney" : 1, "Recurring" : 1}
+
+# The indexes the queries rely on. The month and range queries use "date", the
+# recurring/itemised lookups in the gui use "recurring_date". Undo sorts on
+# _id descending, which the default _id index already serves by walking it
+# backwards, so it needs no index of its own. "key" makes the idempotency keys
+# given to recurring expenses unique, documents without a key are left out.
+# "hash" does the same for the duplicate hashes of itemised expenses, see
+# dedup.
+indexes = [pymongo.IndexModel([("Recurring", pymongo.ASCENDING), ("Date", pymongo.ASCENDING)], name="recurring_date"),
+           pymongo.IndexModel([("Date",      pymongo.ASCENDING)],                                 name="date"),
+           pymongo.IndexModel([("Key",       pymongo.ASCENDING)],                                 name="key",  unique=True, partialFilterExpression={"Key"  : {"$exists" : True}}),
+           pymongo.IndexModel([("Hash",      pymongo.ASCENDING)],                                 name="hash", unique=True, partialFilterExpression={"Hash" : {"$exists" : True}})]
+
+# The servers we have already made sure have the indexes, this session
+_indexed = set()
+
+# The settings every MongoClient is created with. The pool is shared by all
+# the windows open on a server, and the timeouts stop an unreachable server
+# hanging the software for the driver's default of 30 seconds.
+client_settings = {"maxPoolSize"              : 10,
+                   "minPoolSize"              : 0,
+                   "maxIdleTimeMS"            : 300000,
+                   "connectTimeoutMS"         : 5000,
+                   "serverSelectionTimeoutMS" : 5000}
+
+# One client per (address, port), shared by the whole process
+_clients = {}
+
+# Written to each output directory by saveDF, the hash of every file in it
+manifest_name = "manifest.json"
+
+# The monthly totals kept alongside the expenses, one document per month,
+# category and recurring/itemised, updated by every write (see updateRollups)
+# so a trend over years reads a few hundred documents instead of every expense
+rollup_collection = "monthly_rollups"
+rollup_indexes    = [pymongo.IndexModel([("Date", pymongo.ASCENDING), ("Category", pymongo.ASCENDING), ("Recurring", pymongo.ASCENDING)], name="month_category", unique=True)]
+
+# New expenses are written with this field set until they are in the rollups,
+# so a write retried after its reply was lost knows whether to add them
+unrolled_field    = "Unrolled"
+#------------------------------------------------------------------------------
+
+#------------------------------------------------------------------------------
+def getClient(address, port):
+    """
+    Return the MongoClient for a server, creating it the first time. Each
+    client holds a pool of connections, so sharing one client means windows
+    reuse the connections rather than opening their own.
+    
+    An address "sqlite:<path>" opens the SQLite file at path instead, with
+    no server needed, see storage.
+
+    Parameters
+    ----------
+    address : String
+        The address of the MongoDB server, or "sqlite:<path>".
+    port : Integer
+        The port the MongoDB server is running on, unused for SQLite.
+
+    Returns
+    -------
+    pymongo MongoClient or storage.SQLiteClient
+
+    """
+    key = (address, port)
+    if key not in _clients:
+        if storage.isSQLite(address):
+            _clients[key] = storage.SQLiteClient(storage.sqlitePath(address))
+        else:
+            _clients[key] = pymongo.MongoClient(address, port, event_listeners=[metrics.command_listener], **client_settings)
+    
+    return _clients[key]
+
+#------------------------------------------------------------------------------
+def checkClient(address, port):
+    """
+    Check the server can be reached, by sending it a ping.
+
+    Parameters
+    ----------
+    address : String
+        The address of the MongoDB server.
+    port : Integer
+        The port the MongoDB server is running on.
+
+    Returns
+    -------
+    Boolean
+        True if the server replied.
+
+    """
+    try:
+        getClient(address, port).admin.command("ping")
+    except (pymongo.errors.PyMongoError, sqlite3.Error, OSError):
+        return False
+    
+    return True
+
+#------------------------------------------------------------------------------
+def closeClients():
+    """
+    Close every shared client and the connections in its pool.
+
+    Returns
+    -------
+    None.
+
+    """
+    while _clients:
+        _, client = _clients.popitem()
+        client.close()
+    
+    _indexed.clear()
+
+atexit.register(closeClients)
 
 #------------------------------------------------------------------------------
 def openCollection(address, port):
@@ -29,13 +163,589 @@ def openCollection(address, port):
         This is the expenses Collection where the data is stored.
 
     """
-    myclient = pymongo.MongoClient(address, port)
+    myclient = getClient(address, port)
     expenses = myclient.finances.expenses
     
+    # Only check the indexes the first time each server is opened
+    if (address, port) not in _indexed:
+        ensureIndexes(expenses)
+        _indexed.add((address, port))
+    
     return expenses
 
 #------------------------------------------------------------------------------
-def getMonthSummary(month, year, col, path="."):
+def ensureIndexes(col):
+    """
+    Create the indexes the queries rely on, if they do not already exist.
+    Creating an index that already exists does nothing, so this is safe to
+    call every time.
+
+    Parameters
+    ----------
+    col : PyMongo Collection
+        The expenses collection.
+
+    Returns
+    -------
+    List of Strings
+        The names of the indexes.
+
+    """
+    col.database[rollup_collection].create_indexes(rollup_indexes)
+    
+    return col.create_indexes(indexes)
+
+#------------------------------------------------------------------------------
+def _planStages(plan):
+    """
+    Walk an explain plan and return the stages it uses, outermost first.
+    """
+    stages = []
+    while plan:
+        if "queryPlan" in plan:
+            # Plans run by the slot based engine wrap the classic plan
+            plan = plan["queryPlan"]
+        stages.append(plan.get("stage", "?"))
+        if "inputStage" in plan:
+            plan = plan["inputStage"]
+        elif "inputStages" in plan:
+            for sub_plan in plan["inputStages"]:
+                stages.extend(_planStages(sub_plan))
+            break
+        else:
+            break
+    
+    return stages
+
+#------------------------------------------------------------------------------
+def explainQueries(col, year=None, month=None):
+    """
+    Run explain on each query the software makes, and report which stages the
+    winning plans use, flagging any that scan the whole collection.
+
+    Parameters
+    ----------
+    col : PyMongo Collection
+        The expenses collection.
+    year : Integer, optional
+        The year used for the date queries. The default is this year.
+    month : Integer, optional
+        The month used for the date queries. The default is this month.
+
+    Returns
+    -------
+    results : List of dictionaries
+        One entry per query, with its "name", the "stages" of the winning
+        plan and "collscan", True if the plan scans the collection.
+
+    """
+    now      = datetime.now()
+    year     = now.year  if year  is None else year
+    month    = now.month if month is None else month
+    min_date = datetime(year, month, 1)
+    max_date = datetime(year, month, calendar.monthrange(year, month)[1])
+    month_q  = {"$lte" : max_date, "$gte" : min_date}
+    
+    # The queries as they are made in this module and in gui
+    queries = [("Month summary (getMonthSummary)",       col.find({"Date" : month_q})),
+               ("Previous values (historyPage)",          col.find({"Recurring" : False, "Date" : {"$lt" : max_date}}).sort("Date", -1).limit(10)),
+               ("Previous dates (historyPage)",           col.find({"Date" : {"$in" : [min_date, max_date]}, "Recurring" : False}).sort("Date", 1)),
+               ("Last recurring (gui.populate_expenses)", col.find({"Recurring" : True, "Date" : month_q}).sort("Date", 1)),
+               ("Undo (gui.remove_last_expense)",        col.find().sort("_id", -1).limit(1)),
+               ("Trend (getRollupRows)",                 col.database[rollup_collection].find({"Date" : {"$gte" : min_date, "$lt" : max_date}, "Count" : {"$gt" : 0}}).sort("Date", 1))]
+    
+    results = []
+    for name, cursor in queries:
+        stages = _planStages(cursor.explain()["queryPlanner"]["winningPlan"])
+        results.append({"name" : name, "stages" : stages, "collscan" : "COLLSCAN" in stages})
+    
+    # The aggregation pipeline's $match is explained through the command
+    pipeline = [{"$match" : {"Date" : month_q}}, {"$group" : {"_id" : None}}]
+    explain  = col.database.command("aggregate", col.name, pipeline=pipeline, explain=True)
+    if "stages" in explain:
+        plan = explain["stages"][0]["$cursor"]["queryPlanner"]["winningPlan"]
+    else:
+        plan = explain["queryPlanner"]["winningPlan"]
+    stages = _planStages(plan)
+    results.append({"name" : "Month totals (aggregateTotals)", "stages" : stages, "collscan" : "COLLSCAN" in stages})
+    
+    return results
+
+#------------------------------------------------------------------------------
+def historyPage(col, before=None, size=10):
+    """
+    A page of the itemised expenses entered on the last few dates before a
+    date, for paging back through the history. Every expense on a date is
+    on the same page, so the date alone says where the next page starts.
+
+    Parameters
+    ----------
+    col : PyMongo Collection
+        The expenses collection.
+    before : datetime, optional
+        Only expenses before this date are included. The default is None,
+        the latest page.
+    size : Integer, optional
+        The page covers the dates of the last size expenses, so it holds at
+        least size expenses unless the history runs out. The default is 10.
+
+    Returns
+    -------
+    List of dictionaries
+        The expenses, oldest first, empty once there are none left.
+
+    """
+    query = {"Recurring" : False}
+    if before is not None:
+        query["Date"] = {"$lt" : before}
+    
+    # Both are served by the recurring_date index, the first only reads as
+    # many keys as it needs to find the dates
+    last_docs  = col.find(query, {"Date" : 1}).sort("Date", -1).limit(size)
+    page_dates = list(set(doc["Date"] for doc in last_docs))
+    if len(page_dates) == 0:
+        return []
+    
+    return list(col.find({"Date" : {"$in" : page_dates}, "Recurring" : False}).sort([("Date", 1), ("_id", 1)]))
+
+#------------------------------------------------------------------------------
+def recurringKey(doc, occurrence=1):
+    """
+    The idempotency key for a recurring expense, made from its month, name
+    and category, so the same bill in the same month always has the same key.
+
+    Parameters
+    ----------
+    doc : Dictionary
+        The document for the recurring expense.
+    occurrence : Integer, optional
+        Counts documents with the same name and category in the same month,
+        so they each get their own key. The default is 1.
+
+    Returns
+    -------
+    String
+        The key.
+
+    """
+    key = "recurring:{}:{}:{}".format(doc["Date"].strftime("%Y-%m"), doc["Category"], " ".join(doc["Name"].lower().split()))
+    if occurrence > 1:
+        key += ":{}".format(occurrence)
+    
+    return key
+
+#------------------------------------------------------------------------------
+def insertRecurring(col, docs):
+    """
+    Insert a month's recurring expenses in a single ordered bulk write, one
+    round trip and one acknowledgement for the lot.
+
+    Each document is upserted on its idempotency key (see recurringKey)
+    rather than inserted, so submitting the same month again updates the
+    expenses already there instead of duplicating them. If the write fails
+    part way, submitting again completes it.
+
+    Parameters
+    ----------
+    col : PyMongo Collection
+        The expenses collection.
+    docs : List of dictionaries
+        The recurring expenses, all for the same month.
+
+    Returns
+    -------
+    pymongo BulkWriteResult
+        upserted_count is the number of new expenses and modified_count the
+        number that were already there and have changed.
+
+    """
+    requests = []
+    written  = []
+    seen     = {}
+    for doc in docs:
+        doc = dict(doc)
+        
+        # Count repeats of the same name and category in this month
+        base = recurringKey(doc)
+        seen[base] = seen.get(base, 0) + 1
+        
+        doc["Key"] = recurringKey(doc, seen[base])
+        requests.append(pymongo.UpdateOne({"Key" : doc["Key"]}, {"$set" : doc, "$setOnInsert" : {unrolled_field : True}}, upsert=True))
+        written.append(dict(doc, **{unrolled_field : True}))
+    
+    # Checked before writing, so an amount the rollups cannot take (e.g.
+    # NaN) is not written either
+    _rollupDeltas(written, 1, {})
+    
+    # The versions being replaced come out of the rollups
+    keys     = [doc["Key"] for doc in written]
+    previous = list(col.find({"Key" : {"$in" : keys}}, dict(report_fields, Key=1, **{unrolled_field : 1})))
+    
+    try:
+        result = col.bulk_write(requests, ordered=True)
+    except pymongo.errors.BulkWriteError as error:
+        # Ordered, so everything before the first error was written
+        done = set(keys[:error.details["writeErrors"][0]["index"]])
+        updateRollups(col, [doc for doc in written if doc["Key"] in done], [doc for doc in previous if doc["Key"] in done])
+        raise
+    
+    updateRollups(col, written, previous)
+    
+    return result
+
+#------------------------------------------------------------------------------
+def insertExpenses(col, docs):
+    """
+    Insert expenses in a single unordered bulk insert, one round trip for
+    the lot. Each is written with unrolled_field set, which updateRollups
+    clears once it is in the rollups. The documents given are left without
+    it, but are given their _ids.
+
+    Parameters
+    ----------
+    col : PyMongo Collection
+        The expenses collection.
+    docs : List of dictionaries
+        The expenses.
+
+    Returns
+    -------
+    Integer
+        The number inserted.
+
+    """
+    if len(docs) == 0:
+        return 0
+    
+    pending = [dict(doc, **{unrolled_field : True}) for doc in docs]
+    
+    # Checked before writing, as in insertRecurring
+    _rollupDeltas(pending, 1, {})
+    
+    try:
+        inserted = len(col.insert_many(pending, ordered=False).inserted_ids)
+    except pymongo.errors.BulkWriteError as error:
+        # Unordered, so everything without an error was written
+        failed = set(write_error["index"] for write_error in error.details["writeErrors"])
+        updateRollups(col, [doc for i, doc in enumerate(pending) if i not in failed])
+        raise
+    finally:
+        for doc, written in zip(docs, pending):
+            if "_id" in written:
+                doc["_id"] = written["_id"]
+    
+    updateRollups(col, pending)
+    
+    return inserted
+
+#------------------------------------------------------------------------------
+def deleteExpense(col, doc):
+    """
+    Delete an expense, and take it out of the rollups.
+
+    Parameters
+    ----------
+    col : PyMongo Collection
+        The expenses collection.
+    doc : Dictionary
+        The expense, as it was read from the database.
+
+    Returns
+    -------
+    Integer
+        The number deleted, 0 if it had already gone.
+
+    """
+    deleted = col.delete_one({"_id" : doc["_id"]}).deleted_count
+    if deleted > 0:
+        updateRollups(col, removed=[doc])
+    
+    return deleted
+
+#------------------------------------------------------------------------------
+def _rollupDeltas(docs, sign, deltas):
+    """
+    Add the amounts of docs, in pence, to the totals of their rollups in
+    deltas, or take them away if sign is -1.
+    """
+    if len(docs) == 0:
+        return
+    
+    amounts   = money.toPence([doc["Amount"]   for doc in docs])
+    courtneys = money.toPence([doc["Courtney"] for doc in docs])
+    for doc, amount, courtney in zip(docs, amounts, courtneys):
+        key   = (datetime(doc["Date"].year, doc["Date"].month, 1), doc["Category"], doc["Recurring"] == True)
+        total = deltas.setdefault(key, [0, 0, 0])
+        total[0] += sign * int(amount)
+        total[1] += sign * int(courtney)
+        total[2] += sign
+
+#------------------------------------------------------------------------------
+def updateRollups(col, added=(), removed=()):
+    """
+    Keep the monthly rollups up to date after expenses are written, in one
+    unordered bulk write of $inc upserts. Every write in this module calls
+    it, anything writing to the collection another way should too.
+    
+    Expenses in added with unrolled_field set have it cleared once their
+    $inc is written, by _id, or by Key for recurring expenses. Those in
+    removed with it set were never added, so are not taken away. A write
+    retried after its reply was lost can then add just the expenses still
+    marked. Only a failure between the $inc and clearing the field leaves the
+    rollups out, rebuildRollups puts them right.
+
+    Parameters
+    ----------
+    col : PyMongo Collection
+        The expenses collection.
+    added : List of dictionaries, optional
+        The expenses written.
+    removed : List of dictionaries, optional
+        The expenses deleted, or the versions replaced by those in added.
+
+    Returns
+    -------
+    None.
+
+    """
+    removed = [doc for doc in removed if not doc.get(unrolled_field)]
+    deltas  = {}
+    _rollupDeltas(added,    1, deltas)
+    _rollupDeltas(removed, -1, deltas)
+    
+    requests = []
+    for (date, category, recurring), (amount, courtney, count) in deltas.items():
+        if amount == 0 and courtney == 0 and count == 0:
+            continue
+        requests.append(pymongo.UpdateOne({"Date" : date, "Category" : category, "Recurring" : recurring},
+                                          {"$inc"         : {"Amount" : amount, "Courtney" : courtney, "Count" : count},
+                                           "$setOnInsert" : {"Year" : date.year, "Month" : date.month}}, upsert=True))
+    
+    if len(requests) > 0:
+        col.database[rollup_collection].bulk_write(requests, ordered=False)
+    
+    rolled = [pymongo.UpdateOne({"_id" : doc["_id"]} if "_id" in doc else {"Key" : doc["Key"]}, {"$unset" : {unrolled_field : ""}})
+              for doc in added if doc.get(unrolled_field)]
+    if len(rolled) > 0:
+        col.bulk_write(rolled, ordered=False)
+
+#------------------------------------------------------------------------------
+def rebuildRollups(col):
+    """
+    Rebuild the monthly rollups from every expense, totalled on the server,
+    replacing what was there. For repairing them, e.g. after the expenses have been
+    edited by hand.
+
+    Parameters
+    ----------
+    col : PyMongo Collection
+        The expenses collection.
+
+    Returns
+    -------
+    Integer
+        The number of rollup documents.
+
+    """
+    amount   = _pence("$Amount")
+    courtney = _pence("$Courtney")
+    pipeline = [{"$group" : {"_id"      : {"Date"      : {"$dateFromParts" : {"year" : {"$year" : "$Date"}, "month" : {"$month" : "$Date"}}},
+                                           "Category"  : "$Category",
+                                           "Recurring" : {"$eq" : ["$Recurring", True]}},
+                             "Amount"   : {"$sum" : amount},
+                             "Courtney" : {"$sum" : courtney},
+                             "Count"    : {"$sum" : 1}}}]
+    
+    docs = []
+    for group in col.aggregate(pipeline):
+        key = group["_id"]
+        docs.append({"Date"     : key["Date"], "Category" : key["Category"], "Recurring" : key["Recurring"],
+                     "Year"     : key["Date"].year, "Month" : key["Date"].month,
+                     "Amount"   : int(group["Amount"]), "Courtney" : int(group["Courtney"]), "Count" : group["Count"]})
+    
+    # Written to a new collection which then replaces the old one in one go,
+    # so the rollups are never seen half built
+    rebuilt = col.database[rollup_collection + "_rebuild"]
+    rebuilt.drop()
+    rebuilt.create_indexes(rollup_indexes)
+    if len(docs) > 0:
+        rebuilt.insert_many(docs, ordered=False)
+    rebuilt.rename(rollup_collection, dropTarget=True)
+    
+    # Everything is in the rollups now
+    rolled = [pymongo.UpdateOne({"_id" : doc["_id"]}, {"$unset" : {unrolled_field : ""}}) for doc in col.find({unrolled_field : True}, {"_id" : 1})]
+    if len(rolled) > 0:
+        col.bulk_write(rolled, ordered=False)
+    
+    return len(docs)
+
+#------------------------------------------------------------------------------
+def getRollupRows(start, end, col):
+    """
+    Read the monthly rollups between two months, as rows that can be rolled
+    up again by report.buildRollup (e.g. through saveRollup) in place of the
+    expenses themselves.
+
+    Parameters
+    ----------
+    start : datetime/String
+        A date in the first month, e.g. "2019-01".
+    end : datetime/String
+        A date in the last month, it is inclusive.
+    col : PyMongo Collection
+        The expenses collection.
+
+    Returns
+    -------
+    Pandas DataFrame
+        One row per month, category and recurring/itemised, with the Date
+        (the first of the month), Category, Recurring, Count, and the
+        Amount and Courtney totals in pence.
+
+    """
+    min_date = pd.Period(start, freq="M").start_time.to_pydatetime()
+    end_date = (pd.Period(end, freq="M") + 1).start_time.to_pydatetime()
+    query    = {"Date" : {"$gte" : min_date, "$lt" : end_date}, "Count" : {"$gt" : 0}}
+    fields   = {"_id" : 0, "Date" : 1, "Category" : 1, "Recurring" : 1, "Amount" : 1, "Courtney" : 1, "Count" : 1}
+    
+    df = pd.DataFrame(list(col.database[rollup_collection].find(query, fields).sort("Date", 1)),
+                      columns=["Date", "Category", "Recurring", "Amount", "Courtney", "Count"])
+    
+    df["Date"]      = pd.to_datetime(df["Date"])
+    df["Recurring"] = df["Recurring"].astype(bool)
+    for column in ["Amount", "Courtney", "Count"]:
+        df[column] = df[column].astype("int64")
+    
+    return df
+
+#------------------------------------------------------------------------------
+def _pence(field):
+    """
+    An aggregation expression converting a field in pounds to whole pence,
+    rounding halves away from zero like money.toPence. ($round rounds halves
+    to even, so is not used.)
+    """
+    return {"$trunc" : {"$add" : [{"$multiply" : [field, 100]}, {"$multiply" : [{"$cmp" : [field, 0]}, 0.5]}]}}
+
+#------------------------------------------------------------------------------
+def aggregateTotals(col, min_date, max_date):
+    """
+    Work out the totals between two dates on the MongoDB server, so only the
+    totals are sent back rather than every document. The documents are
+    grouped in the same way as report.groupRows, so every total in the
+    reports can be built from these groups.
+
+    Parameters
+    ----------
+    col : PyMongo Collection
+        The collection we are querying.
+    min_date : datetime
+        The first date, inclusive.
+    max_date : datetime
+        The last date, inclusive.
+
+    Returns
+    -------
+    totals : Dictionary
+        Maps (recurring, sign of the amount, has a Courtney share, category)
+        to the (amount, courtney) sums of that group, in pence.
+
+    """
+    # A missing Courtney share is none, as typeColumns has it, rather than
+    # null which is not equal to 0
+    amount   = _pence("$Amount")
+    courtney = _pence({"$ifNull" : ["$Courtney", 0]})
+    pipeline = [{"$match" : {"Date" : {"$lte" : max_date, "$gte" : min_date}}},
+                {"$group" : {"_id"      : {"Recurring" : {"$eq"  : ["$Recurring", True]},
+                                           "Sign"      : {"$cmp" : [amount,       0]},
+                                           "Shared"    : {"$ne"  : [courtney,     0]},
+                                           "Category"  : "$Category"},
+                             "Amount"   : {"$sum" : amount},
+                             "Courtney" : {"$sum" : courtney}}}]
+    
+    totals = {}
+    for group in col.aggregate(pipeline):
+        key = group["_id"]
+        totals[(key["Recurring"], key["Sign"], key["Shared"], key["Category"])] = (int(group["Amount"]), int(group["Courtney"]))
+    
+    return totals
+
+#------------------------------------------------------------------------------
+def typeColumns(df):
+    """
+    Give the columns of a summary DataFrame their compact types, in place.
+    The dates are datetime64, the categories a categorical of
+    lookup.valid_categories (any others after them), the amounts int64 pence
+    and recurring a bool. A missing Courtney share counts as nothing, as it
+    does in the server's totals.
+
+    Parameters
+    ----------
+    df : Pandas DataFrame
+        The documents returned by a query.
+
+    Returns
+    -------
+    None.
+
+    """
+    categories = set(df["Category"].dropna().unique())
+    categories = [cat for cat in lookup.valid_categories if cat in categories] + sorted(categories - set(lookup.valid_categories))
+    
+    df["Date"]      = pd.to_datetime(df["Date"])
+    df["Category"]  = pd.Categorical(df["Category"], categories=categories)
+    df["Amount"]    = money.toPence(df["Amount"])
+    df["Courtney"]  = money.toPence(df["Courtney"].fillna(0))
+    df["Recurring"] = (df["Recurring"] == True).astype(bool)
+
+#------------------------------------------------------------------------------
+def formatSummary(df):
+    """
+    Give the columns of a summary DataFrame their types (see typeColumns),
+    sort it into chronological order and add the formatted date and cost
+    columns, in place.
+
+    Parameters
+    ----------
+    df : Pandas DataFrame
+        The documents returned by a query.
+
+    Returns
+    -------
+    None.
+
+    """
+    with metrics.stage("types"):
+        typeColumns(df)
+    
+    # Sort the values into chronological order, keeping the order they were
+    # returned in for the same date
+    with metrics.stage("sort"):
+        df.sort_values("Date", inplace=True, kind="stable")
+    
+    with metrics.stage("format"):
+        # Create formated date
+        df["Date_fmt"] = df["Date"].dt.strftime("%d-%b-%Y")
+        
+        # Create formatted cost rows
+        df["Amount_fmt"]   = money.formatPence(df["Amount"])
+        df["Courtney_fmt"] = money.formatPence(df["Courtney"])
+
+#------------------------------------------------------------------------------
+def _findFrame(col, query):
+    """
+    Find the documents matching a query and put them in a DataFrame, timing
+    the two stages and counting the documents.
+    """
+    with metrics.stage("find"):
+        docs = list(col.find(query))
+    metrics.count("documents_read", len(docs))
+    
+    with metrics.stage("dataframe"):
+        return pd.DataFrame(docs)
+
+#------------------------------------------------------------------------------
+def getMonthSummary(month, year, col, path=".", aggregate=False, cache=None):
     """
     This method creates a summary from the collection, saves them out and returns a Pandas DataFrame
 
@@ -49,6 +759,15 @@ def getMonthSummary(month, year, col, path="."):
         The collection we are querying.
     path : String, optional
         The path to where the output files are saved.
+    aggregate : Boolean, optional
+        If True the totals are worked out by the MongoDB server with
+        aggregateTotals. The totals are kept in df.attrs["totals"], where
+        saveDF picks them up. The rows are fetched whole either way, so
+        overview.csv has the same columns in both modes. The default is
+        False.
+    cache : cache.FrameCache, optional
+        If given the month is loaded from the cache when its documents have
+        not changed, and cached when they have. The default is None.
 
     Returns
     -------
@@ -81,24 +800,122 @@ def getMonthSummary(month, year, col, path="."):
     # Build the query
     query = {"Date" : { "$lte" : max_date, "$gte" : min_date}}
     
-    # Find the documents, and save them to a dataframe
-    df = pd.DataFrame(list(col.find(query)))
+    def build():
+        # Find the documents, and save them to a dataframe
+        df = _findFrame(col, query)
+        if aggregate:
+            with metrics.stage("aggregate"):
+                df.attrs["totals"] = aggregateTotals(col, min_date, max_date)
+            
+        # Sort into chronological order and add the formatted columns, a
+        # month with no enteries has no columns to format
+        if len(df) > 0:
+            formatSummary(df)
         
-    # Sort the values into chronological order
-    df.sort_values("Date", inplace=True)
+        return df
+    #--------------------------------------------------------------------------
     
-    # Create formated date
-    df["Date_fmt"] = df["Date"].dt.strftime("%d-%b-%Y")
+    with metrics.stage("month_summary"):
+        if cache is None:
+            df = build()
+        else:
+            name = "{:%Y-%m-%d}_{:%Y-%m-%d}{}".format(min_date, max_date, "_aggregate" if aggregate else "")
+            df   = cache.fetch(col, query, name, build)
     
+    return df, min_date.strftime("%Y-%m_%B")
+
+#------------------------------------------------------------------------------
+def periodName(period):
+    """
+    The name of the output directory for a period, months keep the same
+    name getMonthSummary uses.
+
+    Parameters
+    ----------
+    period : Pandas Period
+        The period, e.g. a month or a year.
+
+    Returns
+    -------
+    String
+        The directory name.
+
+    """
+    if period.freqstr.startswith("M"):
+        return period.start_time.strftime("%Y-%m_%B")
+    
+    return str(period)
+
+#------------------------------------------------------------------------------
+def getRangeSummary(start, end, col, freq="M", cache=None):
+    """
+    Fetch every document between two dates in a single query, and split them
+    into one summary per period (by default per month).
+
+    Parameters
+    ----------
+    start : datetime/String
+        A date in the first period of the range, e.g. datetime(2022, 1, 1) or
+        "2022-01".
+    end : datetime/String
+        A date in the last period of the range, it is inclusive.
+    col : PyMongo Collection
+        The collection we are querying.
+    freq : String, optional
+        The length of each period as a Pandas frequency, "M" for months, "Q"
+        for quarters or "Y" for years. The default is "M".
+    cache : cache.FrameCache, optional
+        If given the range is loaded from the cache when its documents have
+        not changed, and cached when they have. The default is None.
+
+    Returns
+    -------
+    df : Pandas DataFrame
+        All the enteries in the range, with a "Period" column.
+    summaries : List of tuples
+        A (DataFrame, name) pair for each period with enteries, in 
+        chronological order. Each DataFrame is laid out the same as the one
+        getMonthSummary returns, so can be passed straight to saveDF.
+
+    """
+    periods = pd.period_range(pd.Period(start, freq), pd.Period(end, freq), freq=freq)
+    if len(periods) == 0:
+        raise ValueError("The end of the range is before the start")
     
-    # Create formatted cost rows
-    df["Amount_fmt"] = df.apply(lambda row: "£{:0,.2f}".format(row["Amount"]).replace("£-", "-£"), axis=1)
-    df["Courtney_fmt"] = df.apply(lambda row: "£{:0,.2f}".format(row["Courtney"]).replace("£-", "-£"), axis=1)
+    # Build the query, from the start of the first period up to the start of
+    # the period after the last
+    min_date = periods[0].start_time.to_pydatetime()
+    end_date = (periods[-1] + 1).start_time.to_pydatetime()
+    query    = {"Date" : { "$lt" : end_date, "$gte" : min_date}}
     
-    return df, min_date.strftime("%Y-%m_%B")
+    def build():
+        # Find the documents, and save them to a single dataframe
+        df = _findFrame(col, query)
+        if len(df) > 0:
+            formatSummary(df)
+            df["Period"] = df["Date"].dt.to_period(freq)
+        
+        return df
+    #--------------------------------------------------------------------------
+    
+    with metrics.stage("range_summary"):
+        if cache is None:
+            df = build()
+        else:
+            name = "{:%Y-%m-%d}_{:%Y-%m-%d}_{}".format(min_date, end_date, periods.freqstr)
+            df   = cache.fetch(col, query, name, build)
+    
+    if len(df) == 0:
+        return df, []
+    
+    # Split by period in memory
+    with metrics.stage("split"):
+        summaries = [(group.drop(columns="Period"), periodName(period)) for period, group in df.groupby("Period", sort=True)]
+    
+    return df, summaries
 
 #------------------------------------------------------------------------------
-def saveDF(df, root="."):
+def saveDF(df, root=".", incremental=False, workers=1):
     """
     Save att the relevent dataframes.
 
@@ -109,172 +926,181 @@ def saveDF(df, root="."):
         
     root : String, optional
         The path to the root directory where the output files are saved.
+    incremental : Boolean, optional
+        If True only the files whose contents have changed since the last
+        save are written, using the hashes in the manifest left in root.
+        Files from views that no longer exist (e.g. a category with no
+        enteries left) are removed. The default is False.
+    workers : Integer, optional
+        The number of worker processes the HTML views are rendered with, see
+        report.writeViews. The default is 1.
 
     Returns
     -------
-    None.
+    written : List of Strings
+        The names of the files written.
 
     """
-    def write_html(_df, name="default.html", cols=None, _root=root):
-        with open(os.path.join(_root, name), "w", encoding="utf-8") as f:
-            _df.to_html(f, columns=cols, col_space=150, justify="center", index=False)
-    #--------------------------------------------------------------------------
-    
-    value_root = os.path.join(root, "value_sorted")
+    value_root = os.path.join(root, report.value_dir)
     
     if not os.path.isdir(root):
         os.makedirs(root)
         
     if not os.path.isdir(value_root):
         os.makedirs(value_root)
-    #--------------------------------------------------------------------------    
-       
-    # Pretty formatting
-    replace_dict = {"Date_fmt" : "Date", "Amount_fmt" : "Amount", "Courtney_fmt" : "Courtney", "Courtney" : "Courtney_num", "Amount" : "Amount_num", "Date" : "Date_dt"}
-    df_fmt = df.rename(replace_dict, axis=1)
-    
-    #--------------------------------------------------------------------------
-    # All Enteries
     #--------------------------------------------------------------------------
-    # Save all to csv (all columns)
-    df_fmt.to_csv(os.path.join(root, "overview.csv"), index=False)
     
-    # Save all to html
-    # Calculate Totals
-    # Total Recurring
-    total_rec_amount   = df_fmt.loc[df_fmt["Recurring"] == True]["Amount_num"].sum()
-    total_rec_courtney = df_fmt.loc[df_fmt["Recurring"] == True]["Courtney_num"].sum()
+    # The hashes from the last save
+    manifest_path = os.path.join(root, manifest_name)
+    manifest      = {}
+    if incremental and os.path.isfile(manifest_path):
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
     
-    total_rec = {"Name" : "Recurring Expenses Total", "Category": "TOTAL", "Date_fmt": "", "Date": "", "Recurring" : True,
-                 "Amount"   : "£{:0,.2f}".format(total_rec_amount).replace("£-", "-£"),
-                 "Courtney" : "£{:0,.2f}".format(total_rec_courtney).replace("£-", "-£")}
-    
-    
-    total_exp_amount   = df_fmt.loc[df_fmt["Recurring"] == False]["Amount_num"].sum()
-    total_exp_courtney = df_fmt.loc[df_fmt["Recurring"] == False]["Courtney_num"].sum()
-    # Total Expenses
-    total_exp = {"Name" : "Itemised Expenses Total", "Category": "TOTAL", "Date_fmt": "", "Date": "", "Recurring" : False,
-                 "Amount"   : "£{:0,.2f}".format(total_exp_amount).replace("£-", "-£"),
-                 "Courtney" : "£{:0,.2f}".format(total_exp_courtney).replace("£-", "-£")}
-    
-    total_gnd = {"Name" : "Grand Total", "Category": "TOTAL", "Date_fmt": -1, "Date": "", "Recurring" : True,
-                 "Amount":   "£{:0,.2f}".format(total_rec_amount   + total_exp_amount).replace("£-", "-£"),
-                 "Courtney": "£{:0,.2f}".format(total_rec_courtney + total_exp_courtney).replace("£-", "-£")}
-    
-    # Place them at the end of the dataframe
-    df_all = df_fmt.append([total_rec, total_exp, total_gnd], ignore_index=True)
-    
-    df_all = df_all.sort_values(["Recurring", "Date_fmt"], ascending=[False, True])
-        
-    df_all_value = df_all.sort_values(["Amount_num", "Date_fmt"], ascending=[True, False])
-    
-    write_html(df_all,       "overview.html", ["Name", "Date", "Category", "Amount", "Courtney"])
-    write_html(df_all_value, "overview.html", ["Name", "Date", "Category", "Amount", "Courtney"], value_root)
-    
-    #--------------------------------------------------------------------------
-    # All Positive/Negative Enteries
+    def changed(name, digest, *paths):
+        # Write when the contents differ or a file has gone missing
+        return not incremental or manifest.get(name) != digest or not all(os.path.isfile(path) for path in paths)
     #--------------------------------------------------------------------------
-    # Save all to csv (all columns)
-    df_positive = df_fmt.loc[(df_fmt["Amount_num"] > 0) & (df_fmt["Recurring"] == False)].sort_values("Amount_num")
-    df_negative = df_fmt.loc[(df_fmt["Amount_num"] < 0) & (df_fmt["Recurring"] == False)].sort_values("Amount_num")
     
-    # Save all to html
-    # Calculate Totals
-    positive_totals = {"Name" : "Totals", "Category": "TOTAL", "Date": "",
-                       "Amount"   : "£{:0,.2f}".format(df_positive["Amount_num"].sum()).replace("£-", "-£"),
-                       "Courtney" : "£{:0,.2f}".format(df_positive["Courtney_num"].sum()).replace("£-", "-£")}
+    hashes  = {}
+    written = []
     
-    negative_totals = {"Name" : "Totals", "Category": "TOTAL", "Date": "",
-                       "Amount"   : "£{:0,.2f}".format(df_negative["Amount_num"].sum()).replace("£-", "-£"),
-                       "Courtney" : "£{:0,.2f}".format(df_negative["Courtney_num"].sum()).replace("£-", "-£")}
+    # Save all to csv (all columns)
+    with metrics.stage("csv"):
+        df_fmt = report.csvColumns(df)
+        hashes["overview.csv"] = report.frameHash(df_fmt)
+        if changed("overview.csv", hashes["overview.csv"], os.path.join(root, "overview.csv")):
+            df_fmt.to_csv(os.path.join(root, "overview.csv"), index=False)
+            written.append("overview.csv")
+            metrics.count("files_written")
+            metrics.count("bytes_written", os.path.getsize(os.path.join(root, "overview.csv")))
     
-    # Place them at the end of the dataframe
-    df_positive = df_positive.append(positive_totals, ignore_index=True).sort_values("Date", ascending=True)
-    df_positive_value = df_positive.sort_values("Amount_num")
+    # Save each view to html, using the totals from the server if we have them
+    with metrics.stage("views"):
+        views = []
+        for view in report.buildViews(df, df.attrs.get("totals")):
+            hashes[view.name] = report.viewHash(view)
+            if changed(view.name, hashes[view.name], os.path.join(root, view.name), os.path.join(value_root, view.name)):
+                views.append(view)
     
-    df_negative = df_negative.append(negative_totals, ignore_index=True).sort_values("Date", ascending=True)
-    df_negative_value = df_negative.sort_values("Amount_num")
+    with metrics.stage("html"):
+        written += report.writeViews(views, root, workers)
     
-    write_html(df_positive,       "positive-expenses.html", ["Name", "Date", "Category", "Amount", "Courtney"])
-    write_html(df_positive_value, "positive-expenses.html", ["Name", "Date", "Category", "Amount", "Courtney"], value_root)
+    # Remove the files of views that have gone since the last save
+    for name in set(manifest) - set(hashes):
+        for directory in [root, value_root]:
+            if os.path.isfile(os.path.join(directory, name)):
+                os.remove(os.path.join(directory, name))
     
-    write_html(df_negative,       "negative-expenses.html", ["Name", "Date", "Category", "Amount", "Courtney"])
-    write_html(df_negative_value, "negative-expenses.html", ["Name", "Date", "Category", "Amount", "Courtney"], value_root)
+    # Always left up to date, so a later incremental save can trust it
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(hashes, f, indent=1, sort_keys=True)
     
-    #--------------------------------------------------------------------------
-    # Courtney Only Enteries
-    #--------------------------------------------------------------------------
-    # Save just courtney to html
-    c_df = df_fmt[df["Courtney"] != 0]
-    
-    # Calculate Totals
-    totals = {"Name" : "Totals", "Category": "TOTAL", "Date": "",
-              "Amount"   : "£{:0,.2f}".format(c_df["Amount_num"].sum()).replace("£-", "-£"),
-              "Courtney" : "£{:0,.2f}".format(c_df["Courtney_num"].sum()).replace("£-", "-£")}
+    return written
 
-    # Place them at the end of the dataframe
-    c_df = c_df.append(totals, ignore_index=True)
-    
-    c_df_value = c_df.sort_values("Courtney_num")
-    
-    write_html(c_df,       "courtney.html", ["Name", "Date", "Category", "Amount", "Courtney"])
-    write_html(c_df_value, "courtney.html", ["Name", "Date", "Category", "Amount", "Courtney"], value_root)
-    
-    #--------------------------------------------------------------------------
-    # Harry Only Enteries
-    #--------------------------------------------------------------------------
-    # Save just harry to html
-    h_df = df_fmt[df["Courtney"] == 0]
-    
-    # Calculate Totals
-    totals = {"Name" : "Totals", "Category": "TOTAL", "Date": "",
-              "Amount"   : "£{:0,.2f}".format(h_df["Amount_num"].sum()).replace("£-", "-£"),
-              "Courtney" : "£{:0,.2f}".format(h_df["Courtney_num"].sum()).replace("£-", "-£")}
+#------------------------------------------------------------------------------
+def saveRollup(df, root=".", freq="M"):
+    """
+    Save the rolled up view of a range, one row per period with the totals
+    for each category.
+
+    Parameters
+    ----------
+    df : Pandas DataFrame
+        The enteries in the range, usually from getRangeSummary, or the
+        monthly rollups of the range from getRollupRows.
+    root : String, optional
+        The path to the root directory where the output files are saved.
+    freq : String, optional
+        The length of each period as a Pandas frequency. The default is "M".
+
+    Returns
+    -------
+    None.
 
-    # Place them at the end of the dataframe
-    h_df = h_df.append(totals, ignore_index=True)
+    """
+    if not os.path.isdir(root):
+        os.makedirs(root)
     
-    h_df_value = h_df.sort_values("Amount_num")
+    rollup = report.buildRollup(df, freq)
+    report.csvRollup(rollup).to_csv(os.path.join(root, "rollup.csv"), index=False)
+    report.writeRollup(rollup, root)
+
+#------------------------------------------------------------------------------
+def _savePeriod(df, root, incremental):
+    """
+    saveDF for a worker process of saveRange. Returns what it recorded, as
+    the worker's metrics are otherwise lost when it exits.
+    """
+    with metrics.collect() as run:
+        saveDF(df, root, incremental)
     
-    write_html(h_df,       "harry.html", ["Name", "Date", "Category", "Amount"])
-    write_html(h_df_value, "harry.html", ["Name", "Date", "Category", "Amount"], value_root)
+    return run.snapshot()
+
+#------------------------------------------------------------------------------
+def saveRange(df, summaries, root=".", freq="M", incremental=False, workers=1):
+    """
+    Save each period of a range in the same layout as saveDF, with the
+    rolled up view alongside them.
+
+    Parameters
+    ----------
+    df : Pandas DataFrame
+        All the enteries in the range, from getRangeSummary.
+    summaries : List of tuples
+        The (DataFrame, name) pairs from getRangeSummary.
+    root : String, optional
+        The path to the root directory where the output files are saved.
+    freq : String, optional
+        The frequency the range was split by. The default is "M".
+    incremental : Boolean, optional
+        Passed on to saveDF for each period. The default is False.
+    workers : Integer, optional
+        The number of worker processes the periods are saved with, each
+        period is saved by a single worker into its own directory. The
+        default is 1.
+
+    Returns
+    -------
+    None.
+
+    """
+    paths = [os.path.join(root, name) for _, name in summaries]
+    dfs   = [period_df for period_df, _ in summaries]
     
-    #--------------------------------------------------------------------------
-    # Recurring Only Enteries
-    #--------------------------------------------------------------------------
-    # Save just harry to html
-    rec_df = df_fmt[df["Recurring"] == True]
+    with metrics.stage("save_periods"):
+        if workers <= 1 or len(summaries) <= 1:
+            for period_df, path in zip(dfs, paths):
+                saveDF(period_df, path, incremental)
+        else:
+            # Each worker sends back what it recorded, the files and bytes
+            # written included
+            for period_metrics in pools.mapOnPool(_savePeriod, workers, dfs, paths, [incremental] * len(dfs)):
+                metrics.merge(period_metrics)
     
-    # Calculate Totals
-    totals = {"Name" : "Totals", "Category": "TOTAL", "Date": "",
-              "Amount"   : "£{:0,.2f}".format(rec_df["Amount_num"].sum()).replace("£-", "-£"),
-              "Courtney" : "£{:0,.2f}".format(rec_df["Courtney_num"].sum()).replace("£-", "-£")}
+    if len(df) > 0:
+        with metrics.stage("rollup"):
+            saveRollup(df, root, freq)
 
-    # Place them at the end of the dataframe
-    rec_df = rec_df.append(totals, ignore_index=True)
-    
-    rec_df_value = rec_df.sort_values("Amount_num")
+#------------------------------------------------------------------------------
+if __name__ == "__main__":
+    import argparse
     
-    write_html(rec_df,       "recurring.html", ["Name", "Date", "Category", "Amount", "Courtney"])
-    write_html(rec_df_value, "recurring.html", ["Name", "Date", "Category", "Amount", "Courtney"], value_root)
+    parser = argparse.ArgumentParser(description="PyFinance database diagnostics")
+    parser.add_argument("command", choices=["indexes", "explain"], help="Create the indexes, or explain each query the software makes")
+    parser.add_argument("--address", default="localhost", help="The address of the MongoDB server")
+    parser.add_argument("--port",    default=27017, type=int, help="The port the MongoDB server is running on")
+    args = parser.parse_args()
     
+    expenses = openCollection(args.address, args.port)
     
-    #--------------------------------------------------------------------------
-    # Each Category
-    #--------------------------------------------------------------------------
-    # For each category
-    for cat in df_fmt["Category"].unique():
-        if cat != "TOTAL":
-            w_df = df_fmt[df_fmt["Category"] == cat]
-            
-            # Calculate Totals
-            totals = {"Name" : "Totals", "Category": "TOTAL", "Date": "",
-                      "Amount"   : "£{:0,.2f}".format(w_df["Amount_num"].sum()).replace("£-", "-£"),
-                      "Courtney" : "£{:0,.2f}".format(w_df["Courtney_num"].sum()).replace("£-", "-£")}
-    
-            # Place them at the end of the dataframe
-            w_df       = w_df.append(totals, ignore_index=True)
-            w_df_value = w_df.sort_values("Amount_num")
-        
-            write_html(w_df,       "{}.html".format(cat.lower()), ["Name", "Date", "Amount", "Courtney"])
-            write_html(w_df_value, "{}.html".format(cat.lower()), ["Name", "Date", "Amount", "Courtney"], value_root)
\ No newline at end of file
+    if args.command == "indexes":
+        for index in expenses.index_information():
+            print(index)
+    else:
+        for result in explainQueries(expenses):
+            flag = "COLLSCAN!" if result["collscan"] else "ok"
+            print("{:<40} | {:<9} | {}".format(result["name"], flag, " <- ".join(result["stages"])))
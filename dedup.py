@@ -0,0 +1,343 @@
+"""
+Duplicate detection for expenses. Each itemised expense is given a hash of
+its date, name and amount, which is kept on the document with a unique index
+in MongoDB, and in a set in memory so a duplicate is spotted before it is
+written without a round trip.
+"""
+
+import hashlib
+import threading
+
+import pymongo
+import pymongo.errors
+
+import money
+import database
+
+#------------------------------------------------------------------------------
+# Global Variables
+#------------------------------------------------------------------------------
+hash_field = "Hash"
+
+# What to do with a duplicate, "reject" leaves it out, "flag" writes it
+# without a hash and marked as a duplicate, to be checked by hand
+modes      = ["reject", "flag"]
+
+# One index per (address, port), shared by the whole process
+_indexes   = {}
+#------------------------------------------------------------------------------
+
+def normaliseName(name):
+    """
+    Normalise a name for comparing, in lower case with the whitespace
+    collapsed, so "Tesco  Stores" and "tesco stores" are the same.
+
+    Parameters
+    ----------
+    name : String
+        The name of the expense.
+
+    Returns
+    -------
+    String
+
+    """
+    return " ".join(str(name).lower().split())
+#------------------------------------------------------------------------------
+
+def expenseHash(doc, occurrence=1):
+    """
+    The hash of an expense, from its date (to the day), normalised name and
+    amount in pence.
+
+    Parameters
+    ----------
+    doc : Dictionary
+        The document for the expense.
+    occurrence : Integer, optional
+        Counts the same expense on the same day within a statement, e.g. two
+        coffees, so they each get their own hash. The default is 1.
+
+    Returns
+    -------
+    String
+        24 hex characters.
+
+    """
+    key = "{:%Y-%m-%d}|{}|{}".format(doc["Date"], normaliseName(doc["Name"]), money.Money.parse(doc["Amount"]).pence)
+    if occurrence > 1:
+        key += "|{}".format(occurrence)
+
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=12).hexdigest()
+#------------------------------------------------------------------------------
+
+class DedupIndex():
+    """
+    The hashes of the expenses already in a collection, loaded once and
+    kept up to date as expenses are added through it, so checking an
+    expense is a set lookup.
+    """
+    def __init__(self, collection):
+        self.collection = collection
+        self.lock       = threading.Lock()
+        self.hashes     = None
+
+    def load(self):
+        """
+        Load the hashes from the database, the first time it is needed.
+
+        Returns
+        -------
+        None.
+
+        """
+        with self.lock:
+            if self.hashes is not None:
+                return
+
+        cursor = self.collection.find({hash_field : {"$exists" : True}}, {hash_field : 1, "_id" : 0})
+        hashes = set(doc[hash_field] for doc in cursor)
+
+        with self.lock:
+            if self.hashes is None:
+                self.hashes = hashes
+
+    def ready(self):
+        """
+        Whether the hashes have been loaded, so checking is a set lookup
+        with no round trip to the database.
+        """
+        with self.lock:
+            return self.hashes is not None
+
+    def seen(self, doc):
+        """
+        Check whether an expense is already in the database.
+
+        Parameters
+        ----------
+        doc : Dictionary
+            The document for the expense.
+
+        Returns
+        -------
+        Boolean
+
+        """
+        self.load()
+
+        with self.lock:
+            return expenseHash(doc) in self.hashes
+
+    def prepare(self, docs, mode="reject", occurrences=None):
+        """
+        Give each expense its hash, and sort out the duplicates of ones
+        already in the database.
+
+        The same expense more than once in docs (two coffees on the same
+        day) is not a duplicate, each repeat is hashed with its occurrence
+        (see expenseHash). Importing the same statement again gives them the
+        same hashes, so they are still caught then.
+
+        Parameters
+        ----------
+        docs : List of dictionaries
+            The expenses.
+        mode : String, optional
+            "reject" leaves the duplicates out, "flag" keeps them without a
+            hash and with "Duplicate" set to True. The default is "reject".
+        occurrences : Dictionary, optional
+            How many times each expense has been seen so far, updated in
+            place, so a statement imported a chunk at a time counts its
+            repeats across the chunks. The default is None, counted within
+            docs.
+
+        Returns
+        -------
+        new : List of dictionaries
+            The expenses to write, with their hashes.
+        duplicates : List of dictionaries
+            The expenses found to be duplicates.
+
+        """
+        if mode not in modes:
+            raise ValueError("The mode must be one of {}".format(", ".join(modes)))
+
+        self.load()
+
+        occurrences = {} if occurrences is None else occurrences
+        new         = []
+        duplicates  = []
+        with self.lock:
+            for doc in docs:
+                doc    = dict(doc)
+                first  = expenseHash(doc)
+
+                occurrences[first] = occurrences.get(first, 0) + 1
+                digest = expenseHash(doc, occurrences[first]) if occurrences[first] > 1 else first
+
+                if digest in self.hashes:
+                    duplicates.append(doc)
+                    if mode == "flag":
+                        doc["Duplicate"] = True
+                        new.append(doc)
+                else:
+                    doc[hash_field] = digest
+                    new.append(doc)
+
+        return new, duplicates
+
+    def add(self, docs):
+        """
+        Record expenses as written, e.g. after they have been inserted.
+
+        Parameters
+        ----------
+        docs : List of dictionaries
+            The expenses, those without a hash are ignored.
+
+        Returns
+        -------
+        None.
+
+        """
+        with self.lock:
+            # If they are not loaded yet they will be loaded with these in
+            if self.hashes is not None:
+                self.hashes.update(doc[hash_field] for doc in docs if hash_field in doc)
+
+    def discard(self, doc):
+        """
+        Forget an expense, e.g. after it has been removed with undo.
+
+        Parameters
+        ----------
+        doc : Dictionary
+            The expense, ignored if it has no hash.
+
+        Returns
+        -------
+        None.
+
+        """
+        with self.lock:
+            if self.hashes is not None and hash_field in doc:
+                self.hashes.discard(doc[hash_field])
+
+    def insert(self, docs, mode="reject", occurrences=None):
+        """
+        Insert expenses with their duplicates sorted out, see prepare, in a
+        single unordered bulk insert. Any duplicates written by someone else
+        since the hashes were loaded are caught by the unique index.
+
+        Parameters
+        ----------
+        docs : List of dictionaries
+            The expenses.
+        mode : String, optional
+            "reject" or "flag". The default is "reject".
+        occurrences : Dictionary, optional
+            Passed on to prepare. The default is None.
+
+        Returns
+        -------
+        inserted : Integer
+            The number inserted, flagged duplicates included.
+        duplicates : Integer
+            The number found to be duplicates.
+
+        """
+        new, duplicates = self.prepare(docs, mode, occurrences)
+        inserted        = len(new)
+        rejected        = 0
+
+        try:
+            database.insertExpenses(self.collection, new)
+        except pymongo.errors.BulkWriteError as error:
+            for write_error in error.details["writeErrors"]:
+                if write_error["code"] != 11000:
+                    raise
+            rejected  = len(error.details["writeErrors"])
+            inserted -= rejected
+
+        self.add(new)
+
+        return inserted, len(duplicates) + rejected
+#------------------------------------------------------------------------------
+
+def openIndex(address, port):
+    """
+    Return the duplicate index for a database server, creating it the first
+    time. The hashes are not loaded until they are first needed.
+
+    Parameters
+    ----------
+    address : String
+        The address of the MongoDB server.
+    port : Integer
+        The port the MongoDB server is running on.
+
+    Returns
+    -------
+    DedupIndex
+
+    """
+    key = (address, port)
+    if key not in _indexes:
+        _indexes[key] = DedupIndex(database.openCollection(address, port))
+
+    return _indexes[key]
+#------------------------------------------------------------------------------
+
+def backfillHashes(col):
+    """
+    Give the itemised expenses already in a collection their hashes. Where
+    there are duplicates the earliest keeps the hash and the others are
+    marked with "Duplicate", so they can be checked by hand.
+
+    Parameters
+    ----------
+    col : PyMongo Collection
+        The expenses collection.
+
+    Returns
+    -------
+    hashed : Integer
+        The number of expenses given a hash.
+    duplicates : Integer
+        The number marked as duplicates.
+
+    """
+    seen     = set(doc[hash_field] for doc in col.find({hash_field : {"$exists" : True}}, {hash_field : 1}))
+    requests = []
+    hashed   = 0
+    flagged  = 0
+
+    query = {hash_field : {"$exists" : False}, "Recurring" : False, "Duplicate" : {"$ne" : True}}
+    for doc in col.find(query, {"Date" : 1, "Name" : 1, "Amount" : 1}).sort("_id", 1):
+        digest = expenseHash(doc)
+        if digest in seen:
+            requests.append(pymongo.UpdateOne({"_id" : doc["_id"]}, {"$set" : {"Duplicate" : True}}))
+            flagged += 1
+        else:
+            requests.append(pymongo.UpdateOne({"_id" : doc["_id"]}, {"$set" : {hash_field : digest}}))
+            seen.add(digest)
+            hashed += 1
+
+    if len(requests) > 0:
+        col.bulk_write(requests, ordered=False)
+
+    return hashed, flagged
+#------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="PyFinance duplicate detection")
+    parser.add_argument("command", choices=["backfill"], help="Give the expenses already in the database their hashes")
+    parser.add_argument("--address", default="localhost", help="The address of the MongoDB server")
+    parser.add_argument("--port",    default=27017, type=int, help="The port the MongoDB server is running on")
+    args = parser.parse_args()
+
+    hashed, flagged = backfillHashes(database.openCollection(args.address, args.port))
+    print("{} expenses hashed, {} marked as duplicates".format(hashed, flagged))
@@ -0,0 +1,150 @@
+"""
+Streaming export of the enteries over a date range, for ranges too large to
+build a month summary for. The documents are read from the cursor a batch
+at a time and each batch is written straight out as CSV and HTML rows, with
+the totals kept as it goes, so the memory used does not grow with the range.
+"""
+
+import os
+import csv
+import html
+import itertools
+
+import pandas as pd
+
+import money
+import report
+import database
+
+#------------------------------------------------------------------------------
+# Global Variables
+#------------------------------------------------------------------------------
+batch_size  = 1000
+
+# The same layout as overview.csv
+csv_columns = ["_id", "Name", "Date_dt", "Category", "Amount_num", "Courtney_num", "Recurring", "Date", "Amount", "Courtney"]
+
+# Matches the tables written by DataFrame.to_html in the report files
+html_head   = '<table border="1" class="dataframe">\n  <thead>\n    <tr style="text-align: center;">\n{}    </tr>\n  </thead>\n  <tbody>\n'
+html_th     = '      <th style="min-width: 150px;">{}</th>\n'
+html_tail   = '  </tbody>\n</table>'
+#------------------------------------------------------------------------------
+
+def _htmlRows(rows):
+    """
+    Render a list of rows (lists of strings) as HTML table rows.
+    """
+    return "".join("    <tr>\n" + "".join("      <td>{}</td>\n".format(html.escape(str(cell), quote=False)) for cell in row) + "    </tr>\n" for row in rows)
+#------------------------------------------------------------------------------
+
+def writeExport(documents, csv_file, html_file, size=None):
+    """
+    Write documents out as CSV and HTML, a batch at a time, with the totals
+    rows at the end of the HTML.
+
+    Parameters
+    ----------
+    documents : Iterable of dictionaries
+        The documents in the order they are to be written, e.g. a cursor.
+    csv_file : File like
+        Opened for writing text, with newline="".
+    html_file : File like
+        Opened for writing text.
+    size : Integer, optional
+        The number of documents in each batch. The default is
+        export.batch_size.
+
+    Returns
+    -------
+    totals : Dictionary
+        The number of "rows" written, and the (amount, courtney) totals in
+        pence of the "recurring" and "itemised" enteries and the "grand"
+        total.
+
+    """
+    size     = batch_size if size is None else size
+    writer   = csv.writer(csv_file, lineterminator="\n")
+    totals   = {"rows" : 0, "recurring" : (0, 0), "itemised" : (0, 0)}
+    iterator = iter(documents)
+
+    writer.writerow(csv_columns)
+    html_file.write(html_head.format("".join(html_th.format(column) for column in report.all_columns)))
+
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if len(batch) == 0:
+            break
+
+        df = pd.DataFrame(batch, columns=["_id", "Name", "Date", "Category", "Amount", "Courtney", "Recurring"])
+        database.typeColumns(df)
+
+        date_fmt     = df["Date"].dt.strftime("%d-%b-%Y")
+        amount_fmt   = money.formatPence(df["Amount"])
+        courtney_fmt = money.formatPence(df["Courtney"])
+
+        writer.writerows(zip(df["_id"], df["Name"], df["Date"].dt.strftime("%Y-%m-%d"), df["Category"],
+                             money.fromPence(df["Amount"]), money.fromPence(df["Courtney"]), df["Recurring"], date_fmt, amount_fmt, courtney_fmt))
+        html_file.write(_htmlRows(zip(df["Name"], date_fmt, df["Category"], amount_fmt, courtney_fmt)))
+
+        # Keep the running totals, in pence so they are exact
+        recurring = df["Recurring"].to_numpy()
+        for key, rows in [("recurring", recurring), ("itemised", ~recurring)]:
+            amount, courtney = totals[key]
+            totals[key]      = (amount + money.sumPence(df["Amount"][rows]), courtney + money.sumPence(df["Courtney"][rows]))
+
+        totals["rows"] += len(df)
+
+    totals["grand"] = (totals["recurring"][0] + totals["itemised"][0], totals["recurring"][1] + totals["itemised"][1])
+
+    rows = []
+    for key, name in [("recurring", "Recurring Expenses Total"), ("itemised", "Itemised Expenses Total"), ("grand", "Grand Total")]:
+        row = report.totalsRow(*totals[key], name)
+        rows.append([row[column] for column in report.all_columns])
+
+    html_file.write(_htmlRows(rows))
+    html_file.write(html_tail)
+
+    return totals
+#------------------------------------------------------------------------------
+
+def exportRange(start, end, col, root=".", size=None):
+    """
+    Export every entery between two dates to export.csv and export.html in
+    root, in date order, streaming them from the database.
+
+    Parameters
+    ----------
+    start : datetime/String
+        The first day of the range, e.g. datetime(2020, 1, 1) or "2020-01-01".
+    end : datetime/String
+        The last day of the range, it is inclusive.
+    col : PyMongo Collection
+        The collection we are querying.
+    root : String, optional
+        The path to the directory the files are saved in.
+    size : Integer, optional
+        The number of documents fetched and written at a time. The default is
+        export.batch_size.
+
+    Returns
+    -------
+    totals : Dictionary
+        The totals, see writeExport.
+
+    """
+    size     = batch_size if size is None else size
+    min_date = pd.Timestamp(start).normalize().to_pydatetime()
+    end_date = (pd.Timestamp(end).normalize() + pd.Timedelta(days=1)).to_pydatetime()
+
+    if end_date <= min_date:
+        raise ValueError("The end of the range is before the start")
+
+    if not os.path.isdir(root):
+        os.makedirs(root)
+
+    # The date index gives them in date order without sorting on the server
+    cursor = col.find({"Date" : {"$gte" : min_date, "$lt" : end_date}}).sort("Date", 1).batch_size(size)
+
+    with open(os.path.join(root, "export.csv"), "w", encoding="utf-8", newline="") as csv_file, \
+         open(os.path.join(root, "export.html"), "w", encoding="utf-8") as html_file:
+        return writeExport(cursor, csv_file, html_file, size)
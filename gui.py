@@ -4,8 +4,8 @@ the software works together.
 """
 
 import os
-import time
 import tkinter
+import concurrent.futures
 import tkinter.filedialog
 import tkinter.messagebox
 import calendar
@@ -13,12 +13,21 @@ import platform
 
 from   datetime             import datetime
 from   tkinter              import ttk
-from   tkinter.font         import Font
-from   tkinter.scrolledtext import ScrolledText
 
-import database
+import lazy
+import cache
+import pools
 import lookup
 
+# These pull in pymongo and pandas, so they are loaded the first time a window
+# uses them (normally on the database thread while connecting), not before
+# the main window can be shown
+database = lazy.LazyModule("database")
+dedup    = lazy.LazyModule("dedup")
+journal  = lazy.LazyModule("journal")
+metrics  = lazy.LazyModule("metrics")
+money    = lazy.LazyModule("money")
+
 #------------------------------------------------------------------------------
 # Global Variables
 #------------------------------------------------------------------------------
@@ -29,23 +38,139 @@ ixpad      = 2
 ypad       = 4
 iypad      = 2
 history    = 10   # How many previous values should we show
+
+# The colours of the states in the log box
+state_colours = {"Saved" : "darkgreen", "Pending" : "darkorange", "Conflict" : "red"}
+poll_ms    = 50   # How often to check on background work (milliseconds)
+sync_ms    = 250  # How often to check what the journal's sync has written (milliseconds)
+
+# The database work is done on a worker thread rather than the Tk main thread, so
+# the windows keep responding while it waits on the network. A single worker
+# runs the jobs in the order they were submitted, so inserts and undos are
+# never reordered.
+executor   = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="database")
+
+# The worker processes a whole year's months are saved with, and a month's
+# views once it is large enough (see report.parallel_rows). Smaller months
+# are written in this process, as a pool costs more than it saves there.
+render_workers = 2
+#------------------------------------------------------------------------------
+
+class Spinner():
+    """
+    A label showing a spinner and a message while background work is
+    running, and nothing once it is finished.
+    """
+    frames = "|/-\\"
+    
+    def __init__(self, parent):
+        self.label    = tkinter.Label(parent, text="", anchor="w")
+        self.messages = []
+        self.frame    = 0
+        
+    def pack(self, **kwargs):
+        self.label.pack(**kwargs)
+        
+    def grid(self, **kwargs):
+        self.label.grid(**kwargs)
+        
+    def start(self, message):
+        self.messages.append(message)
+        if len(self.messages) == 1:
+            self._spin()
+            
+    def stop(self, message):
+        self.messages.remove(message)
+        if len(self.messages) == 0 and self.label.winfo_exists():
+            self.label.config(text="")
+    
+    def _spin(self):
+        if len(self.messages) == 0 or not self.label.winfo_exists():
+            return
+        self.frame = (self.frame + 1) % len(self.frames)
+        self.label.config(text="{} {}...".format(self.frames[self.frame], self.messages[-1]))
+        self.label.after(poll_ms * 2, self._spin)
+#------------------------------------------------------------------------------
+
+def runInBackground(widget, function, *args, on_done=None, on_error=None, spinner=None, message="Working"):
+    """
+    Run a function on the database thread, and hand its result back to the
+    Tk main thread once it is finished. Tk widgets must only be touched from
+    the main thread, so on_done and on_error are called from widget.after,
+    never from the database thread.
+
+    Parameters
+    ----------
+    widget : tkinter widget
+        Any widget in the window the work is for, used to poll for the result.
+    function : Callable
+        The function to run on the database thread.
+    *args
+        The arguments passed to function.
+    on_done : Callable, optional
+        Called with the result of function. The default is None.
+    on_error : Callable, optional
+        Called with the exception if function raises. The default is None,
+        which shows the error in a message box.
+    spinner : Spinner, optional
+        Shows the message while the work is running. The default is None.
+    message : String, optional
+        What the work is doing, for the spinner. The default is "Working".
+
+    Returns
+    -------
+    concurrent.futures.Future
+        The running work.
+
+    """
+    future = executor.submit(function, *args)
+    
+    if spinner is not None:
+        spinner.start(message)
+        
+    def poll():
+        if not future.done():
+            widget.after(poll_ms, poll)
+            return
+        
+        if spinner is not None:
+            spinner.stop(message)
+        
+        # The window was closed while we were waiting
+        if not widget.winfo_exists():
+            return
+        
+        error = future.exception()
+        if error is None:
+            if on_done is not None:
+                on_done(future.result())
+        elif on_error is not None:
+            on_error(error)
+        else:
+            tkinter.messagebox.showerror("Database", "{} failed:\n\n{}".format(message, error))
+    
+    widget.after(poll_ms, poll)
+    
+    return future
 #------------------------------------------------------------------------------
 
 class Document():
     def __init__(self, default_name="", default_day=1, default_category="", default_amount=0, default_courtney=0, default_recurring=False):
+        # The amounts are held as text and read as money.Money, so they are
+        # exact to the penny
+        default_amount   = money.Money.parse(default_amount)
+        default_courtney = money.Money.parse(default_courtney)
+        
         default_fraction = 0.5
-        if default_amount != 0:
-            if default_courtney != 0:
-                default_fraction = default_courtney / default_amount
-            else:
-                default_fraction = 0
+        if default_amount:
+            default_fraction = default_courtney.ratio(default_amount)
             
         self.name         = tkinter.StringVar( value = default_name)
         self.day          = tkinter.IntVar(    value = default_day)
         self.category     = tkinter.StringVar( value = default_category)
-        self.amount       = tkinter.DoubleVar( value = default_amount)
+        self.amount       = tkinter.StringVar( value = str(default_amount))
         self.fraction     = tkinter.DoubleVar( value = default_fraction)
-        self.courtney     = tkinter.DoubleVar( value = default_courtney)
+        self.courtney     = tkinter.StringVar( value = str(default_courtney))
         self.recurring    = tkinter.BooleanVar(value = default_recurring)   
         
     def get_name(self):
@@ -58,13 +183,13 @@ class Document():
         return self.category.get().upper()
     
     def get_amount(self):
-        return self.amount.get()
+        return money.Money.parse(self.amount.get())
     
     def get_fraction(self):
         return self.fraction.get()
     
     def get_courtney(self):
-        return self.courtney.get()
+        return money.Money.parse(self.courtney.get())
     
     def get_recurring(self):
         return self.recurring.get()
@@ -108,17 +233,17 @@ class Document():
         return {"Name"      : self.get_name(),
                 "Date"      : self.get_date(year, month),
                 "Category"  : self.get_category(),
-                "Amount"    : self.get_amount(),
-                "Courtney"  : self.get_courtney(),
+                "Amount"    : self.get_amount().pounds,
+                "Courtney"  : self.get_courtney().pounds,
                 "Recurring" : self.get_recurring()}
 
     def reset(self):
         self.name.set("")
-        self.amount.set(0.0)
+        self.amount.set(str(money.Money()))
         self.fraction.set(0.5)
-        self.courtney.set(0.0)
+        self.courtney.set(str(money.Money()))
         
-    def validate(self, year, month, day_w=None, cat_w=None, name_w=None):
+    def validate(self, year, month, day_w=None, cat_w=None, name_w=None, amount_w=None):
         # Validation: Is the Category in the list, and is the day valid
         max_day = calendar.monthrange(year, lookup.month_str_to_number[month.lower()])[1]
         if self.get_day() < 1 or self.get_day() > max_day:
@@ -139,160 +264,215 @@ class Document():
                 name_w.focus_force()
             return False
         
+        try:
+            self.get_amount()
+            self.get_courtney()
+        except ValueError:
+            tkinter.messagebox.showwarning("Warning!", "The entered amounts must be numbers, e.g. 12.34")
+            if amount_w is not None:
+                amount_w.focus_force()
+            return False
+        
         return True
         
-def log(logbox, message, blank=False, append=None, colour="black", tag_number=0, font="normal", underline=False, show_time=False):
+class LogView():
     """
-    This procedure writes the message to the log box, with various controlable
-    options, for example, the append feild can append font of a different
-    colour to the same line.
-      
-    Parameters
-    ----------
-    logbox : ScrolledText widget object
-        The object that is the ScrolledText widget.
-    message : String
-        The message to qrite to the log box.
-    blank : Boolean, optional
-        If True, then then a blank line is printed to the ScrolledText. The 
-        default is Flase.
-    append : String, optional
-        If this is not None, then this text string is appended to the end of
-        the message string. The font colour is determined by the colour
-        variable, and if underline is True the appended text is underlined.
-        The default is None.
-    colour : String, optional
-        The colour of the appended text. The default is "black". 
-    tag_number : Integer, optional
-        This is a unique ID for the appended text, if two IDs match then the
-        formating of the appended strings will be the same. The default is 0.
-    font : String. optional
-        Is the appended text "normal", "bold" etc. The default is "normal".
-    underline : Boolean, optional
-        Controls the underline of the appended text. The default is False.
-    show_time : Boolean, optional
-        If True, the time will be prepended to the message like so "(HH:MM) ".
-        The default is False.
-    
-    Returns
-    -------
-    None
+    The log of expenses, a table showing a window onto a list of documents
+    kept in memory. Only the rows on screen exist as Treeview items, and
+    they are reused as it scrolls, so a long history or a long session costs
+    no more to show than a short one. Scrolling up past the first row loads
+    the page of older expenses before it, see database.historyPage.
     """
-    _user_message = None
-    _size = 10
-    d_font = Font(family='Consolas', size=_size)
-    if not blank:
-        if show_time:
-            _user_message = "({}) {}".format(time.strftime("%H:%M"), message)
+    columns = [("Name", 420), ("Date", 90), ("Category", 70), ("Amount", 100), ("Courtney", 100), ("Recurring", 70), ("State", 70)]
+    
+    def __init__(self, parent, rows=20, fetch=None, spinner=None):
+        self.frame     = tkinter.Frame(parent)
+        self.tree      = ttk.Treeview(self.frame, columns=[column for column, _ in self.columns], show="headings", height=rows, selectmode="none")
+        self.scrollbar = ttk.Scrollbar(self.frame, orient="vertical", command=self.yview)
+        self.rows      = rows
+        self.fetch     = fetch     # Called with a date on the database thread, returns the page before it
+        self.spinner   = spinner
+        self.docs      = []        # Every row, oldest first
+        self.ids       = set()
+        self.states    = {}        # The state of each row by _id
+        self.first     = 0         # The row at the top of the window
+        self.before    = None      # Where the next older page starts
+        self.loading   = False
+        self.exhausted = fetch is None
+        
+        for column, width in self.columns:
+            self.tree.heading(column, text=column)
+            self.tree.column(column, width=width, stretch=(column == "Name"), anchor="w" if column == "Name" else "center")
+        
+        for state, colour in state_colours.items():
+            self.tree.tag_configure(state, foreground=colour)
+        
+        # The Treeview only ever holds the visible rows, so it cannot scroll
+        # itself, the wheel and the scrollbar move the window instead
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            self.tree.bind(sequence, self._wheel)
+        
+        self.tree.pack(side="left", fill="both", expand=1)
+        self.scrollbar.pack(side="right", fill="y")
+        self._render()
+        
+    def pack(self, **kwargs):
+        self.frame.pack(**kwargs)
+    
+    def _values(self, doc):
+        # Formatted as it is shown, only the rows on screen are formatted
+        amount   = money.Money.parse(doc["Amount"])
+        courtney = money.Money.parse(doc["Courtney"])
+        return (doc["Name"], doc["Date"].strftime("%d-%b-%y"), doc["Category"], money.formatPenceAmount(amount.pence), money.formatPenceAmount(courtney.pence),
+                "Yes" if doc["Recurring"] else "No", self.states.get(doc.get("_id"), "Saved"))
+    
+    def _render(self):
+        # Reuse the items for the rows now in the window, and drop any spare
+        self.first = max(0, min(self.first, len(self.docs) - self.rows))
+        shown      = min(self.rows, len(self.docs) - self.first)
+        
+        for i in range(shown):
+            doc    = self.docs[self.first + i]
+            values = self._values(doc)
+            tags   = (self.states.get(doc.get("_id"), "Saved"),)
+            if self.tree.exists(str(i)):
+                self.tree.item(str(i), values=values, tags=tags)
+            else:
+                self.tree.insert("", "end", iid=str(i), values=values, tags=tags)
+        
+        for i in range(shown, len(self.tree.get_children())):
+            self.tree.delete(str(i))
+        
+        if len(self.docs) > 0:
+            self.scrollbar.set(self.first / len(self.docs), (self.first + shown) / len(self.docs))
         else:
-            _user_message = message
-    else:
-        _user_message = ""
+            self.scrollbar.set(0, 1)
     
-    if font == "bold":
-        font = Font(family='Consolas', weight="bold", size=_size)
-    else:
-        font = d_font
-    
-    # Make the logbox editable
-    logbox.config(state="normal")    
-    # Add some text
-    tag = "{0}".format(tag_number)
-    if append != None:        
-        logbox.insert("end", _user_message,  "default")
-        logbox.insert("end", str(append) + "\n", tag)
-    else:
-        logbox.insert("end", _user_message + "\n", tag)
+    def scroll_to(self, first):
+        """
+        Move the window so first is the top row, loading the older page if
+        that is above the first row we have.
+        """
+        if first < 0:
+            self.load_older()
         
-    logbox.tag_config(tag, foreground=colour, underline=underline, font=font)    
-    logbox.tag_config("default", foreground="black", font=d_font)
-    # Scroll to the end and make the box uneditable
-    logbox.see("end")
-    logbox.config(state="disabled")
-#------------------------------------------------------------------------------
-
-def wipeLog(logbox, start_i="1.0", end_i=tkinter.END):
-    """
-    Clear the ScrolledText logbox.
+        self.first = first
+        self._render()
+    
+    def yview(self, *args):
+        # Called by the scrollbar, with "moveto fraction" or "scroll n units/pages"
+        if args[0] == "moveto":
+            self.scroll_to(int(round(float(args[1]) * len(self.docs))))
+        elif args[0] == "scroll":
+            step = int(args[1]) * (self.rows if args[2] == "pages" else 1)
+            self.scroll_to(self.first + step)
+    
+    def _wheel(self, event):
+        if event.num == 4 or event.delta > 0:
+            self.scroll_to(self.first - 3)
+        else:
+            self.scroll_to(self.first + 3)
+        return "break"
     
-    Parameters
-    ----------
-    logbox : ScrolledText widget object
-        The object that is the ScrolledText widget.
-    start_i : String, optional
-        A tkinter index for the location of the cursor in the ScrolledText
-        wdidget. The default is "1.0".
-    end_i : String, optional
-        A tkinter index for the location of the cursor in the ScrolledText
-        wdidget. The default is tkinter.END.
-
-    Returns
-    -------
-    None
-    """
-    logbox.config(state="normal")
-    logbox.delete(start_i, end_i)
-    logbox.config(state="disabled")
-#------------------------------------------------------------------------------
-
-def logDocument(logbox, doc):
-    """
-    Log a single document from the database.
+    def load_older(self):
+        """
+        Load the page of expenses before the oldest one shown, in the
+        background, unless it is already loading or there are no more.
+        """
+        if self.loading or self.exhausted:
+            return
+        
+        def failed(error):
+            self.loading = False
+            tkinter.messagebox.showerror("Database", "Loading the older values failed:\n\n{}".format(error))
+        
+        self.loading = True
+        runInBackground(self.tree, self.fetch, self.before, on_done=self.add_page, on_error=failed, spinner=self.spinner, message="Loading older values")
+    
+    def add_page(self, docs):
+        """
+        Add a page of older expenses above the rows already shown, leaving
+        the window on the same rows.
 
-    Parameters
-    ----------
-    logbox : tkinter ScrolledText widget
-        The ScrolledText widget we have defined as out log box.
-    doc : dictionary
-        A document in the format the database uses, can be user contructed.
+        Parameters
+        ----------
+        docs : List of dictionaries
+            The expenses, oldest first, from database.historyPage.
 
-    Returns
-    -------
-    None.
+        Returns
+        -------
+        None.
 
-    """
-    # Work out the sinage
-    if doc["Amount"] < 0:
-        sign = "-"
-        amount_val   = -doc["Amount"]
-        courtney_val = -doc["Courtney"]
-    else:
-        sign = " "
-        amount_val   = doc["Amount"]
-        courtney_val = doc["Courtney"]
+        """
+        self.loading = False
+        if len(docs) == 0:
+            self.exhausted = True
+            return
         
-    if doc["Recurring"]:
-        rec = "Yes"
-    else:
-        rec = "No"
-    
-    format_str   = "{:<60} | {:<10s} | {:^8s} | {}£{:>8.2f} | {}£{:8.2f} | {:10s}".format(doc["Name"], doc["Date"].strftime("%d-%b-%y"), doc["Category"], sign, amount_val, sign, courtney_val, rec)
+        self.before = docs[0]["Date"]
+        
+        # Anything entered this session may be in the page as well
+        docs = [doc for doc in docs if doc.get("_id") not in self.ids]
+        self.ids.update(doc.get("_id") for doc in docs)
+        
+        self.docs   = docs + self.docs
+        self.first += len(docs)
+        self._render()
     
-    log(logbox, format_str)
-#--------------------------------------------------------------------------
-
-def logHeader(logbox):
-    """
-    Write the header to the log box.
-
-    Parameters
-    ----------
-    logbox : tkinter ScrolledText widget
-        The ScrolledText widget we have defined as out log box.
+    def append(self, doc, state="Saved"):
+        """
+        Add an expense at the end, and scroll to it.
 
-    Returns
-    -------
-    None.
+        Parameters
+        ----------
+        doc : Dictionary
+            A document in the format the database uses.
+        state : String, optional
+            Whether the document is "Saved" in the database or "Pending" in
+            the journal. The default is "Saved".
 
-    """
-    header = "{:<60} | {:<10s} | {:<8s} | {:<10s} | {:<10s} | {:<10s}".format("Name of Expense", "Date", "Category", "Amount", "Courtney", "Recurring")
-    row    = "-" * len(header)
+        Returns
+        -------
+        None.
 
-    log(logbox, header)
-    log(logbox, row)
-#-------------------------------------------------------------------------- 
+        """
+        if doc.get("_id") not in self.ids:
+            self.docs.append(doc)
+            self.ids.add(doc.get("_id"))
+        
+        self.states[doc.get("_id")] = state
+        self.scroll_to(len(self.docs))
+    
+    def set_state(self, _id, state):
+        """
+        Update the state shown for an expense, e.g. once it is "Saved".
+        """
+        if _id in self.ids:
+            self.states[_id] = state
+            self._render()
+    
+    def remove(self, _id):
+        """
+        Take an expense out of the log, e.g. after it is undone.
+        """
+        if _id in self.ids:
+            self.docs = [doc for doc in self.docs if doc.get("_id") != _id]
+            self.ids.discard(_id)
+            self.states.pop(_id, None)
+            self._render()
+    
+    def clear(self):
+        """
+        Empty the log, the older pages are not loaded again after this.
+        """
+        self.docs      = []
+        self.ids       = set()
+        self.states    = {}
+        self.exhausted = True
+        self._render()
+#------------------------------------------------------------------------------
 
-def expenseEntryFields(frame, collection, year, month, logbox=None, submit=True, row=0, default_name="", default_day=1, default_category="", default_amount=0, default_courtney=0, default_recurring=False):
+def expenseEntryFields(frame, collection, year, month, log_view=None, submit=True, row=0, default_name="", default_day=1, default_category="", default_amount=0, default_courtney=0, default_recurring=False, spinner=None, entries=None, duplicates=None):
     """
     Create the expense data entry row
 
@@ -300,11 +480,25 @@ def expenseEntryFields(frame, collection, year, month, logbox=None, submit=True,
     ----------
     frame : tkinter frame object
         what are we packing the enteries into.
+    log_view : LogView, optional
+        Where the submitted expenses are shown, there are no submit, undo or
+        clear buttons without it. The default is None.
     submit : Boolean, optional
         Are we drawing the submit, undo clear buttons on this row. The 
         default is True.
     row : integer, optional
         What row are the widgets drawn in. The default is 0.
+    spinner : Spinner, optional
+        Shows when a submit or undo is waiting on the database. The default
+        is None.
+    entries : journal.Journal, optional
+        If given, submitted expenses go into this journal straight away and
+        are written to the database in batches by its background sync, rather
+        than waiting for each one to be written. The default is None.
+    duplicates : dedup.DedupIndex, optional
+        If given, each expense is checked against those already entered
+        before it is submitted, and the user asked before a duplicate is
+        added. The default is None.
 
     Returns
     -------
@@ -312,10 +506,10 @@ def expenseEntryFields(frame, collection, year, month, logbox=None, submit=True,
     variables.
 
     """
-    if logbox is None:
+    if log_view is None:
         submit = False
         
-    dp       = 3 # Decimal places
+    dp       = 3 # Decimal places of the fraction
     #--------------------------------------------------------------------------
     # Tkinter Variables
     #--------------------------------------------------------------------------    
@@ -323,29 +517,54 @@ def expenseEntryFields(frame, collection, year, month, logbox=None, submit=True,
     #--------------------------------------------------------------------------
     
     def update_courtney(*args):
-        document.courtney.set(round(document.get_fraction() * document.get_amount(), dp))
+        # Courtney's share to the nearest penny, the amounts are left alone
+        # until they are valid
+        try:
+            document.courtney.set(str(document.get_amount().split(document.get_fraction())))
+        except (ValueError, tkinter.TclError):
+            pass
     #--------------------------------------------------------------------------
     
     def update_fraction(*args):
-        if document.get_amount() != 0:
-            document.fraction.set(round(document.get_courtney() / document.get_amount(), dp))
+        try:
+            amount, courtney = document.get_amount(), document.get_courtney()
+        except ValueError:
+            return
+        
+        if amount:
+            document.fraction.set(round(courtney.ratio(amount), dp))
         else:
             document.fraction.set(0.5)
     #--------------------------------------------------------------------------
        
     def submit_expense(expenses):
-        if not document.validate(year.get(), month.get(), day_w, cat_w, name_w):
+        if not document.validate(year.get(), month.get(), day_w, cat_w, name_w, amount_w):
             return
             
         doc = document.get_document(year.get(), month.get())
         
-        # Submit document to database
-        expenses.insert_one(doc)
+        # A set lookup, the hashes are loaded with the window. Offline there
+        # are none, but the hash still stops a duplicate once it is synced.
+        if duplicates is not None and duplicates.ready() and duplicates.seen(doc):
+            if not tkinter.messagebox.askyesno("Duplicate", "`{}` for {} on {} has already been entered.\n\nAdd it again?".format(doc["Name"], money.formatPenceAmount(money.Money.parse(doc["Amount"]).pence), doc["Date"].strftime("%d-%b-%Y"))):
+                return
+            doc["Duplicate"] = True
+        elif duplicates is not None or entries is not None:
+            doc[dedup.hash_field] = dedup.expenseHash(doc)
+        
+        if duplicates is not None:
+            duplicates.add([doc])
         
-        # Update the most recent enteries   
-        logDocument(logbox, doc)
+        if entries is None:
+            # Submit document to database, and update the most recent
+            # enteries once it is in
+            runInBackground(frame, database.insertExpenses, expenses, [doc], on_done=lambda result: log_view.append(doc), spinner=spinner, message="Saving {}".format(doc["Name"]))
+        else:
+            # Into the journal, it is written to the database with the next batch
+            doc = entries.append(doc)
+            log_view.append(doc, "Pending")
         
-        # Reset the values
+        # Reset the values, ready for the next one
         document.reset()
         
         # Move the focus back to the name field
@@ -353,17 +572,50 @@ def expenseEntryFields(frame, collection, year, month, logbox=None, submit=True,
     #--------------------------------------------------------------------------    
         
     def remove_last_expense(expenses):
-        # _id include date submitted, hence able to retreive the last item
-        doc = list(expenses.find().sort("_id", -1).limit(1))[0]
-        expenses.delete_one({"_id" : doc["_id"]})
+        def remove():
+            # If it has not been written yet, just take it out of the journal
+            doc = None if entries is None else entries.discard_last()
+            
+            if doc is None:
+                if expenses is None:
+                    raise RuntimeError("Offline, only the expenses not yet written to the database can be undone")
+                
+                # _id include date submitted, hence able to retreive the last item
+                doc = list(expenses.find().sort("_id", -1).limit(1))[0]
+                database.deleteExpense(expenses, doc)
+            
+            if duplicates is not None:
+                duplicates.discard(doc)
+            
+            return doc
         
-        # Remove it from the logbox        
-        wipeLog(logbox, "end-2l", "end-1l")
+        # Remove it from the log once it is gone
+        runInBackground(frame, remove, on_done=lambda doc: log_view.remove(doc["_id"]), spinner=spinner, message="Undoing")
     #--------------------------------------------------------------------------
     
     def clear_log():
-        wipeLog(logbox)
-        logHeader(logbox)
+        log_view.clear()
+    #--------------------------------------------------------------------------
+    
+    def sync_timer(updates):
+        # Show what the journal's background sync has written, the rows stay
+        # pending while the server cannot be reached
+        if not frame.winfo_exists():
+            entries.unsubscribe(updates)
+            return
+        
+        conflicts = 0
+        while not updates.empty():
+            state, ids = updates.get_nowait()
+            for _id in ids:
+                log_view.set_state(_id, state)
+            if state == "Conflict":
+                conflicts += len(ids)
+        
+        if conflicts > 0:
+            tkinter.messagebox.showwarning("Conflict", "{} expenses could not be written to the database, as they clash with expenses already there.\n\nThey are kept in {}".format(conflicts, entries.conflicts_path))
+        
+        frame.after(sync_ms, sync_timer, updates)
     #--------------------------------------------------------------------------
     
     # The fields
@@ -437,6 +689,9 @@ def expenseEntryFields(frame, collection, year, month, logbox=None, submit=True,
         # Clear Log button
         clear_bt = tkinter.Button(frame, text="Clear Log", command=clear_log)
         clear_bt.grid(row=2, column=9, columnspan=2, sticky="nesw", padx=xpad, pady=ypad,ipadx=ixpad, ipady=iypad)
+        
+        if entries is not None:
+            frame.after(sync_ms, sync_timer, entries.subscribe())
 
     # Move the focus back to the name field
     name_w.focus_force()
@@ -444,12 +699,19 @@ def expenseEntryFields(frame, collection, year, month, logbox=None, submit=True,
     return document
 #------------------------------------------------------------------------------
 
-def enterExpense(address, port):
+def enterExpense(address, port, offline=False):
     """
     This is the procedure that defines the GUI for entering new expenses into 
     the database. It contains sub-procedures to complete all of the necessary
     actions.
 
+    Parameters
+    ----------
+    offline : Boolean, optional
+        The server cannot be reached, so the expenses are only entered into
+        the journal, to be written once it can be. There are no previous
+        values or duplicate checks. The default is False.
+
     Returns
     -------
     None.
@@ -458,7 +720,12 @@ def enterExpense(address, port):
     #--------------------------------------------------------------------------
     # Load the database
     #--------------------------------------------------------------------------
-    expenses = database.openCollection(address, port)
+    entries = journal.openJournal(address, port)
+    if offline:
+        expenses, duplicates = None, None
+    else:
+        expenses   = database.openCollection(address, port)
+        duplicates = dedup.openIndex(address, port)
 
     #--------------------------------------------------------------------------
     # Tkinter Variables
@@ -471,7 +738,7 @@ def enterExpense(address, port):
     expense_window = tkinter.Toplevel()
     addIcon(expense_window)
     expense_window.focus_set()
-    expense_window.title("Expense")
+    expense_window.title("Expense (offline)" if offline else "Expense")
     expense_window.minsize(width=min_width, height=min_height)
     expense_window.resizable(width=True, height=True)
     
@@ -485,14 +752,20 @@ def enterExpense(address, port):
     month_w.pack(side="left", anchor="w", padx=xpad, ipadx=ixpad)
     year_w.pack(side="left", anchor="w", padx=xpad, ipadx=ixpad)
     
+    # Shows when we are waiting on the database
+    spinner = Spinner(month_frame)
+    spinner.pack(side="left", anchor="w", padx=xpad, ipadx=ixpad)
+    
     #--------------------------------------------------------------------------
     # Previous Values Log
     #--------------------------------------------------------------------------
     log_frame = tkinter.LabelFrame(expense_window, text="Previous Values")
     
-    # ScrolledText log box
-    logbox = ScrolledText(log_frame, undo=True, borderwidth=3, wrap="word", width=110, state="disabled")
-    logbox.pack(fill="both", expand=1, side="top", padx=xpad, pady=ypad)
+    # Pages back through the older expenses as it is scrolled up, offline
+    # there are none
+    fetch    = None if offline else lambda before: database.historyPage(expenses, before, history)
+    log_view = LogView(log_frame, fetch=fetch, spinner=spinner)
+    log_view.pack(fill="both", expand=1, side="top", padx=xpad, pady=ypad)
     
     #--------------------------------------------------------------------------
     # The Expense Frame
@@ -500,35 +773,48 @@ def enterExpense(address, port):
     expense_values = tkinter.LabelFrame(expense_window, text="Itemised Expense")
     expense_values.pack(side="top", anchor="nw", padx=xpad, pady=ypad,ipadx=ixpad, ipady=iypad)
     
-    expenseEntryFields(expense_values, expenses, year, month, logbox)
+    expenseEntryFields(expense_values, expenses, year, month, log_view, spinner=spinner, entries=entries, duplicates=duplicates)
     
     # Pack the log frame
     log_frame.pack(side="top", anchor="nw", padx=xpad, pady=ypad,ipadx=ixpad, ipady=iypad)
     
-    #--------------------------------------------------------------------------
-    # Fill the log frame
-    #--------------------------------------------------------------------------
-    # Header
-    logHeader(logbox)
-
     #--------------------------------------------------------------------------
     # Initial Enteries
     #--------------------------------------------------------------------------
-    # Find last date entered, if "# documents < history" list all dates until history length is reached
-    last_docs = expenses.find({"Recurring" : False}).sort("Date", -1).limit(history)
-    dates = list(set([doc["Date"] for doc in last_docs]))
-
-    for doc in expenses.find({"Date" : {"$in" : dates}, "Recurring" : False}).sort("Date", 1):
-        logDocument(logbox, doc)
+    def load_history():
+        if offline:
+            return []
+        
+        # Load the duplicate hashes now, the journal's are not written yet
+        duplicates.load()
+        duplicates.add(entries.waiting())
+        
+        return database.historyPage(expenses, None, history)
+    
+    def show_history(docs):
+        log_view.add_page(docs)
+        
+        # Anything left in the journal from last time is still to be written
+        for doc in entries.waiting():
+            log_view.append(doc, "Pending")
+    
+    runInBackground(expense_window, load_history, on_done=show_history, spinner=spinner, message="Loading previous values")
 #------------------------------------------------------------------------------
 
-def enterRecurringExpenses(address, port):
+def enterRecurringExpenses(address, port, offline=False):
     """
     This is the procedure that defines the GUI for entering a new months 
     recurring expenses into the database. It looks up the previous months
     recurring expenses to populate the current month. It contains
     sub-procedures to complete all of the necessary actions.
 
+    Parameters
+    ----------
+    offline : Boolean, optional
+        The server cannot be reached, so last month is not looked up and the
+        expenses go into the journal, to be written once it can be. The
+        default is False.
+
     Returns
     -------
     None.
@@ -557,14 +843,38 @@ def enterRecurringExpenses(address, port):
                 tkinter.messagebox.showerror("Failed", "The reccuring expense `{}` contains errors. Please fix them before continuing.".format(document.get_name()))
                 return
             
-        for document in documents:
-            doc = document.get_document(year.get(), month.get())
-            expenses.insert_one(doc)
-
+        docs = [document.get_document(year.get(), month.get()) for document in documents]
+        
+        def journalled():
+            # The journal's background sync writes them once it can
+            entries.append_recurring(docs)
+            tkinter.messagebox.showinfo("Saved Offline", "The reccuring expenses are saved on this computer, and will be added once the database can be reached.")
         
-        tkinter.messagebox.showinfo("Complete", "The reccuring expenses have been added.")
+        if offline:
+            journalled()
+            return
+        
+        def failed(error):
+            if tkinter.messagebox.askyesno("Failed", "Saving the reccuring expenses failed:\n\n{}\n\nSave them on this computer, to be added once the database can be reached?".format(error)):
+                journalled()
+        
+        def done(result):
+            # Updated expenses keep their _ids, so the cached months cannot
+            # tell they have changed
+            if result.modified_count > 0:
+                cache.openCache(address, port).clear()
+            
+            tkinter.messagebox.showinfo("Complete", "The reccuring expenses have been added.\n\n"
+                                        "{} new, {} updated, {} already up to date.".format(result.upserted_count, result.modified_count, result.matched_count - result.modified_count))
+        
+        # All in one write, resubmitting the month updates rather than duplicates
+        runInBackground(frame, database.insertRecurring, expenses, docs, on_done=done, on_error=failed, spinner=spinner, message="Saving recurring expenses")
         
     def populate_expenses(collection, frame, year, month, documents):
+        # Offline last month cannot be looked up, they are added by hand
+        if offline:
+            return
+        
         last_month_i = lookup.month_str_to_number[month.get().lower()] - 1
         last_year_i  = year.get()
         if last_month_i == 0:
@@ -579,20 +889,21 @@ def enterRecurringExpenses(address, port):
         # Build the query    
         query = {"Recurring" : True, "Date" : {"$lte" : max_date, "$gte" : min_date}}
 
-        # Find recurring expenses from the last month, and sort by date
-        reccuring_docs = expenses.find(query).sort("Date", 1)
-    
+        def show_expenses(reccuring_docs):
+            for i, doc in enumerate(reccuring_docs):
+                 document = expenseEntryFields(expense_values, expenses, year, month, row=i*2, submit=False,
+                                               default_name=doc["Name"],
+                                               default_day=doc["Date"].day,
+                                               default_category=doc["Category"],
+                                               default_amount=doc["Amount"],
+                                               default_courtney=doc["Courtney"],
+                                               default_recurring=doc["Recurring"])
+                
+                 documents.append(document)        
 
-        for i, doc in enumerate(reccuring_docs):
-             document = expenseEntryFields(expense_values, expenses, year, month, row=i*2, submit=False,
-                                           default_name=doc["Name"],
-                                           default_day=doc["Date"].day,
-                                           default_category=doc["Category"],
-                                           default_amount=doc["Amount"],
-                                           default_courtney=doc["Courtney"],
-                                           default_recurring=doc["Recurring"])
-            
-             documents.append(document)        
+        # Find recurring expenses from the last month, and sort by date
+        runInBackground(frame, lambda: list(expenses.find(query).sort("Date", 1)), on_done=show_expenses,
+                        spinner=spinner, message="Loading last month's expenses")
 
     def refresh_expenses(collection, frame, year, month, documents):
         # Remove enteries first
@@ -608,7 +919,8 @@ def enterRecurringExpenses(address, port):
     #--------------------------------------------------------------------------
     # Load the database
     #--------------------------------------------------------------------------
-    expenses = database.openCollection(address, port)
+    expenses = None if offline else database.openCollection(address, port)
+    entries  = journal.openJournal(address, port)
     
     #--------------------------------------------------------------------------
     # Tkinter Variables
@@ -621,7 +933,7 @@ def enterRecurringExpenses(address, port):
     expense_window = tkinter.Toplevel()
     addIcon(expense_window)
     expense_window.focus_set()
-    expense_window.title("Recurring Expenses")
+    expense_window.title("Recurring Expenses (offline)" if offline else "Recurring Expenses")
     expense_window.minsize(width=min_width, height=min_height)
     expense_window.resizable(width=True, height=True)
     
@@ -638,6 +950,10 @@ def enterRecurringExpenses(address, port):
     year_w      = ttk.Entry(month_frame, textvariable=year, width=5)
     month_w.pack(side="left", anchor="w", padx=xpad, ipadx=ixpad)
     year_w.pack( side="left", anchor="w", padx=xpad, ipadx=ixpad)
+    
+    # Shows when we are waiting on the database
+    spinner = Spinner(top_frame)
+    spinner.grid(row=0, column=2, sticky="w", padx=xpad, pady=ypad,ipadx=ixpad, ipady=iypad)
         
     #--------------------------------------------------------------------------
     # The Expense Frame
@@ -675,6 +991,42 @@ def enterRecurringExpenses(address, port):
     submit_bt.pack(side="left", anchor="w", padx=xpad, pady=ypad,ipadx=ixpad, ipady=iypad)
 #------------------------------------------------------------------------------
 
+def showMetrics(parent, run_metrics):
+    """
+    Show where the time went in a run, with the stage timers, MongoDB
+    commands and counters from metrics, and let them be saved.
+
+    Parameters
+    ----------
+    parent : tkinter widget
+        The window the run was started from.
+    run_metrics : Dictionary
+        The snapshot of what the run recorded, see metrics.collect.
+
+    Returns
+    -------
+    None.
+
+    """
+    def save():
+        file_path = tkinter.filedialog.asksaveasfilename(parent=window, defaultextension=".json",
+                                                         filetypes=[("JSON", "*.json"), ("Prometheus text", "*.prom")])
+        if file_path:
+            metrics.saveMetrics(file_path, run_metrics)
+    
+    window = tkinter.Toplevel(parent)
+    addIcon(window)
+    window.title("Query Metrics")
+    
+    text = tkinter.Text(window, width=60, height=30, font=("Courier", 10))
+    text.insert("end", metrics.formatMetrics(run_metrics))
+    text.config(state="disabled")
+    text.pack(side="top", fill="both", expand=1, padx=xpad, pady=ypad)
+    
+    save_bt = tkinter.Button(window, text="Save", command=save)
+    save_bt.pack(side="top", anchor="e", padx=xpad, pady=ypad, ipadx=ixpad, ipady=iypad)
+#------------------------------------------------------------------------------
+
 def monthQuery(address, port):
     """
     This defines the GUI for the user to complete a query for a specific month.
@@ -685,12 +1037,35 @@ def monthQuery(address, port):
 
     """
     def do_query(expenses):
-        df, str_ym = database.getMonthSummary(month.get(), year.get(), expenses)
-        database.saveDF(df, os.path.join(path.get(), str_ym))
+        # Read the variables here, they cannot be used from the database thread
+        _month, _year, _path, _whole_year = month.get(), year.get(), path.get(), whole_year.get()
         
-        tkinter.messagebox.showinfo("Complete", "The querys have been saved to file.")
+        def query():
+            # Just what this run did, not the journal sync or other windows
+            with metrics.collect() as run:
+                if _whole_year:
+                    # One query for the year, saved month by month with the rollup
+                    df, summaries = database.getRangeSummary("{}-01".format(_year), "{}-12".format(_year), expenses, cache=summaries_cache)
+                    database.saveRange(df, summaries, os.path.join(_path, str(_year)), incremental=True, workers=render_workers)
+                else:
+                    df, str_ym = database.getMonthSummary(_month, _year, expenses, cache=summaries_cache)
+                    database.saveDF(df, os.path.join(_path, str_ym), incremental=True, workers=render_workers)
+            
+            return run.snapshot()
         
-        query_window.focus_force()
+        def done(run_metrics):
+            submit_bt.config(state="normal")
+            if show_metrics.get():
+                showMetrics(query_window, run_metrics)
+            tkinter.messagebox.showinfo("Complete", "The querys have been saved to file.")
+            query_window.focus_force()
+        
+        def failed(error):
+            submit_bt.config(state="normal")
+            tkinter.messagebox.showerror("Failed", "The query failed:\n\n{}".format(error))
+        
+        submit_bt.config(state="disabled")
+        runInBackground(query_window, query, on_done=done, on_error=failed, spinner=spinner, message="Running query")
 
     def browse_folder():
         path.set(tkinter.filedialog.askdirectory())
@@ -700,7 +1075,8 @@ def monthQuery(address, port):
     #--------------------------------------------------------------------------
     # Load the database
     #--------------------------------------------------------------------------
-    expenses = database.openCollection(address, port)
+    expenses        = database.openCollection(address, port)
+    summaries_cache = cache.openCache(address, port)
     
     #--------------------------------------------------------------------------
     # Tkinter Variables
@@ -709,6 +1085,8 @@ def monthQuery(address, port):
     month        = tkinter.StringVar(value=current_date.strftime("%b"))
     year         = tkinter.IntVar(value=current_date.year)
     path         = tkinter.StringVar(value=os.path.abspath(os.path.join("..", "data")))
+    whole_year   = tkinter.BooleanVar(value=False)
+    show_metrics = tkinter.BooleanVar(value=False)
     #--------------------------------------------------------------------------
     
     query_window = tkinter.Toplevel()
@@ -725,6 +1103,9 @@ def monthQuery(address, port):
     month_w     = ttk.Combobox(month_frame, values=lookup.months_list, textvariable=month, width=5)
     year_w      = ttk.Entry(month_frame, textvariable=year, width=5)
     
+    year_all_w  = tkinter.Checkbutton(month_frame, text="Whole Year", variable=whole_year, onvalue=True, offvalue=False)
+    metrics_w   = tkinter.Checkbutton(month_frame, text="Show Metrics", variable=show_metrics, onvalue=True, offvalue=False)
+    
     # Submit Button
     submit_bt = tkinter.Button(month_frame, text="Submit", command=lambda:do_query(expenses))
 
@@ -732,8 +1113,13 @@ def monthQuery(address, port):
     month_frame.pack(side="top", anchor="nw", padx=xpad, pady=ypad,ipadx=ixpad, ipady=iypad)
     month_w.pack(side="left", anchor="w", padx=xpad, ipadx=ixpad)
     year_w.pack(side="left", anchor="w", padx=xpad, ipadx=ixpad)
+    year_all_w.pack(side="left", anchor="w", padx=xpad, ipadx=ixpad)
+    metrics_w.pack(side="left", anchor="w", padx=xpad, ipadx=ixpad)
     submit_bt.pack(side="left", anchor="w", padx=xpad, ipadx=ixpad)
     
+    # Shows when the query is running
+    spinner = Spinner(month_frame)
+    spinner.pack(side="left", anchor="w", padx=xpad, ipadx=ixpad)
     
     save_frame = tkinter.LabelFrame(query_window, text="Save Location")
     save_frame.pack(side="top", anchor="nw", padx=xpad, pady=ypad,ipadx=ixpad, ipady=iypad)
@@ -769,6 +1155,29 @@ def openApp(message):
     """
     def about():
         tkinter.messagebox.showinfo("About", message)
+    
+    def open_window(window):
+        address, port = db_address.get(), db_port.get()
+        
+        def connect():
+            # Ping the server and make sure the indexes exist, so opening the
+            # window does not have to wait on the network
+            if not database.checkClient(address, port):
+                return False
+            database.openCollection(address, port)
+            return True
+        
+        def connected(ok):
+            # Only open the window if the database can be reached, or the
+            # window can work offline and the user wants to
+            if ok:
+                window(address, port)
+            elif window not in offline_windows:
+                tkinter.messagebox.showerror("Database", "Cannot connect to the database at {}:{}".format(address, port))
+            elif tkinter.messagebox.askyesno("Database", "Cannot connect to the database at {}:{}\n\nWork offline? The expenses are kept on this computer and added once the database can be reached.".format(address, port)):
+                window(address, port, offline=True)
+        
+        runInBackground(top, connect, on_done=connected, spinner=spinner, message="Connecting to {}".format(address))
         
     top = tkinter.Tk()
     
@@ -792,20 +1201,34 @@ def openApp(message):
     db_add_entry.pack(side="left", anchor="w", padx=xpad, ipadx=ixpad)
     db_port_entry.pack(side="left", anchor="w", padx=xpad, ipadx=ixpad)
     
+    # Shows when we are connecting
+    spinner = Spinner(db_frame)
+    spinner.pack(side="left", anchor="w", padx=xpad, ipadx=ixpad)
+    
     # Buttons
     master_buttons = tkinter.LabelFrame(top, text="Operations")
     master_buttons.pack(side="top", anchor="nw", padx=xpad, pady=ypad,ipadx=ixpad, ipady=iypad)
     
-    enter_bt  = tkinter.Button(master_buttons, text="Enter Expense", command=lambda:enterExpense(db_address.get(), db_port.get()))
+    enter_bt  = tkinter.Button(master_buttons, text="Enter Expense", command=lambda:open_window(enterExpense))
     enter_bt.pack(side="left", padx=xpad, pady=ypad,ipadx=ixpad, ipady=iypad)
     
-    enter_rec_bt = tkinter.Button(master_buttons, text="Enter Recurring Expenses", command=lambda:enterRecurringExpenses(db_address.get(), db_port.get()))
+    enter_rec_bt = tkinter.Button(master_buttons, text="Enter Recurring Expenses", command=lambda:open_window(enterRecurringExpenses))
     enter_rec_bt.pack(side="left", padx=xpad, pady=ypad,ipadx=ixpad, ipady=iypad)
     
-    mquery_bt = tkinter.Button(master_buttons, text="Month Query", command=lambda:monthQuery(db_address.get(), db_port.get()))
+    mquery_bt = tkinter.Button(master_buttons, text="Month Query", command=lambda:open_window(monthQuery))
     mquery_bt.pack(side="left", padx=xpad, pady=ypad,ipadx=ixpad, ipady=iypad)
        
     mquery_bt = tkinter.Button(top, text="About", command=about)
     mquery_bt.pack(side="top", anchor="nw", padx=xpad, pady=ypad,ipadx=ixpad, ipady=iypad)
     
-    top.mainloop()
\ No newline at end of file
+    # The windows which can enter expenses into the journal without the server
+    offline_windows = (enterExpense, enterRecurringExpenses)
+    
+    top.mainloop()
+    
+    # Let any database work still running finish, make a last attempt at
+    # writing the journals, then close the shared database connections
+    executor.shutdown(wait=True)
+    pools.closePools()
+    journal.flushAll()
+    database.closeClients()
\ No newline at end of file
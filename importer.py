@@ -0,0 +1,367 @@
+"""
+Import bank statements, exported as CSV or OFX, into the database without the
+gui. The statement is read in chunks, each transaction is given a category
+by matching its name against a table of rules, and each chunk is written to
+the database in a single bulk insert.
+"""
+
+import re
+import csv
+import time
+
+import numpy  as np
+import pandas as pd
+
+import dedup
+import lookup
+import money
+import database
+
+#------------------------------------------------------------------------------
+# Global Variables
+#------------------------------------------------------------------------------
+chunk_size       = 10000
+default_category = "MISC"
+
+# (pattern, category) pairs, a pattern is a regular expression matched
+# anywhere in the name ignoring case. When several match, the one earliest in
+# the name wins, then the one earliest in this list.
+default_rules = [(r"\btesco\b|\bsainsbury'?s?\b|\basda\b|\baldi\b|\blidl\b|\bmorrisons\b|\bwaitrose\b|\bco-?op\b|\bocado\b", "GROC"),
+                 (r"\bshell\b|\besso\b|\bbp\b|\btexaco\b|\bpetrol\b|\bfuel\b",                                                   "FUEL"),
+                 (r"\bdeliveroo\b|\bjust ?eat\b|\buber ?eats\b|\bdomino'?s\b|\btakeaway\b",                                       "TAKE"),
+                 (r"\brestaurant\b|\bcafe\b|\bcosta\b|\bstarbucks\b|\bpret\b|\bpub\b|\bnando'?s\b",                               "EAT"),
+                 (r"\bnetflix\b|\bspotify\b|\bdisney\b|\bprime video\b|\bsubscription\b",                                         "SUB"),
+                 (r"\bvodafone\b|\bee limited\b|\bo2\b|\bthree\b|\bgiffgaff\b",                                                   "PHON"),
+                 (r"\bmortgage\b",                                                                                                "MORT"),
+                 (r"\bbritish gas\b|\boctopus\b|\bedf\b|\bcouncil tax\b|\bwater\b|\btv licen[cs]e\b",                             "BILL"),
+                 (r"\bvets?\b|\bveterinary\b",                                                                                    "VET"),
+                 (r"\bpets at home\b|\bpet\b",                                                                                    "PETS"),
+                 (r"\bdvla\b|\bkwik fit\b|\bhalfords\b|\bparking\b",                                                              "CAR"),
+                 (r"\bikea\b|\bb ?& ?q\b|\bwickes\b|\bdunelm\b|\bscrewfix\b",                                                     "HOME"),
+                 (r"\bboots\b|\bsuperdrug\b|\bbarbers?\b|\bhairdress",                                                            "PERS"),
+                 (r"\brefund\b|\bcashback\b",                                                                                     "REB")]
+
+# The column names banks use for each field, in lower case
+csv_columns = {"date"   : ["date", "transaction date", "posted date", "posting date", "value date"],
+               "name"   : ["description", "name", "payee", "details", "memo", "transaction description"],
+               "amount" : ["amount", "value", "transaction amount"],
+               "debit"  : ["debit", "debit amount", "paid out", "money out", "out"],
+               "credit" : ["credit", "credit amount", "paid in", "money in", "in"]}
+
+# An OFX statement transaction, and the fields used from it
+ofx_transaction = re.compile(r"<STMTTRN>(.*?)</STMTTRN>", re.IGNORECASE | re.DOTALL)
+ofx_field       = re.compile(r"<(DTPOSTED|TRNAMT|NAME|MEMO)>([^<\r\n]*)", re.IGNORECASE)
+#------------------------------------------------------------------------------
+
+class RuleTable():
+    """
+    A table of categorisation rules compiled into a single regular
+    expression, with one named group per rule, so a whole column of names is
+    categorised in one pass.
+    """
+    def __init__(self, rules=None, default=None):
+        rules = default_rules if rules is None else rules
+
+        for _, category in rules:
+            if category not in lookup.valid_categories:
+                raise ValueError("The category `{}` is not valid".format(category))
+
+        self.rules      = list(rules)
+        self.default    = default_category if default is None else default
+        self.categories = np.array([category for _, category in self.rules] + [self.default], dtype=object)
+
+        # Check each pattern on its own first, so a bad one is reported by name
+        for pattern, _ in self.rules:
+            re.compile(pattern)
+
+        self.pattern = "|".join("(?P<r{}>{})".format(i, pattern) for i, (pattern, _) in enumerate(self.rules))
+        self.regex   = re.compile(self.pattern, re.IGNORECASE)
+
+    def categorise(self, names):
+        """
+        Give each name the category of the first rule it matches.
+
+        Parameters
+        ----------
+        names : Pandas Series of Strings
+            The names of the transactions.
+
+        Returns
+        -------
+        Pandas Series of Strings
+            The category of each name, the default where no rule matches.
+
+        """
+        if len(self.rules) == 0:
+            return pd.Series(self.default, index=names.index, dtype=object)
+
+        groups  = ["r{}".format(i) for i in range(len(self.rules))]
+        matches = names.fillna("").astype(str).str.extract(self.regex, expand=True)[groups].notna().to_numpy()
+
+        # The first rule to match, or the default after the last rule
+        first = np.where(matches.any(axis=1), matches.argmax(axis=1), len(self.rules))
+
+        return pd.Series(self.categories[first], index=names.index, dtype=object)
+#------------------------------------------------------------------------------
+
+def loadRules(path):
+    """
+    Load a rule table from a CSV file, with a "pattern" and a "category"
+    column, one rule per row in the order they are tried.
+
+    Parameters
+    ----------
+    path : String
+        The path to the file.
+
+    Returns
+    -------
+    RuleTable
+
+    """
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        rules = [(row["pattern"], row["category"].strip().upper()) for row in csv.DictReader(f)]
+
+    return RuleTable(rules)
+#------------------------------------------------------------------------------
+
+def _findColumn(columns, field):
+    """
+    Return the name of the column holding a field, None if there is not one.
+    """
+    lower = {column.strip().lower() : column for column in columns}
+    for name in csv_columns[field]:
+        if name in lower:
+            return lower[name]
+
+    return None
+#------------------------------------------------------------------------------
+
+def _amounts(values):
+    """
+    Read a column of amounts as written in a statement, e.g. "1,234.50",
+    "£12.00" or blank, into pence.
+    """
+    if not pd.api.types.is_numeric_dtype(values):
+        values = pd.to_numeric(values.astype(str).str.replace(r"[£,\s]", "", regex=True), errors="coerce")
+
+    return money.toPence(values.fillna(0))
+#------------------------------------------------------------------------------
+
+def _dates(values):
+    """
+    Read a column of dates as written in a statement. ISO dates (2022-03-01)
+    are read as they are, anything else is read day first as UK banks write
+    them (01/03/2022).
+    """
+    values = values.astype(str).str.strip()
+    if len(values) > 0 and re.match(r"\d{4}-\d{1,2}-\d{1,2}", values.iloc[0]):
+        return pd.to_datetime(values, format="ISO8601")
+
+    return pd.to_datetime(values, dayfirst=True)
+#------------------------------------------------------------------------------
+
+def readCSV(path, size=None):
+    """
+    Read a bank statement exported as CSV, a chunk at a time. The date,
+    name and amount columns are found from their headings; banks that split
+    the amount into paid out and paid in columns are handled too.
+
+    Parameters
+    ----------
+    path : String
+        The path to the file.
+    size : Integer, optional
+        The number of rows in each chunk. The default is importer.chunk_size.
+
+    Yields
+    ------
+    Pandas DataFrame
+        With "Date" (datetime64), "Name" and "Amount" (pence, money out is
+        positive, the same as an expense).
+
+    """
+    size = chunk_size if size is None else size
+
+    with pd.read_csv(path, chunksize=size, dtype=str, keep_default_na=False, skipinitialspace=True) as reader:
+        for chunk in reader:
+            date   = _findColumn(chunk.columns, "date")
+            name   = _findColumn(chunk.columns, "name")
+            amount = _findColumn(chunk.columns, "amount")
+            debit  = _findColumn(chunk.columns, "debit")
+            credit = _findColumn(chunk.columns, "credit")
+
+            if date is None or name is None or (amount is None and debit is None and credit is None):
+                raise ValueError("`{}` does not have date, description and amount columns".format(path))
+
+            # Money out is negative on a statement, but positive as an expense
+            if amount is not None:
+                pence = -_amounts(chunk[amount])
+            else:
+                pence = np.zeros(len(chunk), dtype=np.int64)
+                if debit is not None:
+                    pence = pence + np.abs(_amounts(chunk[debit]))
+                if credit is not None:
+                    pence = pence - np.abs(_amounts(chunk[credit]))
+
+            yield pd.DataFrame({"Date"   : _dates(chunk[date]),
+                                "Name"   : chunk[name].str.strip(),
+                                "Amount" : np.asarray(pence, dtype=np.int64)})
+#------------------------------------------------------------------------------
+
+def readOFX(path, size=None):
+    """
+    Read a bank statement exported as OFX (or QFX), a chunk at a time.
+
+    Parameters
+    ----------
+    path : String
+        The path to the file.
+    size : Integer, optional
+        The number of transactions in each chunk. The default is
+        importer.chunk_size.
+
+    Yields
+    ------
+    Pandas DataFrame
+        In the same layout as readCSV.
+
+    """
+    size = chunk_size if size is None else size
+
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        text = f.read()
+
+    rows = []
+    for transaction in ofx_transaction.finditer(text):
+        fields = {key.upper() : value.strip() for key, value in ofx_field.findall(transaction.group(1))}
+        rows.append((fields.get("DTPOSTED", "")[:8], fields.get("NAME") or fields.get("MEMO", ""), fields.get("TRNAMT", "")))
+
+        if len(rows) == size:
+            yield _ofxFrame(rows)
+            rows = []
+
+    if len(rows) > 0:
+        yield _ofxFrame(rows)
+#------------------------------------------------------------------------------
+
+def _ofxFrame(rows):
+    """
+    Build a chunk from (date, name, amount) strings read from an OFX file.
+    """
+    dates, names, amounts = zip(*rows)
+
+    return pd.DataFrame({"Date"   : pd.to_datetime(pd.Series(dates), format="%Y%m%d"),
+                         "Name"   : pd.Series(names, dtype=object),
+                         "Amount" : -_amounts(pd.Series(amounts, dtype=object))})
+#------------------------------------------------------------------------------
+
+def toDocuments(chunk, rules, fraction=0.0):
+    """
+    Categorise a chunk of transactions and turn it into documents in the
+    format the database uses.
+
+    Parameters
+    ----------
+    chunk : Pandas DataFrame
+        From readCSV or readOFX.
+    rules : RuleTable
+        The rules used to categorise the names.
+    fraction : Float, optional
+        The fraction of each amount that is Courtney's. The default is 0.
+
+    Returns
+    -------
+    List of dictionaries
+
+    """
+    courtney = money.splitPence(chunk["Amount"], fraction)
+
+    df = pd.DataFrame({"Name"      : chunk["Name"].to_numpy(dtype=object),
+                       "Date"      : chunk["Date"].to_numpy(),
+                       "Category"  : rules.categorise(chunk["Name"]).to_numpy(),
+                       "Amount"    : money.fromPence(chunk["Amount"].to_numpy()),
+                       "Courtney"  : money.fromPence(courtney),
+                       "Recurring" : False})
+
+    return df.to_dict("records")
+#------------------------------------------------------------------------------
+
+def importStatement(path, col=None, rules=None, fraction=0.0, size=None, duplicates="reject"):
+    """
+    Import a bank statement into the database, a chunk at a time.
+
+    Parameters
+    ----------
+    path : String
+        The path to the statement, read as OFX if it ends in .ofx or .qfx and
+        as CSV otherwise.
+    col : PyMongo Collection, optional
+        The expenses collection. If None nothing is written, which is useful
+        to check the categories first. The default is None.
+    rules : RuleTable, optional
+        The categorisation rules. The default is RuleTable().
+    fraction : Float, optional
+        The fraction of each amount that is Courtney's. The default is 0.
+    size : Integer, optional
+        The number of transactions in each chunk. The default is
+        importer.chunk_size.
+    duplicates : String, optional
+        What to do with transactions already in the database (e.g. from
+        importing an overlapping statement), "reject" or "flag", see
+        dedup.DedupIndex.prepare. Repeats within the statement are kept.
+        The default is "reject".
+
+    Returns
+    -------
+    stats : Dictionary
+        The number of "rows" read, the number "inserted", the number of
+        "duplicates", the "seconds" it took, the "rows_per_sec" and the
+        number of rows given each category in "categories".
+
+    """
+    rules  = RuleTable() if rules is None else rules
+    reader = readOFX if path.lower().endswith((".ofx", ".qfx")) else readCSV
+    index  = None if col is None else dedup.DedupIndex(col)
+    counts = {}   # The repeats of each transaction in the statement so far
+    stats  = {"rows" : 0, "inserted" : 0, "duplicates" : 0, "categories" : {}}
+
+    start = time.perf_counter()
+    for chunk in reader(path, size):
+        docs = toDocuments(chunk, rules, fraction)
+
+        if index is not None:
+            inserted, duplicated = index.insert(docs, duplicates, counts)
+            stats["inserted"]   += inserted
+            stats["duplicates"] += duplicated
+
+        stats["rows"] += len(docs)
+        for category, count in pd.Series([doc["Category"] for doc in docs]).value_counts().items():
+            stats["categories"][category] = stats["categories"].get(category, 0) + int(count)
+
+    stats["seconds"]      = time.perf_counter() - start
+    stats["rows_per_sec"] = stats["rows"] / stats["seconds"] if stats["seconds"] > 0 else float("inf")
+
+    return stats
+#------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Import a bank statement into PyFinance")
+    parser.add_argument("statement", help="The CSV or OFX file to import")
+    parser.add_argument("--rules",    default=None, help="A CSV file of pattern,category rules, the built in rules are used if not given")
+    parser.add_argument("--fraction", default=0.0, type=float, help="The fraction of each amount that is Courtney's")
+    parser.add_argument("--dry-run",  action="store_true", help="Categorise the statement without writing it to the database")
+    parser.add_argument("--duplicates", default="reject", choices=dedup.modes, help="Leave out transactions already in the database, or write them flagged as duplicates")
+    parser.add_argument("--address",  default="localhost", help="The address of the MongoDB server")
+    parser.add_argument("--port",     default=27017, type=int, help="The port the MongoDB server is running on")
+    args = parser.parse_args()
+
+    rules    = None if args.rules is None else loadRules(args.rules)
+    expenses = None if args.dry_run else database.openCollection(args.address, args.port)
+    stats    = importStatement(args.statement, expenses, rules, args.fraction, duplicates=args.duplicates)
+
+    for category, count in sorted(stats["categories"].items()):
+        print("{:<6} {:>8}".format(category, count))
+    print("{} rows, {} inserted, {} duplicates in {:.2f}s ({:.0f} rows/s)".format(stats["rows"], stats["inserted"], stats["duplicates"], stats["seconds"], stats["rows_per_sec"]))
@@ -0,0 +1,574 @@
+"""
+A local journal for expenses waiting to be written to the database. Entries
+are accepted straight into the journal, which is a file on disk, and written
+to MongoDB in batches afterwards by a background sync, so entering expenses
+never waits on the server and nothing is lost if it cannot be reached. With
+the journal the expense windows work offline, everything entered is written
+once the server can be reached again.
+
+The journal file is append only, one operation per line:
+
+    {"op" : "insert",    "doc" : {...}}                 An itemised expense
+    {"op" : "recurring", "_id" : ..., "docs" : [...]}   A month's recurring expenses
+    {"op" : "discard",   "_id" : ...}                   Undo an insert not yet written
+
+Next to it the cursor file holds how far through the journal has been
+written to the database, so opening the journal and syncing it only reads
+the operations since then, and the conflicts file keeps the expenses that
+could not be written as they were entered, see Journal.flush.
+"""
+
+import os
+import re
+import queue
+import sqlite3
+import threading
+
+import bson
+import bson.json_util
+import pymongo.errors
+
+import cache
+import database
+
+#------------------------------------------------------------------------------
+# Global Variables
+#------------------------------------------------------------------------------
+journal_dir    = os.path.join(os.path.expanduser("~"), ".pyfinance")
+batch_size     = 20      # Sync straight away once this many are waiting
+flush_ms       = 2000    # Otherwise sync what is waiting this often (milliseconds)
+sync_batch     = 500     # The most operations written in one go
+max_backoff_ms = 60000   # The longest wait between tries while the server cannot be reached
+
+# The errors which mean the database cannot be reached right now, the sync
+# waits and tries again. Any other error is down to the operation itself, which
+# is kept in the conflicts rather than hold up everything after it.
+connection_errors = (pymongo.errors.ConnectionFailure, sqlite3.OperationalError)
+
+# Round trip the documents exactly, floats and dates included
+json_options = bson.json_util.CANONICAL_JSON_OPTIONS
+
+# One journal per (address, port), shared by the whole process
+_journals = {}
+#------------------------------------------------------------------------------
+
+def _dumps(entry):
+    """
+    An operation as a line of the journal, in bytes.
+    """
+    return (bson.json_util.dumps(entry, json_options=json_options) + "\n").encode("utf-8")
+#------------------------------------------------------------------------------
+
+def _sameExpense(stored, doc):
+    """
+    Whether the expense in the database is the one in the journal, i.e. it
+    was written before and the reply was lost. MongoDB keeps dates to the
+    millisecond, so they are compared to the millisecond.
+    """
+    for field in list(database.report_fields) + ["Hash", "Duplicate"]:
+        a, b = stored.get(field), doc.get(field)
+        if field == "Date" and a is not None and b is not None:
+            a, b = a.replace(microsecond=a.microsecond // 1000 * 1000), b.replace(microsecond=b.microsecond // 1000 * 1000)
+        if a != b:
+            return False
+
+    return True
+#------------------------------------------------------------------------------
+
+class Journal():
+    """
+    The operations waiting to be written to one database server, and the
+    background sync writing them.
+
+    Every expense is given its _id when it is added, so writing it twice
+    (e.g. the server took it but the reply was lost) is spotted as a
+    duplicate and not inserted again. If the expense in the database with
+    that _id is not the one in the journal, or the same expense is already
+    there under another _id (see dedup), it is a conflict: it is not
+    written, but kept in the conflicts file and reported to the listeners.
+    """
+    def __init__(self, path, address, port):
+        self.path           = path
+        self.cursor_path    = path + ".cursor"
+        self.conflicts_path = path + ".conflicts"
+        self.address        = address
+        self.port           = port
+        self.lock           = threading.Lock()   # Guards pending and the files
+        self.sending        = threading.Lock()   # Held while a batch is being written
+        self.pending        = {}                 # _id -> (offset in the file, operation)
+        self.size           = 0                  # Where the next operation is written
+        self.cursor         = 0                  # Everything before this has been written
+        self.listeners      = []
+        self.wakeup         = threading.Event()
+        self.thread         = None
+        self.stopping       = False
+        self.online         = None               # Unknown until the first sync
+
+        self._load()
+
+    def _load(self):
+        # Read the operations since the cursor, the rest are written already
+        if os.path.isfile(self.cursor_path):
+            with open(self.cursor_path, "r", encoding="utf-8") as f:
+                self.cursor = int(f.read().strip() or 0)
+
+        if not os.path.isfile(self.path):
+            self.cursor = 0
+            return
+
+        with open(self.path, "rb") as f:
+            self.size = f.seek(0, os.SEEK_END)
+
+            # The journal was emptied after the cursor was last saved
+            if self.cursor > self.size:
+                self.cursor = 0
+
+            offset = f.seek(self.cursor)
+            for line in f:
+                # A line cut short by a crash was never added, drop it
+                if not line.endswith(b"\n"):
+                    break
+                if line.strip():
+                    self._apply(offset, bson.json_util.loads(line.decode("utf-8"), json_options=json_options))
+                offset += len(line)
+
+        if offset < self.size:
+            with open(self.path, "r+b") as f:
+                f.truncate(offset)
+            self.size = offset
+
+    def _apply(self, offset, entry):
+        # Journals from before the operations were recorded hold bare documents
+        if "op" not in entry:
+            entry = {"op" : "insert", "doc" : entry}
+
+        if entry["op"] == "discard":
+            self.pending.pop(entry["_id"], None)
+        elif entry["op"] == "insert":
+            self.pending[entry["doc"]["_id"]] = (offset, entry)
+        else:
+            self.pending[entry["_id"]] = (offset, entry)
+
+    def _write(self, entry):
+        # Append an operation to the file, the lock must be held
+        line = _dumps(entry)
+        with open(self.path, "ab") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+        offset     = self.size
+        self.size += len(line)
+        self._apply(offset, entry)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.pending)
+
+    def waiting(self):
+        """
+        Return the itemised expenses not yet written to the database, oldest
+        first.
+        """
+        with self.lock:
+            return [entry["doc"] for _, entry in self.pending.values() if entry["op"] == "insert"]
+
+    def append(self, doc):
+        """
+        Add an expense to the journal, giving it an _id if it does not have
+        one. It is on disk when this returns, and the sync is woken once
+        batch_size are waiting.
+
+        Parameters
+        ----------
+        doc : Dictionary
+            The document to write to the database.
+
+        Returns
+        -------
+        doc : Dictionary
+            The document, with its _id.
+
+        """
+        doc = dict(doc)
+        doc.setdefault("_id", bson.ObjectId())
+
+        with self.lock:
+            self._write({"op" : "insert", "doc" : doc})
+            full = len(self.pending) >= batch_size
+
+        if full:
+            self.wake()
+
+        return doc
+
+    def append_recurring(self, docs):
+        """
+        Add a month's recurring expenses to the journal. They are written
+        with database.insertRecurring so, as there, writing the month again
+        updates it rather than duplicating it.
+
+        Parameters
+        ----------
+        docs : List of dictionaries
+            The recurring expenses, all for the same month.
+
+        Returns
+        -------
+        ObjectId
+            The _id of the operation in the journal.
+
+        """
+        _id = bson.ObjectId()
+
+        with self.lock:
+            self._write({"op" : "recurring", "_id" : _id, "docs" : [dict(doc) for doc in docs]})
+
+        self.wake()
+
+        return _id
+
+    def discard_last(self):
+        """
+        Remove the most recently added expense, if it has not been written
+        to the database yet. If a batch is being written this waits for it,
+        as the expense may be in it.
+
+        Returns
+        -------
+        Dictionary or None
+            The document removed, None if nothing was waiting.
+
+        """
+        with self.sending:
+            with self.lock:
+                inserts = [entry["doc"] for _, entry in self.pending.values() if entry["op"] == "insert"]
+                if len(inserts) == 0:
+                    return None
+
+                doc = max(inserts, key=lambda doc: doc["_id"])
+                self._write({"op" : "discard", "_id" : doc["_id"]})
+
+        return doc
+
+    def conflicts(self):
+        """
+        Return the operations that could not be written, and why.
+
+        Returns
+        -------
+        List of dictionaries
+            Each has the "reason" ("changed", "duplicate" or "rejected"), the
+            operation ("entry") as it was in the journal and, for "changed",
+            the expense "stored" in the database under its _id. Those
+            rejected with an error other than a write error have the
+            "error" too.
+
+        """
+        with self.lock:
+            if not os.path.isfile(self.conflicts_path):
+                return []
+            with open(self.conflicts_path, "r", encoding="utf-8") as f:
+                return [bson.json_util.loads(line, json_options=json_options) for line in f if line.strip()]
+
+    def subscribe(self):
+        """
+        Return a queue the sync puts (state, _ids) on after each batch, the
+        state being "Saved" or "Conflict", e.g. for a window to show them.
+        """
+        updates = queue.Queue()
+        with self.lock:
+            self.listeners.append(updates)
+
+        return updates
+
+    def unsubscribe(self, updates):
+        """
+        Stop putting updates on a queue from subscribe.
+        """
+        with self.lock:
+            if updates in self.listeners:
+                self.listeners.remove(updates)
+
+    def _notify(self, state, ids):
+        if len(ids) > 0:
+            with self.lock:
+                listeners = list(self.listeners)
+            for updates in listeners:
+                updates.put((state, ids))
+
+    def _done(self, ids):
+        # Take finished operations out of pending and move the cursor up to
+        # the first still waiting, the lock must be held. Losing a cursor
+        # update only means some operations are written again, which is
+        # safe, so it is not synced to disk.
+        for _id in ids:
+            self.pending.pop(_id, None)
+
+        cursor = min((offset for offset, _ in self.pending.values()), default=self.size)
+
+        # Everything is written, start the file again rather than let it grow
+        if cursor == self.size and self.size > 0:
+            with open(self.path, "r+b") as f:
+                f.truncate(0)
+            cursor    = 0
+            self.size = 0
+
+        if cursor != self.cursor:
+            temp_path = self.cursor_path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write(str(cursor))
+            os.replace(temp_path, self.cursor_path)
+            self.cursor = cursor
+
+    def _conflict(self, reason, entry, stored=None, error=None):
+        # Keep an operation that cannot be written, the lock must be held
+        record = {"reason" : reason, "entry" : entry}
+        if stored is not None:
+            record["stored"] = stored
+        if error is not None:
+            record["error"] = "{}: {}".format(type(error).__name__, error)
+
+        with open(self.conflicts_path, "a", encoding="utf-8") as f:
+            f.write(bson.json_util.dumps(record, json_options=json_options) + "\n")
+
+    def _insert(self, col, entries):
+        """
+        Write a run of inserts in one insert_many, and sort out any that
+        were already there. Returns the _ids written and those in conflict.
+        """
+        docs = [entry["doc"] for entry in entries]
+        try:
+            database.insertExpenses(col, docs)
+            return [doc["_id"] for doc in docs], []
+        except pymongo.errors.BulkWriteError as error:
+            failed = {write_error["index"] : write_error["code"] for write_error in error.details["writeErrors"]}
+
+        # One query for every _id already taken
+        duplicates = [docs[index]["_id"] for index, code in failed.items() if code == 11000]
+        stored     = {doc["_id"] : doc for doc in col.find({"_id" : {"$in" : duplicates}})} if duplicates else {}
+
+        written   = [doc["_id"] for i, doc in enumerate(docs) if i not in failed]
+        conflicts = []
+        unrolled  = []
+        with self.lock:
+            for index, code in failed.items():
+                entry, doc = entries[index], docs[index]
+                if code != 11000:
+                    self._conflict("rejected", entry)
+                    conflicts.append(doc["_id"])
+                elif doc["_id"] not in stored:
+                    # The same expense is in the database under another _id
+                    self._conflict("duplicate", entry)
+                    conflicts.append(doc["_id"])
+                elif _sameExpense(stored[doc["_id"]], doc):
+                    # Written before but the reply was lost, maybe before it
+                    # was added to the rollups
+                    written.append(doc["_id"])
+                    if stored[doc["_id"]].get(database.unrolled_field):
+                        unrolled.append(stored[doc["_id"]])
+                else:
+                    self._conflict("changed", entry, stored[doc["_id"]])
+                    conflicts.append(doc["_id"])
+
+        database.updateRollups(col, unrolled)
+
+        return written, conflicts
+
+    def _recurring(self, col, entry):
+        """
+        Write a month's recurring expenses. Returns the _ids written and
+        those in conflict, the operation's _id is in one or the other.
+        """
+        try:
+            result = database.insertRecurring(col, entry["docs"])
+        except pymongo.errors.BulkWriteError:
+            with self.lock:
+                self._conflict("rejected", entry)
+            return [], [entry["_id"]]
+
+        # Updated expenses keep their _ids, so the cached months cannot tell
+        # they have changed
+        if result.modified_count > 0:
+            cache.openCache(self.address, self.port).clear()
+
+        return [entry["_id"]], []
+
+    def _attempt(self, col, entries):
+        """
+        Write a run of inserts, or a single recurring operation. If it fails
+        for any reason but the database not being reachable it would fail
+        every time, so it is kept in the conflicts as "rejected". A run of
+        inserts is first tried again one at a time, to find the ones at
+        fault, which is safe as those already written are the same expense.
+        """
+        try:
+            if entries[0]["op"] == "insert":
+                return self._insert(col, entries)
+            return self._recurring(col, entries[0])
+        except connection_errors:
+            raise
+        except Exception as error:
+            if len(entries) > 1:
+                written, conflicts = [], []
+                for entry in entries:
+                    entry_written, entry_conflicts = self._attempt(col, [entry])
+                    written.extend(entry_written)
+                    conflicts.extend(entry_conflicts)
+                return written, conflicts
+
+            entry = entries[0]
+            with self.lock:
+                self._conflict("rejected", entry, error=error)
+            return [], [entry["doc"]["_id"] if entry["op"] == "insert" else entry["_id"]]
+
+    def flush(self):
+        """
+        Write up to sync_batch of the operations waiting to the database, in
+        the order they were added, with each run of inserts in a single
+        insert_many. If the server cannot be reached the error is raised
+        with everything not yet written still waiting, and it is safe to
+        try again. Operations the database refuses are kept in the conflicts
+        (see conflicts), and the rest are still written.
+
+        Returns
+        -------
+        committed : List of ObjectIds
+            The _ids of the operations now in the database.
+
+        """
+        with self.sending:
+            with self.lock:
+                entries = [entry for _, entry in list(self.pending.values())[:sync_batch]]
+
+            if len(entries) == 0:
+                return []
+
+            col       = database.openCollection(self.address, self.port)
+            committed = []
+            start     = 0
+            while start < len(entries):
+                end = start + 1
+                if entries[start]["op"] == "insert":
+                    while end < len(entries) and entries[end]["op"] == "insert":
+                        end += 1
+                written, conflicts = self._attempt(col, entries[start:end])
+
+                with self.lock:
+                    self._done(written + conflicts)
+
+                committed.extend(written)
+                self._notify("Saved",    written)
+                self._notify("Conflict", conflicts)
+                start = end
+
+        return committed
+
+    #--------------------------------------------------------------------------
+    # The background sync
+    #--------------------------------------------------------------------------
+    def start(self):
+        """
+        Start the background sync, which writes what is waiting every
+        flush_ms, or straight away when woken. While the server cannot be
+        reached it waits longer between each try, up to max_backoff_ms.
+        """
+        with self.lock:
+            if self.thread is None:
+                self.stopping = False
+                self.thread   = threading.Thread(target=self._run, name="journal sync", daemon=True)
+                self.thread.start()
+
+    def wake(self):
+        """
+        Have the background sync write what is waiting now.
+        """
+        self.wakeup.set()
+
+    def stop(self):
+        """
+        Stop the background sync, once it has finished any batch it is
+        writing.
+        """
+        with self.lock:
+            thread, self.thread = self.thread, None
+            self.stopping       = True
+
+        if thread is not None:
+            self.wakeup.set()
+            thread.join()
+
+    def _run(self):
+        delay = flush_ms
+        while True:
+            self.wakeup.wait(delay / 1000)
+            self.wakeup.clear()
+            if self.stopping:
+                return
+
+            try:
+                while len(self) > 0 and not self.stopping:
+                    self.flush()
+                self.online = True
+                delay       = flush_ms
+            except connection_errors:
+                # It is all still waiting for when the server is back
+                self.online = False
+                delay       = min(delay * 2, max_backoff_ms)
+            except Exception:
+                # Not down to any one operation (those are kept aside by
+                # flush), e.g. the indexes could not be made, so try again
+                # later rather than stop syncing
+                delay       = min(delay * 2, max_backoff_ms)
+#------------------------------------------------------------------------------
+
+def openJournal(address, port):
+    """
+    Return the journal for a database server, creating it and starting its
+    background sync the first time. This does not need the server, so it
+    works offline.
+
+    Parameters
+    ----------
+    address : String
+        The address of the MongoDB server.
+    port : Integer
+        The port the MongoDB server is running on.
+
+    Returns
+    -------
+    Journal
+
+    """
+    key = (address, port)
+    if key not in _journals:
+        if not os.path.isdir(journal_dir):
+            os.makedirs(journal_dir)
+
+        # The address may be a SQLite path, so anything but a plain name goes
+        name = re.sub(r"[^\w.-]", "_", address)
+        path = os.path.join(journal_dir, "journal_{}_{}.jsonl".format(name, port))
+        _journals[key] = Journal(path, address, port)
+        _journals[key].start()
+
+    return _journals[key]
+#------------------------------------------------------------------------------
+
+def flushAll():
+    """
+    Stop the background syncs and try to write everything waiting in every
+    open journal, anything that cannot be written stays in its journal for
+    next time.
+
+    Returns
+    -------
+    None.
+
+    """
+    for journal in _journals.values():
+        journal.stop()
+        try:
+            while len(journal) > 0:
+                journal.flush()
+        except Exception:
+            pass
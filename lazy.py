@@ -0,0 +1,56 @@
+"""
+Lazy imports, so the heavy dependencies (pandas, pymongo and the modules
+built on them) are only loaded when they are first used rather than when
+the software starts.
+"""
+
+import importlib
+import threading
+
+#------------------------------------------------------------------------------
+
+class LazyModule():
+    """
+    Stands in for a module until one of its attributes is first used, at
+    which point the module is imported and the attribute taken from it. The
+    import goes through importlib, so it is safe to first use it from the
+    database thread and the Tk thread at the same time.
+
+    Examples
+    --------
+    >>> pd = LazyModule("pandas")
+    >>> pd.DataFrame  # pandas is imported here
+    """
+    def __init__(self, name):
+        self.__dict__["_name"]   = name
+        self.__dict__["_module"] = None
+        self.__dict__["_lock"]   = threading.Lock()
+
+    def _load(self):
+        """
+        Import the module, if it has not been already, and return it.
+
+        Returns
+        -------
+        Module
+
+        """
+        module = self.__dict__["_module"]
+        if module is None:
+            with self.__dict__["_lock"]:
+                if self.__dict__["_module"] is None:
+                    self.__dict__["_module"] = importlib.import_module(self._name)
+                module = self.__dict__["_module"]
+
+        return module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._load(), attribute, value)
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__["_module"] is not None else "not loaded"
+        return "<lazy module '{}' ({})>".format(self._name, state)
+#------------------------------------------------------------------------------
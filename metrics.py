@@ -0,0 +1,362 @@
+"""
+Metrics for the query and report pipeline, to see where the time goes when
+a report is slow. The pipeline is split into stages, each timed with
+
+    with metrics.stage("find"):
+        ...
+
+and counters for the rows and bytes it handles, with metrics.count. Every
+command sent to MongoDB is timed as well, by command_listener, which
+database.getClient registers with each client.
+
+Everything is kept in one registry for the process. A snapshot of it can
+be saved as JSON or in the Prometheus text format with saveMetrics. What a
+single run took is recorded into a registry of its own as well with collect,
+which only sees what is done in the same thread (or context), so work going
+on in other threads at the same time is left out, e.g.
+
+    with metrics.collect() as run:
+        database.getMonthSummary(1, 2022, expenses)
+    print(metrics.formatMetrics(run.snapshot()))
+
+Worker processes have registries of their own, what a worker records is
+sent back and added in here with merge (see database.saveRange), or counted
+here from what it returns (see report.writeViews).
+"""
+
+import json
+import time
+import threading
+import contextlib
+import contextvars
+
+import pymongo.monitoring
+
+#------------------------------------------------------------------------------
+# Global Variables
+#------------------------------------------------------------------------------
+# The prefix of every metric in the Prometheus text format
+prometheus_prefix = "pyfinance"
+
+# The registries of the runs being collected in this context, see collect
+_runs = contextvars.ContextVar("runs", default=())
+#------------------------------------------------------------------------------
+
+class Metrics():
+    """
+    The stage timers, counters and MongoDB command timers, safe to record
+    from any thread.
+    """
+    def __init__(self):
+        self.lock     = threading.Lock()
+        self.stages   = {}   # name -> {"count", "seconds", "max"}
+        self.counters = {}   # name -> total
+        self.commands = {}   # command name -> {"count", "seconds", "max", "failures"}
+
+    def observe(self, name, seconds, timers=None):
+        """
+        Record a run of a stage (or command) which took seconds.
+        """
+        with self.lock:
+            timer = (self.stages if timers is None else timers).setdefault(name, {"count" : 0, "seconds" : 0.0, "max" : 0.0})
+            timer["count"]   += 1
+            timer["seconds"] += seconds
+            timer["max"]      = max(timer["max"], seconds)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time the with block as a run of the stage name, whether or not it
+        raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def count(self, name, value=1):
+        """
+        Add value to the counter name.
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def fail(self, name):
+        """
+        Count a failure of the command name.
+        """
+        with self.lock:
+            self.commands[name]["failures"] = self.commands[name].get("failures", 0) + 1
+
+    def merge(self, metrics):
+        """
+        Add a snapshot to what is recorded here, e.g. one from a worker
+        process.
+        """
+        with self.lock:
+            for kind in ["stages", "commands"]:
+                timers = getattr(self, kind)
+                for name, other in metrics[kind].items():
+                    timer = timers.setdefault(name, {"count" : 0, "seconds" : 0.0, "max" : 0.0})
+                    for key, value in other.items():
+                        timer[key] = max(timer[key], value) if key == "max" else timer.get(key, 0) + value
+
+            for name, value in metrics["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        """
+        A copy of everything recorded so far.
+
+        Returns
+        -------
+        Dictionary
+            With "stages", "counters" and "commands".
+
+        """
+        with self.lock:
+            return {"stages"   : {name : dict(timer) for name, timer in self.stages.items()},
+                    "counters" : dict(self.counters),
+                    "commands" : {name : dict(timer) for name, timer in self.commands.items()}}
+
+    def reset(self):
+        """
+        Forget everything recorded so far.
+        """
+        with self.lock:
+            self.stages.clear()
+            self.counters.clear()
+            self.commands.clear()
+#------------------------------------------------------------------------------
+
+class CommandTimer(pymongo.monitoring.CommandListener):
+    """
+    Times every command a MongoClient sends, by command name, and counts the
+    failures and the documents returned by find and getMore. The driver
+    calls it on the thread sending the command, so the runs being collected
+    there see the command as well.
+    """
+    def __init__(self, registry):
+        self.registry = registry
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        cursor = event.reply.get("cursor") if isinstance(event.reply, dict) else None
+        batch  = cursor.get("firstBatch", cursor.get("nextBatch")) if isinstance(cursor, dict) else None
+
+        for target in (self.registry,) + _runs.get():
+            target.observe(event.command_name, event.duration_micros / 1e6, target.commands)
+            if batch is not None:
+                target.count("documents_returned", len(batch))
+
+    def failed(self, event):
+        for target in (self.registry,) + _runs.get():
+            target.observe(event.command_name, event.duration_micros / 1e6, target.commands)
+            target.fail(event.command_name)
+#------------------------------------------------------------------------------
+
+# The registry for the process, and the listener recording into it
+registry         = Metrics()
+command_listener = CommandTimer(registry)
+#------------------------------------------------------------------------------
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Time a with block as a run of a stage, see Metrics.stage, into the
+    registry and any runs being collected.
+
+    Parameters
+    ----------
+    name : String
+        The name of the stage, e.g. "find".
+
+    Returns
+    -------
+    Context manager
+
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        for target in (registry,) + _runs.get():
+            target.observe(name, seconds)
+#------------------------------------------------------------------------------
+
+def count(name, value=1):
+    """
+    Add to a counter, see Metrics.count.
+
+    Parameters
+    ----------
+    name : String
+        The name of the counter, e.g. "documents_read".
+    value : Integer, optional
+        The amount to add. The default is 1.
+
+    Returns
+    -------
+    None.
+
+    """
+    for target in (registry,) + _runs.get():
+        target.count(name, value)
+#------------------------------------------------------------------------------
+
+@contextlib.contextmanager
+def collect():
+    """
+    Record everything done in the with block into a registry of its own,
+    as well as the registry for the process. Only what is recorded in the
+    same thread (or context) is collected, and runs can be nested.
+
+    Returns
+    -------
+    Context manager
+        Giving the run's Metrics, e.g. for its snapshot once the block ends.
+
+    """
+    run   = Metrics()
+    token = _runs.set(_runs.get() + (run,))
+    try:
+        yield run
+    finally:
+        _runs.reset(token)
+#------------------------------------------------------------------------------
+
+def merge(metrics):
+    """
+    Add a snapshot recorded elsewhere, e.g. in a worker process, into the
+    registry and any runs being collected, see Metrics.merge.
+
+    Parameters
+    ----------
+    metrics : Dictionary
+        The snapshot.
+
+    Returns
+    -------
+    None.
+
+    """
+    for target in (registry,) + _runs.get():
+        target.merge(metrics)
+#------------------------------------------------------------------------------
+
+def snapshot():
+    """
+    A copy of everything recorded so far, see Metrics.snapshot.
+    """
+    return registry.snapshot()
+#------------------------------------------------------------------------------
+
+def toJSON(metrics):
+    """
+    A snapshot as JSON text.
+    """
+    return json.dumps(metrics, indent=2, sort_keys=True)
+#------------------------------------------------------------------------------
+
+def toPrometheus(metrics):
+    """
+    A snapshot in the Prometheus text exposition format, e.g. for the node
+    exporter's textfile collector.
+
+    Parameters
+    ----------
+    metrics : Dictionary
+        The snapshot.
+
+    Returns
+    -------
+    String
+
+    """
+    lines = []
+
+    def family(name, kind, description, samples):
+        if len(samples) == 0:
+            return
+        lines.append("# HELP {}_{} {}".format(prometheus_prefix, name, description))
+        lines.append("# TYPE {}_{} {}".format(prometheus_prefix, name, kind))
+        for labels, value in samples:
+            label_text = ",".join('{}="{}"'.format(key, str(label).replace("\\", "\\\\").replace('"', '\\"')) for key, label in labels.items())
+            lines.append("{}_{}{} {}".format(prometheus_prefix, name, "{" + label_text + "}" if label_text else "", value))
+    #--------------------------------------------------------------------------
+
+    stages   = sorted(metrics["stages"].items())
+    commands = sorted(metrics["commands"].items())
+
+    family("stage_seconds_total",          "counter", "Time spent in each stage of the pipeline.",   [({"stage" : name}, timer["seconds"])        for name, timer in stages])
+    family("stage_runs_total",             "counter", "Runs of each stage of the pipeline.",         [({"stage" : name}, timer["count"])          for name, timer in stages])
+    family("stage_max_seconds",            "gauge",   "The longest run of each stage.",              [({"stage" : name}, timer["max"])            for name, timer in stages])
+    family("mongo_command_seconds_total",  "counter", "Time spent in each MongoDB command.",         [({"command" : name}, timer["seconds"])      for name, timer in commands])
+    family("mongo_commands_total",         "counter", "MongoDB commands sent.",                      [({"command" : name}, timer["count"])        for name, timer in commands])
+    family("mongo_command_failures_total", "counter", "MongoDB commands which failed.",              [({"command" : name}, timer.get("failures", 0)) for name, timer in commands])
+    for name, value in sorted(metrics["counters"].items()):
+        family(name + "_total", "counter", "The {} counted.".format(name.replace("_", " ")), [({}, value)])
+
+    return "\n".join(lines) + "\n"
+#------------------------------------------------------------------------------
+
+def formatMetrics(metrics):
+    """
+    A snapshot as a plain text table, slowest stage first, e.g. to show in a
+    window.
+
+    Parameters
+    ----------
+    metrics : Dictionary
+        The snapshot.
+
+    Returns
+    -------
+    String
+
+    """
+    lines = ["{:<22} | {:>6} | {:>10} | {:>10}".format("Stage", "Runs", "Total (s)", "Max (s)")]
+    for name, timer in sorted(metrics["stages"].items(), key=lambda item: item[1]["seconds"], reverse=True):
+        lines.append("{:<22} | {:>6} | {:>10.4f} | {:>10.4f}".format(name, timer["count"], timer["seconds"], timer["max"]))
+
+    if len(metrics["commands"]) > 0:
+        lines.append("")
+        lines.append("{:<22} | {:>6} | {:>10} | {:>10}".format("MongoDB command", "Sent", "Total (s)", "Failures"))
+        for name, timer in sorted(metrics["commands"].items(), key=lambda item: item[1]["seconds"], reverse=True):
+            lines.append("{:<22} | {:>6} | {:>10.4f} | {:>10}".format(name, timer["count"], timer["seconds"], timer.get("failures", 0)))
+
+    if len(metrics["counters"]) > 0:
+        lines.append("")
+        for name, value in sorted(metrics["counters"].items()):
+            lines.append("{:<22} | {:>,}".format(name, value))
+
+    return "\n".join(lines)
+#------------------------------------------------------------------------------
+
+def saveMetrics(path, metrics=None):
+    """
+    Save a snapshot, in the Prometheus text format if the path ends in .prom
+    or .txt and as JSON otherwise.
+
+    Parameters
+    ----------
+    path : String
+        Where to save it.
+    metrics : Dictionary, optional
+        The snapshot. The default is None, everything recorded so far.
+
+    Returns
+    -------
+    None.
+
+    """
+    if metrics is None:
+        metrics = snapshot()
+
+    text = toPrometheus(metrics) if path.endswith((".prom", ".txt")) else toJSON(metrics)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
@@ -0,0 +1,394 @@
+"""
+Money handling shared by the rest of the software package. Amounts are
+formatted a whole column at a time, so no per-row apply is needed when
+building the reports. Inside the software amounts are kept as whole pence,
+single amounts as Money and columns as int64, so sums and splits are exact.
+"""
+
+import math
+import decimal
+
+import numpy  as np
+
+import lazy
+
+# Only the column functions need pandas, entering a single Money does not
+pd = lazy.LazyModule("pandas")
+
+#------------------------------------------------------------------------------
+# Global Variables
+#------------------------------------------------------------------------------
+currency_symbol = "£"
+sign_position   = "before" # "before" gives -£1.00, "after" gives £-1.00
+decimal_places  = 2
+#------------------------------------------------------------------------------
+
+def _prefixes(symbol, sign):
+    """
+    Return the (positive, negative) prefixes for the currency symbol and sign
+    placement.
+    """
+    if sign == "before":
+        return symbol, "-" + symbol
+    elif sign == "after":
+        return symbol, symbol + "-"
+    else:
+        raise ValueError("The sign position must be either 'before' or 'after'")
+#------------------------------------------------------------------------------
+
+def formatMoney(values, symbol=None, sign=None, dp=None):
+    """
+    Format a column of amounts as currency strings, e.g. 1234.5 -> "£1,234.50"
+    and -3 -> "-£3.00".
+
+    Parameters
+    ----------
+    values : Pandas Series/array like
+        The amounts to format.
+    symbol : String, optional
+        The currency symbol. The default is money.currency_symbol.
+    sign : String, optional
+        Where the minus sign goes, "before" or "after" the currency symbol.
+        The default is money.sign_position.
+    dp : Integer, optional
+        The number of decimal places. The default is money.decimal_places.
+
+    Returns
+    -------
+    Pandas Series of strings, with the same index as values if it was a
+    Series.
+
+    """
+    symbol = currency_symbol if symbol is None else symbol
+    sign   = sign_position   if sign   is None else sign
+    dp     = decimal_places  if dp     is None else dp
+
+    pos, neg = _prefixes(symbol, sign)
+    index    = values.index if isinstance(values, pd.Series) else None
+
+    amounts  = np.asarray(values, dtype=float)
+
+    # The sign is taken from the sign bit so -0.0 is formatted as "-£0.00",
+    # the same as the string formatting does
+    prefix   = pd.Series(np.where(np.signbit(amounts), neg, pos), index=index, dtype=object)
+    number   = pd.Series(np.abs(amounts), index=index).map("{{:0,.{}f}}".format(dp).format)
+
+    return prefix + number
+#------------------------------------------------------------------------------
+
+def formatAmount(value, symbol=None, sign=None, dp=None):
+    """
+    Format a single amount as a currency string, matching formatMoney.
+
+    Parameters
+    ----------
+    value : Float
+        The amount to format.
+    symbol : String, optional
+        The currency symbol. The default is money.currency_symbol.
+    sign : String, optional
+        Where the minus sign goes, "before" or "after" the currency symbol.
+        The default is money.sign_position.
+    dp : Integer, optional
+        The number of decimal places. The default is money.decimal_places.
+
+    Returns
+    -------
+    String
+        The formatted amount.
+
+    """
+    return formatMoney([value], symbol, sign, dp).iloc[0]
+#------------------------------------------------------------------------------
+
+def _roundHalfAway(values):
+    """
+    Round an array of floats to whole numbers, halves away from zero, and
+    return them as int64. Done in place on one temporary to keep it quick.
+    """
+    values  = np.asarray(values, dtype=float)
+    rounded = np.abs(values, out=np.empty_like(values))
+    rounded += 0.5
+    np.floor(rounded, out=rounded)
+    np.copysign(rounded, values, out=rounded)
+
+    return rounded.astype(np.int64)
+#------------------------------------------------------------------------------
+
+def toPence(values):
+    """
+    Convert amounts in pounds to whole pence, rounding halves away from zero
+    the same way aggregateTotals does on the server.
+
+    Parameters
+    ----------
+    values : Pandas Series/array like
+        The amounts in pounds.
+
+    Returns
+    -------
+    Pandas Series of int64 if values was a Series, otherwise a numpy array.
+
+    Raises
+    ------
+    ValueError
+        If any amount is missing (NaN) or infinite, which has no value in
+        pence.
+
+    """
+    pounds  = np.asarray(values, dtype=float)
+    if not np.isfinite(pounds).all():
+        raise ValueError("Amounts must be finite numbers, {} of them are missing or infinite".format(int((~np.isfinite(pounds)).sum())))
+
+    pence   = _roundHalfAway(pounds * 100)
+
+    if isinstance(values, pd.Series):
+        return pd.Series(pence, index=values.index, name=values.name)
+
+    return pence
+#------------------------------------------------------------------------------
+
+def fromPence(values):
+    """
+    Convert whole pence back to pounds, e.g. for writing out to CSV.
+
+    Parameters
+    ----------
+    values : Pandas Series/array like
+        The amounts in pence.
+
+    Returns
+    -------
+    The amounts in pounds, as floats.
+
+    """
+    return values / 100
+#------------------------------------------------------------------------------
+
+def formatPence(values, symbol=None, sign=None):
+    """
+    Format a column of amounts in whole pence as currency strings, e.g.
+    123450 -> "£1,234.50". Integer arithmetic is used throughout, so there is
+    no float rounding.
+
+    Parameters
+    ----------
+    values : Pandas Series/array like
+        The amounts to format, in pence.
+    symbol : String, optional
+        The currency symbol. The default is money.currency_symbol.
+    sign : String, optional
+        Where the minus sign goes, "before" or "after" the currency symbol.
+        The default is money.sign_position.
+
+    Returns
+    -------
+    Pandas Series of strings, with the same index as values if it was a
+    Series.
+
+    """
+    symbol = currency_symbol if symbol is None else symbol
+    sign   = sign_position   if sign   is None else sign
+
+    pos, neg = _prefixes(symbol, sign)
+    index    = values.index if isinstance(values, pd.Series) else None
+
+    pence    = np.asarray(values, dtype=np.int64)
+
+    prefix   = pd.Series(np.where(pence < 0, neg, pos), index=index, dtype=object)
+    pounds   = pd.Series(np.abs(pence) // 100, index=index).map("{:,}".format)
+    minor    = pd.Series(np.abs(pence) %  100, index=index).map("{:02d}".format)
+
+    return prefix + pounds + "." + minor
+#------------------------------------------------------------------------------
+
+def formatPenceAmount(value, symbol=None, sign=None):
+    """
+    Format a single amount in pence as a currency string, matching
+    formatPence.
+
+    Parameters
+    ----------
+    value : Integer
+        The amount to format, in pence.
+    symbol : String, optional
+        The currency symbol. The default is money.currency_symbol.
+    sign : String, optional
+        Where the minus sign goes, "before" or "after" the currency symbol.
+        The default is money.sign_position.
+
+    Returns
+    -------
+    String
+        The formatted amount.
+
+    """
+    return formatPence([value], symbol, sign).iloc[0]
+#------------------------------------------------------------------------------
+
+def sumPence(values, groups=None, n_groups=None):
+    """
+    Sum amounts in pence exactly, either all of them or by group.
+
+    Parameters
+    ----------
+    values : Pandas Series/array like
+        The amounts, in pence.
+    groups : Array like of Integers, optional
+        The group number, from 0, of each amount. The default is None, which
+        sums them all.
+    n_groups : Integer, optional
+        The number of groups. The default is one more than the largest group
+        number.
+
+    Returns
+    -------
+    Integer, or a numpy int64 array with the total of each group.
+
+    """
+    pence = np.asarray(values, dtype=np.int64)
+
+    if groups is None:
+        return int(pence.sum())
+
+    groups   = np.asarray(groups, dtype=np.intp)
+    n_groups = (groups.max() + 1 if len(groups) > 0 else 0) if n_groups is None else n_groups
+    totals   = np.zeros(n_groups, dtype=np.int64)
+    np.add.at(totals, groups, pence)
+
+    return totals
+#------------------------------------------------------------------------------
+
+def splitPence(values, fractions):
+    """
+    Work out a share of amounts in pence, e.g. Courtney's share, rounded to
+    whole pence with halves away from zero.
+
+    Parameters
+    ----------
+    values : Pandas Series/array like
+        The amounts, in pence.
+    fractions : Float or array like of Floats
+        The fraction of each amount that is shared.
+
+    Returns
+    -------
+    numpy int64 array, or an Integer if values was a single amount.
+
+    """
+    pence  = np.asarray(values, dtype=np.int64)
+    shares = _roundHalfAway(pence * np.asarray(fractions, dtype=float))
+
+    if shares.ndim == 0:
+        return int(shares)
+
+    return shares
+#------------------------------------------------------------------------------
+
+class Money():
+    """
+    A single amount of money, held as a whole number of pence so that adding
+    and splitting it is exact.
+    """
+    __slots__ = ["pence"]
+
+    def __init__(self, pence=0):
+        self.pence = int(pence)
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Read an amount typed in pounds, e.g. "12.5", "£1,234.56" or "-3".
+        It is read as a decimal, so it is never rounded through a float.
+
+        Parameters
+        ----------
+        text : String/Float
+            The amount in pounds.
+
+        Returns
+        -------
+        Money
+
+        Raises
+        ------
+        ValueError
+            If the text is not an amount.
+
+        """
+        if isinstance(text, Money):
+            return text
+
+        if isinstance(text, (int, float, np.integer, np.floating)):
+            # The same rounding as toPence, without the array
+            pence = math.floor(abs(float(text)) * 100 + 0.5)
+            return cls(-pence if text < 0 else pence)
+
+        text = str(text).strip().replace(",", "").replace(currency_symbol, "")
+        try:
+            pounds = decimal.Decimal(text)
+        except decimal.InvalidOperation:
+            raise ValueError("`{}` is not an amount of money".format(text))
+
+        if not pounds.is_finite():
+            raise ValueError("`{}` is not an amount of money".format(text))
+
+        return cls(int((pounds * 100).quantize(decimal.Decimal(1), rounding=decimal.ROUND_HALF_UP)))
+
+    @property
+    def pounds(self):
+        """
+        The amount in pounds, as it is stored in the database.
+        """
+        return self.pence / 100
+
+    def split(self, fraction):
+        """
+        The share of this amount for a fraction, see splitPence.
+        """
+        return Money(splitPence(self.pence, fraction))
+
+    def ratio(self, other):
+        """
+        This amount as a fraction of another, 0 if the other is zero.
+        """
+        return self.pence / other.pence if other.pence != 0 else 0
+
+    def __add__(self, other):
+        return Money(self.pence + Money.parse(other).pence)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return Money(self.pence - Money.parse(other).pence)
+
+    def __neg__(self):
+        return Money(-self.pence)
+
+    def __abs__(self):
+        return Money(abs(self.pence))
+
+    def __int__(self):
+        return self.pence
+
+    def __bool__(self):
+        return self.pence != 0
+
+    def __eq__(self, other):
+        try:
+            return self.pence == Money.parse(other).pence
+        except ValueError:
+            return NotImplemented
+
+    def __lt__(self, other):
+        return self.pence < Money.parse(other).pence
+
+    def __hash__(self):
+        return hash(self.pence)
+
+    def __repr__(self):
+        return "Money({})".format(self.pence)
+
+    def __str__(self):
+        # Plain, for an entry box, e.g. "-1234.50"
+        return "{}{}.{:02d}".format("-" if self.pence < 0 else "", abs(self.pence) // 100, abs(self.pence) % 100)
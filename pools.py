@@ -0,0 +1,106 @@
+"""
+The pools of worker processes the report files are rendered with. A pool is
+made the first time it is needed and kept for the next run, so only the
+first run pays for starting the workers, and closed with closePools when
+the software exits.
+
+The workers are started by a fork server rather than forked from this
+process, as a fork of the GUI (or anything else running threads) can copy a
+lock some thread is holding. The fork server imports the rendering modules
+once, so each worker starts with pandas already loaded.
+"""
+
+import atexit
+import threading
+import multiprocessing
+import concurrent.futures
+
+#------------------------------------------------------------------------------
+# Global Variables
+#------------------------------------------------------------------------------
+# How the workers are started, spawn where there is no fork server (Windows)
+pool_context = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+
+# Imported by the fork server before it starts any worker
+preload      = ["report", "database"]
+
+if pool_context.get_start_method() == "forkserver":
+    pool_context.set_forkserver_preload(preload)
+
+# One pool per number of workers, shared by the whole process
+_pools     = {}
+_pool_lock = threading.Lock()
+#------------------------------------------------------------------------------
+
+def getPool(workers):
+    """
+    Return the pool with a number of workers, creating it the first time.
+    The workers themselves are started as they are first needed.
+
+    Parameters
+    ----------
+    workers : Integer
+        The number of worker processes.
+
+    Returns
+    -------
+    concurrent.futures.ProcessPoolExecutor
+
+    """
+    with _pool_lock:
+        if workers not in _pools:
+            _pools[workers] = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=pool_context)
+
+        return _pools[workers]
+#------------------------------------------------------------------------------
+
+def mapOnPool(function, workers, *iterables):
+    """
+    Run function over iterables on the pool with a number of workers, like
+    map, and wait for the results. If a worker dies the pool cannot be used
+    again, so it is dropped and the next call makes a new one.
+
+    Parameters
+    ----------
+    function : Function
+        A module level function, so the workers can import it.
+    workers : Integer
+        The number of worker processes.
+    *iterables : Iterables
+        The arguments, as for map.
+
+    Returns
+    -------
+    List
+        The results, in the order of the arguments.
+
+    """
+    pool = getPool(workers)
+    try:
+        # list() so any error in a worker is raised here
+        return list(pool.map(function, *iterables))
+    except concurrent.futures.process.BrokenProcessPool:
+        with _pool_lock:
+            if _pools.get(workers) is pool:
+                del _pools[workers]
+        raise
+#------------------------------------------------------------------------------
+
+def closePools():
+    """
+    Shut down every pool, once the work they are doing is finished.
+
+    Returns
+    -------
+    None.
+
+    """
+    with _pool_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+
+    for pool in pools:
+        pool.shutdown(wait=True)
+
+atexit.register(closePools)
+#------------------------------------------------------------------------------
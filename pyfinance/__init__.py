@@ -0,0 +1,5 @@
+"""
+Lets the command line interface be run with python -m pyfinance, from the
+directory PyFinance.py is in. The modules themselves stay where they are,
+see cli.
+"""
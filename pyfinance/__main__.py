@@ -0,0 +1,10 @@
+"""
+python -m pyfinance, see cli.
+"""
+
+import sys
+
+import cli
+
+if __name__ == "__main__":
+    sys.exit(cli.main())
@@ -0,0 +1,460 @@
+"""
+The report engine. A month summary is split into all of its views (overview,
+positive, negative, Courtney, Harry, recurring and each category) in a single
+grouped pass, and each view is returned ready to be written out.
+"""
+
+import os
+import hashlib
+import collections
+
+import numpy  as np
+import pandas as pd
+
+import lookup
+import money
+import pools
+import metrics
+
+#------------------------------------------------------------------------------
+# Global Variables
+#------------------------------------------------------------------------------
+# The column names used in the saved files
+replace_dict = {"Date_fmt" : "Date", "Amount_fmt" : "Amount", "Courtney_fmt" : "Courtney", "Courtney" : "Courtney_num", "Amount" : "Amount_num", "Date" : "Date_dt"}
+
+all_columns      = ["Name", "Date", "Category", "Amount", "Courtney"]
+harry_columns    = ["Name", "Date", "Category", "Amount"]
+category_columns = ["Name", "Date", "Amount", "Courtney"]
+
+value_dir        = "value_sorted"
+
+# Views with fewer rows than this between them are written in this process
+# even when workers are given. Sending a view to a warm pool adds about a
+# tenth to its rendering time, and starting the pool about 0.7s, so a smaller
+# month gains little or nothing from the pool.
+parallel_rows    = 2000
+#------------------------------------------------------------------------------
+
+# A single output file, sorted by date and by value
+View = collections.namedtuple("View", ["name", "columns", "by_date", "by_value"])
+
+#------------------------------------------------------------------------------
+def formatColumns(df):
+    """
+    Rename the columns of a month summary to the names used in the saved
+    files, the formatted columns take the plain names.
+
+    Parameters
+    ----------
+    df : Pandas DataFrame
+        The dataframe, usually a month summary.
+
+    Returns
+    -------
+    Pandas DataFrame with the columns renamed.
+
+    """
+    return df.rename(replace_dict, axis=1)
+#------------------------------------------------------------------------------
+
+def csvColumns(df):
+    """
+    The columns of a month summary as they are written to CSV, renamed as
+    formatColumns does with the amounts back in pounds.
+
+    Parameters
+    ----------
+    df : Pandas DataFrame
+        The dataframe, usually a month summary.
+
+    Returns
+    -------
+    Pandas DataFrame
+
+    """
+    df_csv = formatColumns(df)
+    for column in ["Amount_num", "Courtney_num"]:
+        df_csv[column] = money.fromPence(df_csv[column])
+
+    return df_csv
+#------------------------------------------------------------------------------
+
+def totalsRow(amount, courtney, name="Totals"):
+    """
+    Build a totals row for a view.
+
+    Parameters
+    ----------
+    amount : Integer
+        The total amount, in pence.
+    courtney : Integer
+        The total of Courtney's share, in pence.
+    name : String, optional
+        The name of the totals row. The default is "Totals".
+
+    Returns
+    -------
+    Dictionary
+        The totals row.
+
+    """
+    return {"Name" : name, "Category": "TOTAL", "Date": "",
+            "Amount"   : money.formatPenceAmount(amount),
+            "Courtney" : money.formatPenceAmount(courtney)}
+#------------------------------------------------------------------------------
+
+def _stack(*parts):
+    """
+    Stack the rows and totals rows of a view into one DataFrame.
+    """
+    frames = [part if isinstance(part, pd.DataFrame) else pd.DataFrame([part]) for part in parts]
+
+    return pd.concat(frames, ignore_index=True)
+#------------------------------------------------------------------------------
+
+def sortRows(df, column):
+    """
+    Sort the rows by a single column, ascending with missing values (the
+    totals rows) last. The sort is stable, so rows with equal values stay in
+    the order they were in.
+
+    Parameters
+    ----------
+    df : Pandas DataFrame
+        The rows to sort.
+    column : String
+        The column to sort by.
+
+    Returns
+    -------
+    Pandas DataFrame with the rows sorted.
+
+    """
+    return df.sort_values(column, kind="stable")
+#------------------------------------------------------------------------------
+
+def groupRows(df_fmt):
+    """
+    Split the rows into groups in one pass, every row in a group belongs to
+    exactly the same views.
+
+    Parameters
+    ----------
+    df_fmt : Pandas DataFrame
+        The month summary with the formatted column names.
+
+    Returns
+    -------
+    Dictionary
+        Maps (recurring, sign of the amount, has a Courtney share, category)
+        to the positions of the rows in that group.
+
+    """
+    amount   = df_fmt["Amount_num"].to_numpy()
+    courtney = df_fmt["Courtney_num"].to_numpy()
+
+    keys = pd.DataFrame({"Recurring" : df_fmt["Recurring"].to_numpy() == True,
+                         "Sign"      : np.sign(amount),
+                         "Shared"    : courtney != 0,
+                         "Category"  : df_fmt["Category"].to_numpy()})
+
+    return keys.groupby(list(keys.columns), sort=False, dropna=False).indices
+#------------------------------------------------------------------------------
+
+def buildViews(df, totals=None):
+    """
+    Build every view of a month summary.
+
+    Parameters
+    ----------
+    df : Pandas DataFrame
+        The dataframe, usually a month summary.
+    totals : Dictionary, optional
+        Totals already worked out by the database, in the same layout
+        groupRows uses but mapping each group to its (amount, courtney) sums
+        in pence, see database.aggregateTotals. If None the totals are summed from the
+        rows. The default is None.
+
+    Returns
+    -------
+    views : List of View
+        Each view with its file name, the columns to write and the rows sorted
+        by date and by value (totals rows included).
+
+    """
+    df_fmt = formatColumns(df)
+    groups = groupRows(df_fmt)
+
+    def select(test):
+        # The rows of every group passing the test, in their original order
+        positions = [rows for key, rows in groups.items() if test(*key)]
+        if len(positions) == 0:
+            return df_fmt.iloc[:0]
+        return df_fmt.take(np.sort(np.concatenate(positions)))
+
+    def sums(part, test):
+        # The (amount, courtney) totals of a view
+        if totals is None:
+            return money.sumPence(part["Amount_num"]), money.sumPence(part["Courtney_num"])
+        matching = [value for key, value in totals.items() if test(*key)]
+        return sum(amount for amount, _ in matching), sum(courtney for _, courtney in matching)
+    #--------------------------------------------------------------------------
+
+    views = []
+
+    #--------------------------------------------------------------------------
+    # All Enteries
+    #--------------------------------------------------------------------------
+    rec_test = lambda rec, sign, shared, cat: rec
+    exp_test = lambda rec, sign, shared, cat: not rec
+
+    rec_df = select(rec_test)
+    exp_df = select(exp_test)
+
+    rec_sums = sums(rec_df, rec_test)
+    exp_sums = sums(exp_df, exp_test)
+
+    total_rec = totalsRow(*rec_sums, "Recurring Expenses Total")
+    total_exp = totalsRow(*exp_sums, "Itemised Expenses Total")
+    total_gnd = totalsRow(rec_sums[0] + exp_sums[0], rec_sums[1] + exp_sums[1], "Grand Total")
+
+    # Recurring first, each group headed by its totals
+    by_date  = _stack(total_gnd, total_rec, rec_df, total_exp, exp_df)
+    by_value = _stack(sortRows(pd.concat([rec_df, exp_df]), "Amount_num"), total_rec, total_exp, total_gnd)
+    views.append(View("overview.html", all_columns, by_date, by_value))
+
+    #--------------------------------------------------------------------------
+    # All Positive/Negative Enteries
+    #--------------------------------------------------------------------------
+    for name, sign in [("positive-expenses.html", 1), ("negative-expenses.html", -1)]:
+        test    = lambda rec, _sign, shared, cat: not rec and _sign == sign
+        part    = sortRows(select(test), "Amount_num")
+        by_date = sortRows(_stack(part, totalsRow(*sums(part, test))), "Date")
+        views.append(View(name, all_columns, by_date, sortRows(by_date, "Amount_num")))
+
+    #--------------------------------------------------------------------------
+    # Courtney, Harry and Recurring Only Enteries
+    #--------------------------------------------------------------------------
+    for name, columns, sort_column, test in [("courtney.html",  all_columns,   "Courtney_num", lambda rec, sign, shared, cat: shared),
+                                             ("harry.html",     harry_columns, "Amount_num",   lambda rec, sign, shared, cat: not shared),
+                                             ("recurring.html", all_columns,   "Amount_num",   rec_test)]:
+        part    = select(test)
+        by_date = _stack(part, totalsRow(*sums(part, test)))
+        views.append(View(name, columns, by_date, sortRows(by_date, sort_column)))
+
+    #--------------------------------------------------------------------------
+    # Each Category
+    #--------------------------------------------------------------------------
+    for category in df_fmt["Category"].unique():
+        if category != "TOTAL":
+            test    = lambda rec, sign, shared, cat: cat == category
+            part    = select(test)
+            by_date = _stack(part, totalsRow(*sums(part, test)))
+            views.append(View("{}.html".format(category.lower()), category_columns, by_date, sortRows(by_date, "Amount_num")))
+
+    return views
+#------------------------------------------------------------------------------
+
+def frameHash(df, columns=None):
+    """
+    Hash the contents of a DataFrame, its column names and every value in
+    row order. The index is ignored.
+
+    Parameters
+    ----------
+    df : Pandas DataFrame
+        The rows to hash.
+    columns : List of Strings, optional
+        Only hash these columns. The default is all of them.
+
+    Returns
+    -------
+    String
+        The hex digest.
+
+    """
+    if columns is not None:
+        df = df[columns]
+
+    digest = hashlib.sha1(repr(list(df.columns)).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+
+    return digest.hexdigest()
+#------------------------------------------------------------------------------
+
+def viewHash(view):
+    """
+    Hash everything that ends up in a view's files, so a view whose hash has
+    not changed does not need writing again.
+
+    Parameters
+    ----------
+    view : View
+        The view to hash.
+
+    Returns
+    -------
+    String
+        The hex digest.
+
+    """
+    return hashlib.sha1("{}|{}|{}".format(view.name,
+                                          frameHash(view.by_date,  view.columns),
+                                          frameHash(view.by_value, view.columns)).encode("utf-8")).hexdigest()
+#------------------------------------------------------------------------------
+
+def writeView(view, root="."):
+    """
+    Write a view out as HTML, sorted by date in root and sorted by value in
+    the value_sorted directory.
+
+    Parameters
+    ----------
+    view : View
+        The view to write.
+    root : String, optional
+        The path to the root directory where the output files are saved.
+
+    Returns
+    -------
+    Integer
+        The number of bytes written.
+
+    """
+    size = 0
+    for df, directory in [(view.by_date, root), (view.by_value, os.path.join(root, value_dir))]:
+        with open(os.path.join(directory, view.name), "w", encoding="utf-8") as f:
+            df.to_html(f, columns=view.columns, col_space=150, justify="center", index=False)
+            size += f.tell()
+    
+    return size
+#------------------------------------------------------------------------------
+
+def writeViews(views, root=".", workers=1):
+    """
+    Write out several views, spread over a pool of worker processes (see
+    pools) once they have parallel_rows between them. Each view is its own
+    pair of files, so they can be rendered in any order and the output is
+    the same however many workers are used.
+
+    Parameters
+    ----------
+    views : List of View
+        The views to write.
+    root : String, optional
+        The path to the root directory where the output files are saved.
+    workers : Integer, optional
+        The number of worker processes, 1 writes them one after another in
+        this process. The default is 1.
+
+    Returns
+    -------
+    List of Strings
+        The names of the views written, in the order they were given.
+
+    """
+    if workers <= 1 or len(views) <= 1 or sum(len(view.by_date) for view in views) < parallel_rows:
+        sizes = [writeView(view, root) for view in views]
+    else:
+        sizes = pools.mapOnPool(writeView, workers, views, [root] * len(views))
+
+    # Counted here, as the workers' metrics stay in the workers
+    metrics.count("files_written", 2 * len(views))
+    metrics.count("bytes_written", sum(sizes))
+
+    return [view.name for view in views]
+#------------------------------------------------------------------------------
+
+def buildRollup(df, freq="M"):
+    """
+    Roll a range of enteries up into one row per period, with the total for
+    each category, the recurring and itemised totals, the grand total and
+    Courtney's total. Periods with no enteries are included as zeros.
+
+    Parameters
+    ----------
+    df : Pandas DataFrame
+        The enteries in the range, with the database column names.
+    freq : String, optional
+        The length of each period as a Pandas frequency. The default is "M".
+
+    Returns
+    -------
+    rollup : Pandas DataFrame
+        One row per period plus a final totals row, with a "Period" column
+        and the totals in pence.
+
+    """
+    period   = df["Date"].dt.to_period(freq).rename("Period")
+    index    = pd.period_range(period.min(), period.max(), freq=freq, name="Period")
+    category = df["Category"].astype(object)
+
+    # Categories in the order they are listed in, any unknown ones after
+    categories = category.unique()
+    categories = [cat for cat in lookup.valid_categories if cat in categories] + sorted(set(categories) - set(lookup.valid_categories))
+
+    rollup = df.groupby([period, category])["Amount"].sum().unstack(fill_value=0).reindex(index=index, columns=categories, fill_value=0)
+
+    recurring = df.groupby([period, df["Recurring"] == True])["Amount"].sum().unstack(fill_value=0)
+    rollup["Recurring"] = recurring.get(True,  0)
+    rollup["Itemised"]  = recurring.get(False, 0)
+    rollup["Total"]     = df.groupby(period)["Amount"].sum()
+    rollup["Courtney"]  = df.groupby(period)["Courtney"].sum()
+    rollup = rollup.fillna(0).astype(np.int64)
+
+    # Name each row, and add the totals to the end
+    if freq.startswith("M"):
+        names = index.strftime("%b-%Y")
+    else:
+        names = index.astype(str)
+
+    rollup.loc["Totals"] = rollup.sum()
+    rollup.insert(0, "Period", list(names) + ["Totals"])
+
+    return rollup.reset_index(drop=True)
+#------------------------------------------------------------------------------
+
+def csvRollup(rollup):
+    """
+    A rollup from buildRollup as it is written to CSV, with the totals in
+    pounds.
+
+    Parameters
+    ----------
+    rollup : Pandas DataFrame
+        The rollup.
+
+    Returns
+    -------
+    Pandas DataFrame
+
+    """
+    rollup_csv = rollup.copy()
+    for column in rollup_csv.columns[1:]:
+        rollup_csv[column] = money.fromPence(rollup_csv[column])
+
+    return rollup_csv
+#------------------------------------------------------------------------------
+
+def writeRollup(rollup, root="."):
+    """
+    Write a rollup from buildRollup out as HTML, with the amounts formatted.
+
+    Parameters
+    ----------
+    rollup : Pandas DataFrame
+        The rollup to write.
+    root : String, optional
+        The path to the root directory where the output files are saved.
+
+    Returns
+    -------
+    None.
+
+    """
+    rollup_fmt = rollup.copy()
+    for column in rollup_fmt.columns[1:]:
+        rollup_fmt[column] = money.formatPence(rollup_fmt[column])
+
+    with open(os.path.join(root, "rollup.html"), "w", encoding="utf-8") as f:
+        rollup_fmt.to_html(f, col_space=150, justify="center", index=False)
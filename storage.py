@@ -0,0 +1,866 @@
+"""
+The storage backends. Everything in the software reads and writes the
+expenses through a collection, and only uses a small part of the PyMongo
+Collection API: find (with sort, limit and batch_size), insert_many,
+delete_one, bulk_write of UpdateOne, count_documents, aggregate with $match
+and $group, create_indexes, drop and rename, and collection.database[name]
+for the other collections. That part of the API is the storage interface.
+
+There are two backends:
+
+    MongoDB : PyMongo itself, for any other address.
+    SQLite  : SQLiteClient, an embedded database in a single file, for an
+              address "sqlite:<path>", e.g. "sqlite:~/finances.db".
+
+database.getClient picks the backend from the address, so the gui, the
+command line and the benchmarks run the same code against either. With
+SQLite no server is needed at all. The queries and aggregations are
+translated to SQL, so they run in SQLite with its indexes, which are created
+from the same IndexModels as the MongoDB ones.
+"""
+
+import os
+import numbers
+import sqlite3
+import threading
+import contextlib
+
+from   datetime import datetime
+
+import bson
+import pymongo
+import pymongo.errors
+import pymongo.results
+
+#------------------------------------------------------------------------------
+# Global Variables
+#------------------------------------------------------------------------------
+sqlite_prefix = "sqlite:"
+
+# Dates are stored as text in this format, it sorts in date order
+date_format   = "%Y-%m-%d %H:%M:%S.%f"
+
+# How long a write waits for another one to finish (seconds)
+busy_timeout  = 30
+
+# The table recording the fields of each collection, in the order they were
+# first written, and which hold dates, ObjectIds and booleans, as SQLite has
+# no types for them
+fields_table  = "_pyfinance_fields"
+
+# The comparison operators in a filter, and their SQL
+comparisons   = {"$eq" : "=", "$gt" : ">", "$gte" : ">=", "$lt" : "<", "$lte" : "<="}
+
+# The aggregation accumulators, and their SQL
+accumulators  = {"$sum" : "SUM", "$max" : "MAX", "$min" : "MIN"}
+#------------------------------------------------------------------------------
+
+def isSQLite(address):
+    """
+    Whether an address is for the SQLite backend.
+
+    Parameters
+    ----------
+    address : String
+        The address of the database, e.g. "localhost" or "sqlite:finances.db".
+
+    Returns
+    -------
+    Boolean
+
+    """
+    return str(address).startswith(sqlite_prefix)
+#------------------------------------------------------------------------------
+
+def sqlitePath(address):
+    """
+    The path of the SQLite file in an address.
+    """
+    return os.path.abspath(os.path.expanduser(address[len(sqlite_prefix):]))
+#------------------------------------------------------------------------------
+
+def _kind(value):
+    """
+    The kind of value recorded for a field, "value" for the values SQLite
+    stores as they are.
+    """
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, datetime):
+        return "datetime"
+    if isinstance(value, bson.ObjectId):
+        return "objectid"
+
+    return "value"
+#------------------------------------------------------------------------------
+
+def _toSQL(value):
+    """
+    Convert a value to one SQLite can store.
+    """
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, datetime):
+        return value.strftime(date_format)
+    if isinstance(value, bson.ObjectId):
+        return str(value)
+    if isinstance(value, numbers.Integral):
+        return int(value)
+    if isinstance(value, numbers.Real):
+        return float(value)
+    if value is None or isinstance(value, str):
+        return value
+
+    raise TypeError("The SQLite backend cannot store a {}".format(type(value).__name__))
+#------------------------------------------------------------------------------
+
+def _fromSQL(value, kind):
+    """
+    Convert a value read from SQLite back, given the kind of its field.
+    """
+    if value is None or kind is None:
+        return value
+    if kind == "bool":
+        return bool(value)
+    if kind == "datetime":
+        return datetime.fromisoformat(value)
+    if kind == "objectid":
+        return bson.ObjectId(value)
+
+    return value
+#------------------------------------------------------------------------------
+
+def _queryPlan(connection, sql, params):
+    """
+    The plan SQLite picks for a query, in the shape of a MongoDB winning
+    plan, a COLLSCAN, IXSCAN or SORT stage for each step.
+    """
+    plan = None
+    for row in connection.execute("EXPLAIN QUERY PLAN " + sql, params):
+        detail = row[-1]
+        # A scan in the order of an index walks the index, e.g. for a sort
+        if detail.startswith("SEARCH") or (detail.startswith("SCAN") and "USING" in detail and "INDEX" in detail):
+            stage = "IXSCAN"
+        elif detail.startswith("SCAN"):
+            stage = "COLLSCAN"
+        elif "ORDER BY" in detail:
+            stage = "SORT"
+        else:
+            continue
+        plan = {"stage" : stage, "detail" : detail} if plan is None else {"stage" : stage, "detail" : detail, "inputStage" : plan}
+
+    return plan or {"stage" : "EOF"}
+#------------------------------------------------------------------------------
+
+def _quote(name):
+    """
+    Quote a table, column or index name for SQL.
+    """
+    return '"{}"'.format(str(name).replace('"', '""'))
+#------------------------------------------------------------------------------
+
+class SQLiteClient():
+    """
+    A SQLite file standing in for a MongoClient. Each database in it is a
+    set of tables named "<database>.<collection>". Each thread gets its own
+    connection, and the file is in WAL mode, so reads never wait on writes.
+    """
+    def __init__(self, path):
+        self.path        = path
+        self.local       = threading.local()
+        self.lock        = threading.Lock()
+        self.connections = []
+        self.databases   = {}
+        self.fields      = {}   # The fields of each table, and their kinds
+
+        directory = os.path.dirname(path)
+        if directory != "" and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        with self.write() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS {} (tbl TEXT, field TEXT, kind TEXT, position INTEGER, PRIMARY KEY (tbl, field))".format(fields_table))
+
+    def connection(self):
+        """
+        The connection for the calling thread, opened the first time.
+        """
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+
+        return connection
+
+    @contextlib.contextmanager
+    def write(self):
+        """
+        A write transaction, committed at the end of the with block or rolled
+        back if it raises.
+        """
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def table_fields(self, table, refresh=False):
+        """
+        The fields (columns) of a table and their kinds, cached, as another
+        process may add fields it is read again when an unknown one is used.
+        They are in the order they were first written, with _id first like
+        MongoDB, and any not written yet (e.g. only indexed) last with the
+        kind None.
+        """
+        with self.lock:
+            if table in self.fields and not refresh:
+                return self.fields[table]
+
+        connection = self.connection()
+        columns    = [row[1] for row in connection.execute("PRAGMA table_info({})".format(_quote(table)))]
+        kinds      = dict(connection.execute("SELECT field, kind FROM {} WHERE tbl = ? ORDER BY field != '_id', position".format(fields_table), (table,)))
+        fields     = {column : kind for column, kind in kinds.items() if column in columns}
+        fields.update((column, None) for column in columns if column not in fields)
+
+        with self.lock:
+            self.fields[table] = fields
+
+        return fields
+
+    def forget(self, table):
+        """
+        Forget the cached fields of a table, after it is dropped or renamed.
+        """
+        with self.lock:
+            self.fields.pop(table, None)
+
+    def __getitem__(self, name):
+        with self.lock:
+            if name not in self.databases:
+                self.databases[name] = SQLiteDatabase(self, name)
+            return self.databases[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def drop_database(self, name):
+        """
+        Drop every collection in a database.
+        """
+        prefix = "{}.".format(name)
+        tables = [row[0] for row in self.connection().execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        for table in tables:
+            if table.startswith(prefix):
+                self[name][table[len(prefix):]].drop()
+
+    def close(self):
+        """
+        Close every connection.
+        """
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.close()
+        self.local = threading.local()
+#------------------------------------------------------------------------------
+
+class SQLiteDatabase():
+    """
+    A database in a SQLite file, standing in for a PyMongo Database.
+    """
+    def __init__(self, client, name):
+        self.client      = client
+        self.name        = name
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = SQLiteCollection(self, name)
+        return self.collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def command(self, name, *args, **kwargs):
+        """
+        Run a database command, only "ping" and explaining an "aggregate"
+        (as database.explainQueries does) are needed.
+        """
+        if name == "aggregate" and kwargs.get("explain"):
+            return self[args[0]].explain_aggregate(kwargs["pipeline"])
+        if name != "ping":
+            raise NotImplementedError("The SQLite backend does not support the {} command".format(name))
+
+        self.client.connection().execute("SELECT 1")
+
+        return {"ok" : 1.0}
+#------------------------------------------------------------------------------
+
+class SQLiteCollection():
+    """
+    A collection in a SQLite file, standing in for a PyMongo Collection. Each
+    field is a column, added the first time a document has it, so documents
+    read back with the same fields and types they were written with.
+    """
+    def __init__(self, database, name):
+        self.database = database
+        self.client   = database.client
+        self.name     = name
+        self.table    = "{}.{}".format(database.name, name)
+
+    #--------------------------------------------------------------------------
+    # Fields and filters
+    #--------------------------------------------------------------------------
+    def _fields(self, refresh=False):
+        return self.client.table_fields(self.table, refresh)
+
+    def _column(self, field, fields):
+        # A field no document has yet is missing, i.e. NULL
+        if "." in field:
+            raise NotImplementedError("The SQLite backend does not support dotted fields, `{}`".format(field))
+        if field not in fields:
+            fields.update(self._fields(refresh=True))
+        return _quote(field) if field in fields else "NULL"
+
+    def _create(self, connection):
+        connection.execute('CREATE TABLE IF NOT EXISTS {} ("_id" PRIMARY KEY)'.format(_quote(self.table)))
+
+    def _add_fields(self, connection, docs):
+        # Add a column for any field not seen before, recording its kind
+        fields = self._fields(refresh=True)
+        added  = False
+        for doc in docs:
+            for field, value in doc.items():
+                # Columns made for an index have no kind until the first value
+                if value is None or (field in fields and fields[field] is not None):
+                    continue
+                if "." in field or field.startswith("$"):
+                    raise ValueError("The field name `{}` is not allowed".format(field))
+
+                if field not in fields:
+                    connection.execute("ALTER TABLE {} ADD COLUMN {}".format(_quote(self.table), _quote(field)))
+                connection.execute("INSERT OR REPLACE INTO {0} VALUES (?, ?, ?, (SELECT COUNT(*) FROM {0} WHERE tbl = ?))".format(fields_table), (self.table, field, _kind(value), self.table))
+                fields[field] = _kind(value)
+                added         = True
+
+        if added:
+            self.client.forget(self.table)
+
+    def _where(self, query, fields):
+        """
+        Translate a filter into a SQL condition and its parameters.
+        """
+        conditions = []
+        params     = []
+
+        for field, condition in (query or {}).items():
+            if field in ("$and", "$or"):
+                parts = [self._where(part, fields) for part in condition]
+                conditions.append("(" + " {} ".format(field[1:].upper()).join(sql for sql, _ in parts) + ")")
+                for _, part_params in parts:
+                    params.extend(part_params)
+                continue
+
+            column = self._column(field, fields)
+            if not (isinstance(condition, dict) and len(condition) > 0 and all(key.startswith("$") for key in condition)):
+                condition = {"$eq" : condition}
+
+            for operator, value in condition.items():
+                if operator in comparisons and value is None:
+                    conditions.append("{} IS NULL".format(column))
+                elif operator in comparisons:
+                    conditions.append("{} {} ?".format(column, comparisons[operator]))
+                    params.append(_toSQL(value))
+                elif operator == "$ne" and value is None:
+                    conditions.append("{} IS NOT NULL".format(column))
+                elif operator == "$ne":
+                    conditions.append("({0} IS NULL OR {0} != ?)".format(column))
+                    params.append(_toSQL(value))
+                elif operator in ("$in", "$nin"):
+                    values = list(value)
+                    if len(values) == 0:
+                        conditions.append("0" if operator == "$in" else "1")
+                        continue
+                    negate = "NOT " if operator == "$nin" else ""
+                    conditions.append("{} {}IN ({})".format(column, negate, ", ".join("?" * len(values))))
+                    params.extend(_toSQL(item) for item in values)
+                elif operator == "$exists":
+                    conditions.append("{} IS {}NULL".format(column, "NOT " if value else ""))
+                else:
+                    raise NotImplementedError("The SQLite backend does not support {} in a filter".format(operator))
+
+        return " AND ".join(conditions) if conditions else "1", params
+
+    def _expression(self, expression, fields, params):
+        """
+        Translate an aggregation expression into SQL, adding any parameters
+        to params, and return it with the kind of value it gives.
+        """
+        if isinstance(expression, str) and expression.startswith("$"):
+            field = expression[1:]
+            return self._column(field, fields), fields.get(field)
+
+        if not isinstance(expression, dict):
+            params.append(_toSQL(expression))
+            return "?", _kind(expression)
+
+        (operator, args), = expression.items()
+        if operator in ("$add", "$multiply"):
+            parts = [self._expression(arg, fields, params)[0] for arg in args]
+            return "(" + (" + " if operator == "$add" else " * ").join(parts) + ")", None
+        if operator in ("$trunc", "$toLong"):
+            return "CAST({} AS INTEGER)".format(self._expression(args, fields, params)[0]), None
+        if operator in ("$cmp", "$eq", "$ne"):
+            both  = []
+            left  = self._expression(args[0], fields, both)[0]
+            right = self._expression(args[1], fields, both)[0]
+            if operator == "$cmp":
+                # Each side is in the SQL twice, so are its parameters
+                params.extend(both * 2)
+                return "(CASE WHEN {0} < {1} THEN -1 WHEN {0} > {1} THEN 1 ELSE 0 END)".format(left, right), None
+            params.extend(both)
+            return "(COALESCE({}, 'null') {} COALESCE({}, 'null'))".format(left, "=" if operator == "$eq" else "!=", right), "bool"
+        if operator == "$ifNull":
+            parts = [self._expression(arg, fields, params)[0] for arg in args]
+            return "COALESCE({})".format(", ".join(parts)), None
+        if operator in ("$year", "$month"):
+            part = "%Y" if operator == "$year" else "%m"
+            return "CAST(strftime('{}', {}) AS INTEGER)".format(part, self._expression(args, fields, params)[0]), None
+        if operator == "$dateFromParts":
+            year  = self._expression(args["year"],        fields, params)[0]
+            month = self._expression(args.get("month", 1), fields, params)[0]
+            day   = self._expression(args.get("day", 1),   fields, params)[0]
+            return "printf('%04d-%02d-%02d 00:00:00.000000', {}, {}, {})".format(year, month, day), "datetime"
+
+        raise NotImplementedError("The SQLite backend does not support {} in an expression".format(operator))
+
+    def _document(self, names, kinds, row):
+        # Missing fields are NULL, and left out like MongoDB would
+        return {name : _fromSQL(value, kind) for name, kind, value in zip(names, kinds, row) if value is not None}
+
+    #--------------------------------------------------------------------------
+    # Reading
+    #--------------------------------------------------------------------------
+    def find(self, filter=None, projection=None):
+        """
+        Find the documents matching a filter, see SQLiteCursor.
+        """
+        return SQLiteCursor(self, filter, projection)
+
+    def count_documents(self, filter):
+        """
+        Count the documents matching a filter.
+        """
+        fields = dict(self._fields())
+        if len(fields) == 0:
+            return 0
+
+        where, params = self._where(filter, fields)
+
+        return self.client.connection().execute("SELECT COUNT(*) FROM {} WHERE {}".format(_quote(self.table), where), params).fetchone()[0]
+
+    def _group_sql(self, pipeline):
+        # The SQL for a pipeline of $match stages followed by a single
+        # $group, with its parameters, the group's _id, the (name, kind) of
+        # each part of it and of each total. None if there is nothing to
+        # group.
+        fields = dict(self._fields())
+        query  = {}
+        group  = None
+        for stage in pipeline:
+            (name, spec), = stage.items()
+            if name == "$match" and group is None:
+                query = {"$and" : [query, spec]} if query else spec
+            elif name == "$group" and group is None:
+                group = spec
+            else:
+                raise NotImplementedError("The SQLite backend does not support the {} stage here".format(name))
+
+        if group is None or len(fields) == 0:
+            return None
+
+        params  = []
+        selects = []
+        keys    = []   # (name, kind) of each part of the group _id
+        key     = group["_id"]
+        if isinstance(key, dict):
+            for name, expression in key.items():
+                sql, kind = self._expression(expression, fields, params)
+                selects.append(sql)
+                keys.append((name, kind))
+        elif key is not None:
+            sql, kind = self._expression(key, fields, params)
+            selects.append(sql)
+            keys.append((None, kind))
+
+        totals = []
+        for name, accumulator in group.items():
+            if name == "_id":
+                continue
+            (operator, expression), = accumulator.items()
+            if operator not in accumulators:
+                raise NotImplementedError("The SQLite backend does not support the {} accumulator".format(operator))
+            sql, kind = self._expression(expression, fields, params)
+            selects.append("{}({})".format(accumulators[operator], sql))
+            totals.append((name, kind if operator != "$sum" else None))
+
+        where, where_params = self._where(query, fields)
+        # A group with no _id and no totals still needs something to select
+        sql = "SELECT {} FROM {} WHERE {}".format(", ".join(selects) or "COUNT(*)", _quote(self.table), where)
+        if len(keys) > 0:
+            sql += " GROUP BY " + ", ".join(str(i + 1) for i in range(len(keys)))
+        else:
+            sql += " HAVING COUNT(*) > 0"
+
+        return sql, params + where_params, key, keys, totals
+
+    def aggregate(self, pipeline):
+        """
+        Run an aggregation pipeline of $match stages followed by a single
+        $group, the only ones the software needs, as one SQL query.
+        """
+        query = self._group_sql(pipeline)
+        if query is None:
+            return iter([])
+
+        sql, params, key, keys, totals = query
+        results = []
+        for row in self.client.connection().execute(sql, params):
+            if isinstance(key, dict):
+                _id = {name : _fromSQL(value, kind) for (name, kind), value in zip(keys, row)}
+            elif key is not None:
+                _id = _fromSQL(row[0], keys[0][1])
+            else:
+                _id = None
+
+            result = {"_id" : _id}
+            for (name, kind), value in zip(totals, row[len(keys):]):
+                result[name] = _fromSQL(value, kind)
+            results.append(result)
+
+        return iter(results)
+
+    def explain_aggregate(self, pipeline):
+        """
+        The SQLite query plan of an aggregation pipeline, in the shape of a
+        MongoDB explain, see SQLiteCursor.explain.
+        """
+        query = self._group_sql(pipeline)
+        if query is None:
+            return {"queryPlanner" : {"winningPlan" : {"stage" : "EOF"}}}
+
+        return {"queryPlanner" : {"winningPlan" : _queryPlan(self.client.connection(), query[0], query[1])}}
+
+    #--------------------------------------------------------------------------
+    # Writing
+    #--------------------------------------------------------------------------
+    def insert_many(self, documents, ordered=True):
+        """
+        Insert documents, giving any without an _id a new ObjectId. A
+        duplicate _id or unique index key raises a BulkWriteError with code
+        11000, as MongoDB would, after the rest have been written (or, if
+        ordered, those before it).
+        """
+        docs   = list(documents)
+        errors = []
+        for doc in docs:
+            if "_id" not in doc:
+                doc["_id"] = bson.ObjectId()
+
+        with self.client.write() as connection:
+            self._create(connection)
+            self._add_fields(connection, docs)
+
+            for i, doc in enumerate(docs):
+                names = [field for field, value in doc.items() if value is not None]
+                sql   = "INSERT INTO {} ({}) VALUES ({})".format(_quote(self.table), ", ".join(_quote(name) for name in names), ", ".join("?" * len(names)))
+                try:
+                    connection.execute(sql, [_toSQL(doc[name]) for name in names])
+                except sqlite3.IntegrityError as error:
+                    errors.append({"index" : i, "code" : 11000, "errmsg" : str(error), "op" : doc})
+                    if ordered:
+                        break
+
+        if len(errors) > 0:
+            raise pymongo.errors.BulkWriteError({"writeErrors" : errors, "writeConcernErrors" : [], "nInserted" : len(docs) - len(errors),
+                                                 "nUpserted" : 0, "nMatched" : 0, "nModified" : 0, "nRemoved" : 0, "upserted" : []})
+
+        return pymongo.results.InsertManyResult([doc["_id"] for doc in docs], True)
+
+    def delete_one(self, filter):
+        """
+        Delete the first document matching a filter.
+        """
+        fields = dict(self._fields())
+        if len(fields) == 0:
+            return pymongo.results.DeleteResult({"n" : 0}, True)
+
+        where, params = self._where(filter, fields)
+        with self.client.write() as connection:
+            cursor = connection.execute("DELETE FROM {0} WHERE rowid IN (SELECT rowid FROM {0} WHERE {1} LIMIT 1)".format(_quote(self.table), where), params)
+
+        return pymongo.results.DeleteResult({"n" : cursor.rowcount}, True)
+
+    def bulk_write(self, requests, ordered=True):
+        """
+        Apply UpdateOne requests, with $set, $unset, $inc and $setOnInsert,
+        in a single transaction. A duplicate unique index key raises a
+        BulkWriteError with code 11000, as MongoDB would, after the rest
+        have been applied (or, if ordered, those before it).
+        """
+        result = {"writeErrors" : [], "writeConcernErrors" : [], "nInserted" : 0, "nUpserted" : 0, "nMatched" : 0, "nModified" : 0, "nRemoved" : 0, "upserted" : []}
+
+        def failed(i, request, error):
+            result["writeErrors"].append({"index" : i, "code" : 11000, "errmsg" : str(error),
+                                          "op" : {"q" : request._filter, "u" : request._doc, "upsert" : bool(request._upsert)}})
+
+        with self.client.write() as connection:
+            self._create(connection)
+
+            for i, request in enumerate(requests):
+                if not isinstance(request, pymongo.UpdateOne):
+                    raise NotImplementedError("The SQLite backend only supports UpdateOne in bulk_write")
+
+                query, update = request._filter, request._doc
+                unknown       = set(update) - {"$set", "$unset", "$inc", "$setOnInsert"}
+                if unknown:
+                    raise NotImplementedError("The SQLite backend does not support {} in an update".format(", ".join(sorted(unknown))))
+
+                fields        = dict(self._fields())
+                where, params = self._where(query, fields)
+                names         = list(fields)
+                row           = connection.execute("SELECT rowid, {} FROM {} WHERE {} LIMIT 1".format(", ".join(_quote(name) for name in names), _quote(self.table), where), params).fetchone()
+
+                if row is None:
+                    if not request._upsert:
+                        continue
+                    # The equality parts of the filter are part of the new document
+                    doc = {field : value for field, value in query.items() if not field.startswith("$") and not isinstance(value, dict)}
+                    doc.update(update.get("$setOnInsert", {}))
+                    doc.update(update.get("$set", {}))
+                    for field, value in update.get("$inc", {}).items():
+                        doc[field] = doc.get(field, 0) + value
+                    for field in update.get("$unset", {}):
+                        doc.pop(field, None)
+                    doc.setdefault("_id", bson.ObjectId())
+
+                    self._add_fields(connection, [doc])
+                    insert = [field for field, value in doc.items() if value is not None]
+                    try:
+                        connection.execute("INSERT INTO {} ({}) VALUES ({})".format(_quote(self.table), ", ".join(_quote(field) for field in insert), ", ".join("?" * len(insert))),
+                                           [_toSQL(doc[field]) for field in insert])
+                    except sqlite3.IntegrityError as error:
+                        failed(i, request, error)
+                        if ordered:
+                            break
+                        continue
+                    result["nUpserted"] += 1
+                    result["upserted"].append({"index" : i, "_id" : doc["_id"]})
+                    continue
+
+                old = self._document(names, [fields[name] for name in names], row[1:])
+                new = dict(old)
+                new.update(update.get("$set", {}))
+                for field, value in update.get("$inc", {}).items():
+                    new[field] = new.get(field, 0) + value
+                for field in update.get("$unset", {}):
+                    new.pop(field, None)
+
+                # An unset field goes back to NULL
+                changed = {field : value for field, value in new.items() if field not in old or old[field] != value or type(old[field]) != type(value)}
+                changed.update((field, None) for field in old if field not in new)
+                if len(changed) == 0:
+                    result["nMatched"] += 1
+                    continue
+
+                self._add_fields(connection, [changed])
+                try:
+                    connection.execute("UPDATE {} SET {} WHERE rowid = ?".format(_quote(self.table), ", ".join("{} = ?".format(_quote(field)) for field in changed)),
+                                       [_toSQL(value) for value in changed.values()] + [row[0]])
+                except sqlite3.IntegrityError as error:
+                    failed(i, request, error)
+                    if ordered:
+                        break
+                    continue
+                result["nMatched"]  += 1
+                result["nModified"] += 1
+
+        if len(result["writeErrors"]) > 0:
+            raise pymongo.errors.BulkWriteError(result)
+
+        return pymongo.results.BulkWriteResult(result, True)
+
+    #--------------------------------------------------------------------------
+    # Indexes and the collection itself
+    #--------------------------------------------------------------------------
+    def create_indexes(self, indexes):
+        """
+        Create SQL indexes from PyMongo IndexModels, partial ones included.
+        """
+        names = []
+        with self.client.write() as connection:
+            self._create(connection)
+
+            for index in indexes:
+                spec = index.document
+                keys = list(spec["key"].items())
+
+                # The columns must exist to be indexed, their kind is set by
+                # the first document that has them
+                fields = self._fields(refresh=True)
+                for field, _ in keys:
+                    if field not in fields:
+                        connection.execute("ALTER TABLE {} ADD COLUMN {}".format(_quote(self.table), _quote(field)))
+                self.client.forget(self.table)
+                fields = dict(self._fields(refresh=True))
+
+                sql = "CREATE {}INDEX IF NOT EXISTS {} ON {} ({})".format("UNIQUE " if spec.get("unique") else "",
+                                                                         _quote("{}.{}".format(self.table, spec["name"])), _quote(self.table),
+                                                                         ", ".join("{} {}".format(_quote(field), "DESC" if direction == -1 else "ASC") for field, direction in keys))
+                params = []
+                if "partialFilterExpression" in spec:
+                    where, params = self._where(spec["partialFilterExpression"], fields)
+                    if len(params) > 0:
+                        raise NotImplementedError("The SQLite backend only supports $exists in a partial index")
+                    sql += " WHERE " + where
+
+                connection.execute(sql)
+                names.append(spec["name"])
+
+        return names
+
+    def index_information(self):
+        """
+        The indexes on the collection, by name.
+        """
+        prefix = self.table + "."
+        rows   = self.client.connection().execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ?", (self.table,))
+
+        return {name[len(prefix):] : {"sql" : sql} for name, sql in rows if name.startswith(prefix)}
+
+    def drop(self):
+        """
+        Drop the collection and its indexes.
+        """
+        with self.client.write() as connection:
+            connection.execute("DROP TABLE IF EXISTS {}".format(_quote(self.table)))
+            connection.execute("DELETE FROM {} WHERE tbl = ?".format(fields_table), (self.table,))
+        self.client.forget(self.table)
+
+    def rename(self, new_name, dropTarget=False):
+        """
+        Rename the collection, replacing new_name if dropTarget, in a single
+        transaction so readers see either the old or the new one.
+        """
+        target = "{}.{}".format(self.database.name, new_name)
+
+        with self.client.write() as connection:
+            if dropTarget:
+                connection.execute("DROP TABLE IF EXISTS {}".format(_quote(target)))
+                connection.execute("DELETE FROM {} WHERE tbl = ?".format(fields_table), (target,))
+
+            connection.execute("ALTER TABLE {} RENAME TO {}".format(_quote(self.table), _quote(target)))
+            connection.execute("UPDATE {} SET tbl = ? WHERE tbl = ?".format(fields_table), (target, self.table))
+
+            # SQLite keeps the index names, so rename them to match
+            for name, sql in list(connection.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (target,))):
+                if name.startswith(self.table + "."):
+                    new_index = target + name[len(self.table):]
+                    connection.execute("DROP INDEX {}".format(_quote(name)))
+                    connection.execute(sql.replace(_quote(name), _quote(new_index), 1))
+
+        self.client.forget(self.table)
+        self.client.forget(target)
+#------------------------------------------------------------------------------
+
+class SQLiteCursor():
+    """
+    The documents matching a filter, standing in for a PyMongo Cursor. The
+    query is run when it is iterated, and read a batch at a time.
+    """
+    def __init__(self, collection, filter=None, projection=None):
+        self.collection = collection
+        self.filter     = filter
+        self.projection = projection
+        self.order      = []
+        self.count      = 0
+        self.size       = 1000
+
+    def sort(self, key, direction=pymongo.ASCENDING):
+        if isinstance(key, str):
+            key = [(key, direction)]
+        self.order.extend(key)
+        return self
+
+    def limit(self, count):
+        self.count = count
+        return self
+
+    def batch_size(self, size):
+        self.size = size
+        return self
+
+    def _sql(self, explain=False):
+        # The SQL and parameters for the query, None if there is no table
+        fields = dict(self.collection._fields())
+        if len(fields) == 0:
+            return None
+
+        names = list(fields)
+        if self.projection is not None:
+            included = [field for field, keep in self.projection.items() if keep and field != "_id"]
+            if len(included) > 0:
+                names = [field for field in included if field in fields]
+                if self.projection.get("_id", 1):
+                    names.insert(0, "_id")
+            else:
+                names = [field for field in names if self.projection.get(field, 1)]
+
+        where, params = self.collection._where(self.filter, fields)
+        sql = "SELECT {} FROM {} WHERE {}".format(", ".join(_quote(name) for name in names) or "NULL", _quote(self.collection.table), where)
+
+        order = ["{} {}".format(_quote(field), "DESC" if direction == pymongo.DESCENDING else "ASC") for field, direction in self.order if field in fields]
+        if len(order) > 0:
+            sql += " ORDER BY " + ", ".join(order)
+        if self.count > 0:
+            sql += " LIMIT {}".format(int(self.count))
+
+        return sql, params, names, [fields[name] for name in names]
+
+    def __iter__(self):
+        query = self._sql()
+        if query is None:
+            return
+
+        sql, params, names, kinds = query
+        cursor = self.collection.client.connection().execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(self.size)
+            if len(rows) == 0:
+                break
+            for row in rows:
+                yield self.collection._document(names, kinds, row)
+
+    def explain(self):
+        """
+        The SQLite query plan, in the shape of a MongoDB explain, a
+        COLLSCAN, IXSCAN or SORT stage for each step.
+        """
+        query = self._sql()
+        if query is None:
+            return {"queryPlanner" : {"winningPlan" : {"stage" : "EOF"}}}
+
+        sql, params, _, _ = query
+
+        return {"queryPlanner" : {"winningPlan" : _queryPlan(self.collection.client.connection(), sql, params)}}
+#------------------------------------------------------------------------------